@@ -0,0 +1,58 @@
+# coding: UTF-8
+"""
+The work done on the bot's process pool. It's kept apart from the bot, and nothing runs when it's imported, so the
+pool's workers never have to import the bot however they're started.
+"""
+
+from __future__ import print_function  # This does not break Python 3 compatibility.
+
+import re
+from random import randint
+
+dice = [u"0⃣", u"1⃣", u"2⃣", u"3⃣", u"4⃣", u"5⃣", u"6⃣", u"7⃣", u"8⃣", u"9⃣️⃣️"]  # 1-9 in emoji form
+
+
+def numToEmoji(s):
+    """
+    Replaces numbers with emojis.
+
+    :param s: The string to replace the numbers of with emojis.
+    :type s: string_types
+    :return: The provided string with its numbers replaced with emojis.
+    :rtype string_types:
+    """
+    for i in range(len(dice)):
+        s = s.replace(u"" + str(i), dice[i])  # Force string_types strings for Python 2 and Python 3.
+    return s
+
+
+def rollDice(numDice, numSides):
+    """
+    Rolls the given dice. Runs in the process pool, since it can take a while for lots of dice.
+
+    :param numDice: How many dice to roll.
+    :type numDice: int
+    :param numSides: How many sides each die has.
+    :type numSides: int
+    :return The: rolls, sum, max and min, in emoji form.
+    :rtype string_types:
+    """
+    rolls = [randint(1, numSides) for _ in range(numDice)]  # Roll the dice
+    return numToEmoji(u"".join(str(s) + u" " for s in rolls) + u"\nSum={}\nMax={}\nMin={}".format(
+        sum(rolls), max(rolls), min(rolls)))
+
+
+def replaceText(start, end, text):
+    """
+    Replaces start with end in text, ignoring case. Runs in the process pool, since it can take a while for big inputs.
+
+    :param start: The text to replace.
+    :type start: string_types
+    :param end: What to replace it with.
+    :type end: string_types
+    :param text: The text to replace it in.
+    :type text: string_types
+    :return The: text, with start replaced by end.
+    :rtype string_types:
+    """
+    return re.compile(re.escape(start), re.IGNORECASE).sub(end, text)
@@ -0,0 +1,289 @@
+# coding: UTF-8
+"""
+A full-text index of every message the bot has seen, kept in SQLite with FTS5, so the history can be searched without
+reading through the whole message log.
+
+The existing log can be added to the index with "python3 messageIndex.py backfill [log] [database]".
+"""
+
+from __future__ import print_function  # This does not break Python 3 compatibility.
+
+import re
+import sqlite3
+import unicodedata
+from io import open
+from sys import argv
+from threading import Thread
+from time import time
+
+from six.moves.queue import Empty, Full, Queue
+
+# The chat is indexed, so a search only looks at the chat being searched instead of every chat's matches.
+schema = u"""
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(message, sender, chat, time UNINDEXED);
+"""
+# What the message log's lines look like. Lines matching neither are the rest of a message with newlines in it.
+receivedPattern = re.compile(u"^\\[(\\d{4}-\\d\\d-\\d\\dT[\\d:.]+)\\] (.*?): (.*)$", re.DOTALL)
+sentPattern = re.compile(
+    u"^\\[(\\d{4}-\\d\\d-\\d\\dT[\\d:.]+)\\] Sent \"(.*)\" from (.*) \\(\\d+\\) to (.*) \\(\\d+\\)\\.$", re.DOTALL)
+linePattern = re.compile(u"^\\[\\d{4}-\\d\\d-\\d\\dT[\\d:.]+\\] ")
+
+
+def connect(path):
+    """
+    Opens the index, creating it if it doesn't exist.
+
+    :param path: The path of the database.
+    :type path: string_types
+    :return The: connection.
+    :rtype sqlite3.Connection:
+    """
+    connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    connection.execute(u"PRAGMA journal_mode=WAL")  # So searches can run while messages are being added.
+    connection.execute(u"PRAGMA synchronous=NORMAL")
+    old = connection.execute(u"SELECT sql FROM sqlite_master WHERE name = 'messages'").fetchone()
+    if old is not None and u"chat UNINDEXED" in old[0]:  # Made before chats were indexed.
+        with connection:
+            connection.execute(u"ALTER TABLE messages RENAME TO oldMessages")
+            connection.executescript(schema)
+            connection.execute(u"INSERT INTO messages (message, sender, chat, time) "
+                u"SELECT message, sender, chat, time FROM oldMessages")
+            connection.execute(u"DROP TABLE oldMessages")
+    connection.executescript(schema)
+    return connection
+
+
+def quote(text):
+    """
+    Quotes text as an FTS5 string, so it can't have syntax errors.
+
+    :param text: The text.
+    :type text: string_types
+    :return The: FTS5 string.
+    :rtype string_types:
+    """
+    return u"\"{}\"".format(text.replace(u"\"", u"\"\""))
+
+
+def hasTokens(text):
+    """
+    Checks whether FTS5's unicode61 tokenizer finds any words in some text. It only counts letters, numbers and
+    private use characters as parts of words, so text that's only punctuation or emoji has none.
+
+    :param text: The text.
+    :type text: string_types
+    :return Whether: it has any words.
+    :rtype bool:
+    """
+    return any(unicodedata.category(character)[0] in u"LN" or unicodedata.category(character) == u"Co"
+               for character in text)
+
+
+def toMatchQuery(query, chat=None):
+    """
+    Turns a search into an FTS5 query which can't have syntax errors, matching messages with every word in it in their
+    text or sender.
+
+    :param query: What was searched for.
+    :type query: string_types
+    :param chat: The title of the chat to search, or None to search every chat. Titles without any words can't be
+    matched, so they're left out, and the chat has to be checked some other way.
+    :type chat: string_types
+    :return The: FTS5 query.
+    :rtype string_types:
+    """
+    words = u"{{message sender}} : ({})".format(u" ".join(quote(word) for word in query.split()))
+    return words if chat is None or not hasTokens(chat) else u"chat : {} AND {}".format(quote(chat), words)
+
+
+class MessageIndex(object):
+    """
+    Adds messages to the index from a background thread, in batches, so adding a message only costs putting it in a
+    queue. Searches open their own connection, so they can run on any thread.
+    """
+
+    def __init__(self, path, queueSize=10000, flushInterval=1.0):
+        """
+        :param path: The path of the database, which is created if it doesn't exist.
+        :type path: string_types
+        :param queueSize: How many messages can be waiting to be added before new ones are dropped.
+        :type queueSize: int
+        :param flushInterval: How often, in seconds, waiting messages are added.
+        :type flushInterval: float
+        """
+        self.path, self.flushInterval = path, flushInterval
+        self.connection = connect(path)
+        self.queue = Queue(queueSize)
+        self.dropped = 0  # Messages not indexed because the queue was full.
+        self.thread = Thread(target=self._run, name=u"messageIndex")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, chat, sender, message, when):
+        """
+        Queues a message to be added to the index.
+
+        :param chat: The title of the chat the message was seen in.
+        :type chat: string_types
+        :param sender: Who sent it.
+        :type sender: string_types
+        :param message: The message, without any HTML.
+        :type message: string_types
+        :param when: When it was sent.
+        :type when: datetime
+        """
+        try:
+            self.queue.put_nowait((message, sender, chat, when.isoformat()))
+        except Full:
+            self.dropped += 1
+
+    def addMany(self, rows):
+        """
+        Adds messages to the index right away, in one transaction.
+
+        :param rows: The messages, as (message, sender, chat, ISO 8601 time).
+        :type rows: list
+        """
+        with self.connection:
+            self.connection.executemany(u"INSERT INTO messages (message, sender, chat, time) VALUES (?, ?, ?, ?)",
+                rows)
+
+    def search(self, chat, query, page=1, pageSize=5):
+        """
+        Finds the messages in a chat matching a search, best matches first.
+
+        :param chat: The title of the chat to search.
+        :type chat: string_types
+        :param query: What to search for. Every word has to be in the message or sender's name.
+        :type query: string_types
+        :param page: Which page of results to get, starting at 1.
+        :type page: int
+        :param pageSize: How many results are on a page.
+        :type pageSize: int
+        :return The: page of results, as (ISO 8601 time, sender, snippet of the message), and whether there are more.
+        :rtype tuple:
+        """
+        connection = sqlite3.connect(self.path, timeout=10)
+        # The MATCH finds the chat's messages, and chat = ? leaves out chats whose titles contain its title, or is the
+        # only check if the title has no words to match.
+        try:
+            rows = connection.execute(u"SELECT time, sender, snippet(messages, 0, '*', '*', '...', 16) FROM messages "
+                u"WHERE messages MATCH ? AND chat = ? ORDER BY rank LIMIT ? OFFSET ?",
+                (toMatchQuery(query, chat), chat, pageSize + 1, (page - 1) * pageSize)).fetchall()
+        finally:
+            connection.close()
+        return rows[:pageSize], len(rows) > pageSize
+
+    def close(self):
+        """
+        Adds every message still queued, then closes the index.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.connection.close()
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flushInterval)]
+            except Empty:
+                continue
+            try:  # Take everything else that's waiting, so it's all added in one transaction.
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            rows = [row for row in batch if row is not None]
+            if rows:
+                try:
+                    self.addMany(rows)
+                except sqlite3.Error as e:
+                    print(u"Could not index {} messages: {}".format(len(rows), e))
+            if None in batch:
+                return
+
+
+def readLog(logFile, commandDelimiter=u"!"):
+    """
+    Reads the message log one message at a time, without reading the whole thing into memory.
+
+    The log only says which chat a message came from when it was sent on to other chats, so only those messages are
+    read, once for the chat they came from and once for each chat they were sent to. Commands and the bot's own
+    messages are skipped, the same as when messages are indexed as they come in.
+
+    :param logFile: The message log, opened for reading.
+    :param commandDelimiter: What commands start with.
+    :type commandDelimiter: string_types
+    :return Each: message, as (message, sender, chat, ISO 8601 time).
+    :rtype generator:
+    """
+
+    def records():
+        record = None
+        for line in logFile:
+            if linePattern.match(line) and record is not None:
+                yield record.rstrip(u"\n")
+                record = None
+            record = line if record is None else record + line
+        if record is not None:
+            yield record.rstrip(u"\n")
+
+    received = None  # The last message received, as (time, sender, message).
+    chats = set()  # The chats the last message received has been read for already.
+    for record in records():
+        match = sentPattern.match(record)
+        if match:
+            message, sending, receiving = match.groups()[1:]
+            if received is None or message != u"{}: {}".format(*received[1:]) or \
+                    received[2].startswith(commandDelimiter):
+                continue  # It was sent by the bot, not forwarded from someone.
+            for chat in (sending, receiving):
+                if chat not in chats:
+                    chats.add(chat)
+                    yield received[2], received[1], chat, received[0]
+            continue
+        match = receivedPattern.match(record)
+        if match:
+            received, chats = match.groups(), set()
+
+
+def backfill(logPath, databasePath, batchSize=5000, commandDelimiter=u"!"):
+    """
+    Adds every message in the message log to the index.
+
+    :param logPath: The path of the message log.
+    :type logPath: string_types
+    :param databasePath: The path of the index.
+    :type databasePath: string_types
+    :param batchSize: How many messages are added per transaction.
+    :type batchSize: int
+    :param commandDelimiter: What commands start with.
+    :type commandDelimiter: string_types
+    :return How: many messages were added.
+    :rtype int:
+    """
+    connection = connect(databasePath)
+    count, batch, startTime = 0, [], time()
+    with open(logPath, encoding=u"utf-8", errors=u"replace") as logFile:
+        for row in readLog(logFile, commandDelimiter):
+            batch.append(row)
+            if len(batch) >= batchSize:
+                with connection:
+                    connection.executemany(u"INSERT INTO messages (message, sender, chat, time) VALUES (?, ?, ?, ?)",
+                        batch)
+                count += len(batch)
+                batch = []
+                print(u"{} messages indexed ({:.0f}/s)".format(count, count / max(time() - startTime, 0.001)))
+    with connection:
+        connection.executemany(u"INSERT INTO messages (message, sender, chat, time) VALUES (?, ?, ?, ?)", batch)
+    count += len(batch)
+    connection.close()
+    return count
+
+
+if __name__ == u"__main__":
+    if len(argv) < 2 or argv[1] != u"backfill":
+        print(u"Usage: python3 messageIndex.py backfill [log] [database]")
+        exit(1)
+    print(u"{} messages indexed.".format(backfill(argv[2] if len(argv) > 2 else u"Pidgin_Crossover_Messages.log",
+        argv[3] if len(argv) > 3 else u"messageIndex.db")))
@@ -0,0 +1,123 @@
+# coding: UTF-8
+"""
+Writes the message log on its own thread, so logging a message only costs putting it in a queue.
+"""
+
+from __future__ import print_function  # This does not break Python 3 compatibility.
+
+import gzip
+import shutil
+from datetime import datetime
+from glob import glob
+from io import open
+from os import remove, rename
+from threading import Thread
+from time import time
+
+from six.moves.queue import Empty, Full, Queue
+
+
+class MessageLog(object):
+    """
+    Appends lines to a log file from a background thread. Lines are written in batches and flushed every
+    flushInterval seconds. Once the file gets too big or too old, it's gzipped and a new one is started, keeping only
+    the newest few old logs so the log can't fill the disk.
+    """
+
+    def __init__(self, path, echo=True, maxBytes=16 * 1024 * 1024, maxAge=None, keep=8, queueSize=10000,
+            flushInterval=1.0):
+        """
+        :param path: The path of the log file.
+        :type path: string_types
+        :param echo: Whether every line should be printed to the console too.
+        :type echo: bool
+        :param maxBytes: How big the log can get, in bytes, before it's rotated, or None to never rotate by size.
+        :type maxBytes: int
+        :param maxAge: How old the log can get, in seconds, before it's rotated, or None to never rotate by age.
+        :type maxAge: float
+        :param keep: How many old, gzipped logs to keep.
+        :type keep: int
+        :param queueSize: How many lines can be waiting to be written before new ones are dropped.
+        :type queueSize: int
+        :param flushInterval: How often, in seconds, the log is flushed to the file.
+        :type flushInterval: float
+        """
+        self.path, self.echo = path, echo
+        self.maxBytes, self.maxAge, self.keep = maxBytes, maxAge, keep
+        self.flushInterval = flushInterval
+        self.queue = Queue(queueSize)
+        self.dropped = 0  # Lines dropped because the queue was full.
+        self.file = open(path, mode=u"a", encoding=u"utf-8")
+        self.opened = time()  # When the current log was started.
+        self.thread = Thread(target=self._run, name=u"messageLog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, line):
+        """
+        Queues a line to be written to the log. If the writer can't keep up, the line is dropped instead of waiting.
+
+        :param line: The line to write.
+        :type line: string_types
+        """
+        try:
+            self.queue.put_nowait(line)
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Writes everything still queued, then closes the log.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        lastFlush = time()
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flushInterval)]
+            except Empty:
+                batch = []
+            try:  # Take everything else that's waiting, so it all gets written at once.
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            closing = None in batch
+            lines = [line for line in batch if line is not None]
+            if lines:
+                if self.echo:
+                    print(u"\n".join(lines))
+                self.file.write(u"\n".join(lines) + u"\n")
+            if closing or time() - lastFlush >= self.flushInterval:
+                self.file.flush()
+                lastFlush = time()
+                if self._shouldRotate():
+                    self._rotate()
+            if closing:
+                self.file.close()
+                return
+
+    def _shouldRotate(self):
+        return (self.maxBytes is not None and self.file.tell() >= self.maxBytes) or \
+            (self.maxAge is not None and time() - self.opened >= self.maxAge)
+
+    def _rotate(self):
+        """
+        Gzips the current log, starts a new one, and removes old logs past the newest keep.
+        """
+        self.file.close()
+        oldPath = u"{}.{}".format(self.path, datetime.now().strftime(u"%Y%m%d-%H%M%S-%f"))
+        rename(self.path, oldPath)
+        self.file = open(self.path, mode=u"a", encoding=u"utf-8")
+        self.opened = time()
+        try:
+            with open(oldPath, u"rb") as oldFile, gzip.open(oldPath + u".gz", u"wb") as gzipFile:
+                shutil.copyfileobj(oldFile, gzipFile)
+            remove(oldPath)
+        except (IOError, OSError):  # Keep the uncompressed log rather than lose it.
+            pass
+        oldPaths = sorted(glob(self.path + u".????????-??????-??????*"))  # The timestamps sort oldest first.
+        for path in oldPaths[:max(len(oldPaths) - self.keep, 0)]:
+            remove(path)
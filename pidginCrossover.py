@@ -3,30 +3,42 @@
 A bot controlling an instance of pidgin/finch in order to send/receive messages.
 """
 
-# humanize, parsedatetime, pydbus, youtube-dl, and PyGObject are dependencies.
+# humanize, parsedatetime, pydbus, youtube-dl, and PyGObject are dependencies. pydbus is only needed to use DBus.
 # "sudo pip install pygobject humanize parsedatetime pydbus youtube-dl --upgrade" will do that for you.
 from __future__ import print_function  # This does not break Python 3 compatibility.
 
 import re
 import traceback
 from argparse import ArgumentError
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from io import open
-from itertools import chain
+from heapq import heapify, heappop, heappush
+from itertools import chain, count, groupby
 from json import dumps, loads
 from math import ceil
-from os import system as executeCommand
-from random import randint
+from multiprocessing import get_context
+from os import fsync, rename, system as executeCommand
+from os.path import exists
 from signal import SIGTERM, SIGQUIT
-from time import sleep, strptime
+from threading import Lock
+from time import sleep, strptime, time as currentTime
 
 from gi.repository import GLib, GObject
 from humanize import naturaldelta, naturaltime
-from parsedatetime import Calendar as datetimeParser
-from pydbus import SessionBus
 from six import string_types
 from youtube_dl import YoutubeDL as ydl
 
+from cpuWork import replaceText, rollDice
+from messageIndex import MessageIndex
+from messageLog import MessageLog
+from punIndex import PunIndex
+from purpleBackend import DBusPurpleBackend, PURPLE_CONV_TYPE_CHAT
+from schedules import parseRecurrence, splitCatchUp
+from stateStore import JournalStateStore, JsonStateStore, SqliteStateStore
+
 
 # Utility Functions:
 # -----------------------------------------------
@@ -70,29 +82,144 @@ def getChats():
 
     :return All: valid chat ids, filtering out any duplicate or invalid chats.
     """
-    rawChats = purple.PurpleGetConversations()
-    chatIDs = dict()
-    for i in rawChats:
-        info = (purple.PurpleConversationGetAccount(i), purple.PurpleConversationGetTitle(i))
-        if info not in chatIDs or chatIDs[info] < i <= 10000 or purple.PurpleConversationGetType(i) != 2:
-            chatIDs[info] = i
-    return tuple(chatIDs.values())
+    return tuple(convIdsByInfo.values())
+
+
+def _preferConv(current, candidate, convType):
+    """
+    Whether candidate should replace current as the conversation used for an (account, title) pair.
+
+    :param current: The ID of the conversation currently used, or None.
+    :type current: int
+    :param candidate: The ID of the conversation which might replace it.
+    :type candidate: int
+    :param convType: The type of the candidate conversation.
+    :type convType: int
+    :return If: candidate should be used instead of current.
+    :rtype bool:
+    """
+    return current is None or current < candidate <= 10000 or convType != PURPLE_CONV_TYPE_CHAT
+
+
+def registerConv(conv):
+    """
+    Adds a conversation to the conversation registry, looking its account, title and type up over DBus once.
+
+    :param conv: The ID of the conversation.
+    :type conv: int
+    :return The: (account, title, type) of the conversation.
+    :rtype tuple:
+    """
+    info = (purple.PurpleConversationGetAccount(conv), purple.PurpleConversationGetTitle(conv),
+        purple.PurpleConversationGetType(conv))
+    convInfo[conv] = info
+    if _preferConv(convIdsByInfo.get(info[:2]), conv, info[2]):
+        convIdsByInfo[info[:2]] = conv
+        convIdsByTitle[info[1]] = conv
+    return info
+
+
+def unregisterConv(conv):
+    """
+    Removes a conversation from the conversation registry, falling back to any other conversation with its title.
+
+    :param conv: The ID of the conversation.
+    :type conv: int
+    """
+    info = convInfo.pop(conv, None)
+    if info is None:
+        return
+    if convIdsByInfo.get(info[:2]) == conv:
+        del convIdsByInfo[info[:2]]
+        for otherConv, otherInfo in convInfo.items():  # Only happens when a conversation closes, so scanning is fine.
+            if otherInfo[:2] == info[:2] and _preferConv(convIdsByInfo.get(info[:2]), otherConv, otherInfo[2]):
+                convIdsByInfo[info[:2]] = otherConv
+    rosters.pop(conv, None)
+    if convIdsByTitle.get(info[1]) == conv:
+        del convIdsByTitle[info[1]]
+        replacement = next((i for i in convIdsByInfo.values() if convInfo[i][1] == info[1]), None)
+        if replacement is not None:
+            convIdsByTitle[info[1]] = replacement
+
+
+def buildConvRegistry():
+    """
+    Rebuilds the conversation registry from every conversation libpurple currently has open.
+    """
+    convInfo.clear()
+    convIdsByInfo.clear()
+    convIdsByTitle.clear()
+    for conv in purple.PurpleGetConversations():
+        registerConv(conv)
+
+
+def onConversationUpdated(conv, updateType):
+    """
+    Keeps the conversation registry current when a conversation's title or account changes.
+
+    :param conv: The ID of the conversation.
+    :type conv: int
+    :param updateType: What changed, as a PurpleConvUpdateType.
+    :type updateType: int
+    """
+    if updateType in (PURPLE_CONV_UPDATE_ACCOUNT, PURPLE_CONV_UPDATE_TITLE):
+        unregisterConv(conv)
+        registerConv(conv)
 
 
 def updateFile(path, value):
     """
-    Replaces the contents of the file at the given path with the given value.
+    Marks the file at the given path to be replaced with the given value. Files are written flushDelay seconds after
+    they first change, and when the bot exits, so lots of changes in a row only write the file once.
+
+    :param path: The file path of the file to overwrite.
+    :type path: string_types
+    :param value: The value to overwrite the file with, which is serialized as json when it's written.
+    """
+    global flushSource
+    dirtyFiles[path] = value
+    if flushSource is None:
+        flushSource = GLib.timeout_add_seconds(flushDelay, flushFiles)
+
+
+def flushFiles():
+    """
+    Writes every file which has changed since it was last written.
+
+    :return False:, so the GLib source only runs once.
+    :rtype bool:
+    """
+    global flushSource
+    if flushSource is not None:
+        GLib.source_remove(flushSource)
+        flushSource = None
+    while dirtyFiles:
+        path, value = dirtyFiles.popitem()
+        try:
+            writeFile(path, value)
+        except (IOError, OSError):
+            print(u"Couldn't write {}!\n".format(path), traceback.format_exc())
+    return False
+
+
+def writeFile(path, value):
+    """
+    Replaces the contents of the file at the given path with the given value, serialized as json. The file is written
+    next to the old one, then renamed over it, so a crash can never leave it half-written.
 
     :param path: The file path of the file to overwrite.
     :type path: string_types
-    :param value: The string to overwrite the file with.
-    :type value: string_types
+    :param value: The value to overwrite the file with.
     """
 
     serializeDate = lambda dtOrStr: dtOrStr.strftime(dtFormatStr) if isinstance(dtOrStr, datetime) else None
-    with open(path, mode=u"w", encoding=u"utf-8") as openFile:  # To update a file
+    tempPath = path + u".tmp"
+    with open(tempPath, mode=u"w", encoding=u"utf-8") as openFile:  # To update a file
         openFile.write(dumps(value, indent=4, default=serializeDate, ensure_ascii=False))
         # The default function allows it to dump datetime objects.
+        openFile.flush()
+        fsync(openFile.fileno())  # Make sure it's actually on the disk before replacing the old one.
+    rename(tempPath, path)
 
 
 # Fixes rounding errors.
@@ -102,86 +229,349 @@ naturalDelta = lambda time: naturaldelta(time - timedelta(seconds=1))
 
 def getNameFromArgs(act, name, conv=None):
     """
-    Gets a user's actual name given the account and name.
+    Gets a user's actual name given the account and name. Resolved names are cached until a buddy or nick changes.
 
     :param act: The account from the argSet.
     :param name: The user's name from the argSet.
     :param conv: The conversation from the argSet.
     :return The: user's nickname, or their actual name if no nick was found.
     """
-    act = purple.PurpleConversationGetAccount(conv) if conv is not None else act
-    buddy = purple.PurpleFindBuddy(act, name)
-    realName = purple.PurpleBuddyGetAlias(buddy) or purple.PurpleBuddyGetName(buddy)
     chat = None  # This is here so PyCharm doesn't complain about chat not existing in the return statement.
     if conv is not None:
-        chat = getChatName(conv)
-    return (nicks[chat].get(realName, realName) if chat in nicks else realName) or name
+        act, chat = getConvInfo(conv)[:2]
+    chatNames = nameCache.setdefault(chat, {})
+    if (act, name) in chatNames:
+        botStats[u"nameCacheHits"] += 1
+        return chatNames[act, name]
+    botStats[u"nameCacheMisses"] += 1
+    buddy = purple.PurpleFindBuddy(act, name)
+    realName = purple.PurpleBuddyGetAlias(buddy) or purple.PurpleBuddyGetName(buddy)
+    chatNames[act, name] = (nicks[chat].get(realName, realName) if chat in nicks else realName) or name
+    return chatNames[act, name]
+
+
+def invalidateNames(chat=None, *_):
+    """
+    Forgets resolved names, either for one chat or, if no chat is given, for all of them.
+
+    :param chat: The title of the chat whose names changed, or None if any name could have changed.
+    :type chat: string_types
+    """
+    if chat is None:
+        nameCache.clear()
+    else:
+        nameCache.pop(chat, None)
+    for conv, roster in rosters.items():  # Rosters are indexed by the names, so they have to be indexed again.
+        if chat is None or getConvInfo(conv)[1] == chat:
+            roster.clearIndex()
+
+
+# Clears every resolved name when libpurple's buddy list changes, since buddies aren't tied to a single chat.
+onBuddyChanged = lambda *_: invalidateNames()
+
+
+class Roster(object):
+    """
+    The users in a chat, kept current from libpurple's signals instead of asking libpurple for the whole list every
+    time. Once searched, the users are indexed by every suffix of their lower-cased names, sorted, so exact, prefix and
+    substring matches are all found with one binary search.
+    """
+
+    def __init__(self, conv, users):
+        """
+        :param conv: The ID of the chat.
+        :type conv: int
+        :param users: The names of the users in the chat, as libpurple has them.
+        :type users: list
+        """
+        self.conv = conv
+        self.users = {}  # User -> their resolved name, or None if the index hasn't been made.
+        self.suffixes = None  # Sorted (suffix of a lower-cased name, where it starts, resolved name)
+        for user in users:
+            self.users[user] = None
+
+    def _keys(self, user):
+        name = self.users[user]
+        return {name.lower(), user.lower()}  # Users can be found by their resolved name or the name libpurple has.
+
+    def _index(self, user):
+        self.users[user] = getNameFromArgs(None, user, self.conv)
+        for key in self._keys(user):
+            for start in range(len(key)):
+                insort(self.suffixes, (key[start:], start, self.users[user]))
+
+    def _unindex(self, user):
+        for key in self._keys(user):
+            for start in range(len(key)):
+                i = bisect_left(self.suffixes, (key[start:], start, self.users[user]))
+                if i < len(self.suffixes) and self.suffixes[i] == (key[start:], start, self.users[user]):
+                    del self.suffixes[i]
+
+    def add(self, user):
+        """
+        Adds a user who joined the chat.
+
+        :param user: The name of the user, as libpurple has it.
+        :type user: string_types
+        """
+        if user in self.users:
+            return
+        self.users[user] = None
+        if self.suffixes is not None:
+            self._index(user)
+
+    def remove(self, user):
+        """
+        Removes a user who left the chat.
+
+        :param user: The name of the user, as libpurple has it.
+        :type user: string_types
+        """
+        if user not in self.users:
+            return
+        if self.suffixes is not None:
+            self._unindex(user)
+        del self.users[user]
+
+    def clearIndex(self):
+        """
+        Forgets the resolved names, so they're resolved and indexed again the next time they're needed.
+        """
+        self.suffixes = None
+        for user in self.users:
+            self.users[user] = None
+
+    def getNames(self):
+        """
+        Gets the resolved names of everyone in the chat.
+
+        :return The: names.
+        :rtype list:
+        """
+        self._buildIndex()
+        return list(self.users.values())
+
+    def find(self, partialName):
+        """
+        Finds the user whose name best matches a partial name: one which is the same, then one which starts with it,
+        then one which has it anywhere. Ties go to the name which sorts first.
+
+        :param partialName: The partial name, which can be any case.
+        :type partialName: string_types
+        :return How: good the match is (0 for the same, 1 for starts with, 2 for anywhere) and the resolved name, or
+            None if nobody matches.
+        :rtype tuple:
+        """
+        self._buildIndex()
+        partialName = partialName.lower()
+        best = None
+        for i in range(bisect_left(self.suffixes, (partialName,)), len(self.suffixes)):
+            suffix, start, name = self.suffixes[i]
+            if not suffix.startswith(partialName):
+                break
+            match = (2 if start else 0 if suffix == partialName else 1, name)
+            best = match if best is None else min(best, match)
+        return best
+
+    def _buildIndex(self):
+        if self.suffixes is None:
+            self.suffixes = []
+            for user in self.users:
+                self._index(user)
+
+
+def getRoster(conv):
+    """
+    Gets the roster for a chat, asking libpurple who's in it the first time.
+
+    :param conv: The ID of the chat.
+    :type conv: int
+    :return The: roster.
+    :rtype Roster:
+    """
+    if conv not in rosters:
+        rosters[conv] = Roster(conv, [purple.PurpleConvChatCbGetName(user) for user in
+            purple.PurpleConvChatGetUsers(purple.PurpleConvChat(int(conv)))])
+    return rosters[conv]
+
+
+def onChatBuddyJoined(conv, user, *_):
+    """
+    Adds a user to a chat's roster when they join it.
+
+    :param conv: The ID of the chat.
+    :type conv: int
+    :param user: The name of the user.
+    :type user: string_types
+    """
+    if conv in rosters:  # Rosters which haven't been made yet will get everyone when they are.
+        rosters[conv].add(user)
+
+
+def onChatBuddyLeft(conv, user, *_):
+    """
+    Removes a user from a chat's roster when they leave it.
+
+    :param conv: The ID of the chat.
+    :type conv: int
+    :param user: The name of the user.
+    :type user: string_types
+    """
+    if conv in rosters:
+        rosters[conv].remove(user)
+
+
+# A user's flags only change while they're in the chat, so make sure they're in the roster.
+onChatBuddyFlags = onChatBuddyJoined
+
+
+def onChatBuddyRenamed(conv, oldUser, newUser, *_):
+    """
+    Swaps a user's old name for their new one in a chat's roster when they change it.
+
+    :param conv: The ID of the chat.
+    :type conv: int
+    :param oldUser: The user's old name.
+    :type oldUser: string_types
+    :param newUser: The user's new name.
+    :type newUser: string_types
+    """
+    if conv in rosters:
+        rosters[conv].remove(oldUser)
+        rosters[conv].add(newUser)
+
+
+def getAccountAlias(account):
+    """
+    Gets the alias of one of the bot's accounts, cached until libpurple says it changed.
+
+    :param account: The account ID.
+    :type account: int
+    :return The: account's alias.
+    :rtype string_types:
+    """
+    if account not in accountAliases:
+        accountAliases[account] = purple.PurpleAccountGetAlias(account)
+    return accountAliases[account]
+
+
+def getAccountUsername(account):
+    """
+    Gets the username of one of the bot's accounts. Usernames can't change, so they're cached forever.
+
+    :param account: The account ID.
+    :type account: int
+    :return The: account's username.
+    :rtype string_types:
+    """
+    if account not in accountUsernames:
+        accountUsernames[account] = purple.PurpleAccountGetUsername(account)
+    return accountUsernames[account]
+
+
+def getConvInfo(chatId):
+    """
+    Gets the (account, title, type) of a conversation from the conversation registry.
+
+    :param chatId: The ID of the conversation.
+    :type chatId: int
+    :return The: (account, title, type) of the conversation.
+    :rtype tuple:
+    """
+    return convInfo.get(chatId) or registerConv(chatId)
+
+
+getChatName = lambda chatId: getConvInfo(chatId)[1]  # Gets the name of a chat given the chat's ID.
 
 
-getChatName = lambda chatId: purple.PurpleConversationGetTitle(chatId)  # Gets the name of a chat given the chat's ID.
+def getTimeShape(phrase):
+    """
+    Parses the common kinds of natural time strings with precompiled patterns, so parsedatetime isn't needed for them.
+    Shapes don't depend on the current time, so each phrase only has to be parsed once.
+
+    :param phrase: A natural time string, lowercase with single spaces, such as "in 30 minutes" or "7 pm".
+    :type phrase: string_types
+    :return (u"in":, seconds), (u"at", hour, minute), or None if it needs parsedatetime.
+    :rtype tuple:
+    """
+    if phrase in timeShapes:
+        return timeShapes[phrase]
+    shape = None
+    relativeMatch, clockMatch = relativeTimePattern.match(phrase), clockTimePattern.match(phrase)
+    if relativeMatch:
+        shape = (u"in", sum((1 if amount in (u"a", u"an") else int(amount)) * timeUnits[unit[0]]
+            for amount, unit in timeAmountPattern.findall(relativeMatch.group(1))))
+    elif clockMatch:
+        namedTime, hour, minute, half, hour24, minute24 = clockMatch.groups()
+        if namedTime:
+            shape = (u"at", 12 if namedTime == u"noon" else 0, 0)
+        elif hour and 1 <= int(hour) <= 12:
+            shape = (u"at", int(hour) % 12 + (12 if half == u"p" else 0), int(minute or 0))
+        elif hour24 and int(hour24) < 24:
+            shape = (u"at", int(hour24), int(minute24))
+        if shape is not None and shape[2] > 59:
+            shape = None
+    if len(timeShapes) >= timeShapesSize:
+        timeShapes.clear()
+    timeShapes[phrase] = shape
+    return shape
 
 
 def getTime(currTime):
     """
-    Given a natural time string, such as "in 30 minutes", returns that time as a datetime object.
+    Given a natural time string, such as "in 30 minutes", returns that time as a datetime object. Common phrases are
+    handled by getTimeShape, and anything else by parsedatetime. Each phrase is only worked out once per message.
 
     :param currTime: A natural time string, such as "in 30 minutes" or "7 PM".
     :type currTime: string_types
     :return The: natural time as a datetime object.
     :rtype datetime:
     """
-    return parser.parseDT(currTime)[0]
+    global parser
+    phrase = u" ".join(currTime.lower().split())
+    if phrase not in parsedTimes:
+        shape = getTimeShape(phrase)
+        rightNow = now().replace(microsecond=0)  # The same as parsedatetime gives.
+        if shape is None:
+            if parser is None:  # parsedatetime takes a while to set up, so only do it if it's needed.
+                from parsedatetime import Calendar as datetimeParser
+                parser = datetimeParser()
+            parsedTimes[phrase] = parser.parseDT(currTime)[0]
+        elif shape[0] == u"in":
+            parsedTimes[phrase] = rightNow + timedelta(seconds=shape[1])
+        else:
+            parsedTimes[phrase] = rightNow.replace(hour=shape[1], minute=shape[2], second=0)
+    return parsedTimes[phrase]
 
 
 def _formatCommandAndAliases(lst, formatStr):
     """
     Formats the commands and aliases alphabetically in a nice way.
 
-    :param lst: The list of commands/aliases.
+    :param lst: The list of commands/aliases, sorted.
     :type lst: list
     :param formatStr: The format string to use with the list of aliases.
     :type formatStr: string_types
     :return The: commands and aliases formatted alphabetically, as a unicode string.
     :rtype string_types:
     """
-    lastValue = None
-    alphabeticalLists = []
-    currentList = []
-    for i in range(len(lst)):
-        val = lst[i]
-        if lastValue is None:
-            lastValue = val
-            currentList.append(val)
-        elif lastValue[:1] != val[:1]:
-            lastValue = val
-            alphabeticalLists.append(currentList)
-            currentList = []
-        else:
-            currentList.append(val)
-    return formatStr.format(u"\n".join((u", ".join(alphabeticalList) for alphabeticalList in alphabeticalLists)))
+    return formatStr.format(u"\n".join(u", ".join(alphabeticalList) for _, alphabeticalList in
+        groupby(lst, lambda val: val[:1])))
 
 
 def getAliases(argSet):
     """
-    Returns all of the valid aliases, formatted nicely.
+    Returns all of the valid aliases, formatted nicely. Only formatted again once an alias or link changes.
 
     :param argSet: The set of values passed in to messageListener.
     :type argSet: tuple
     :return All: of the valid aliases, formatted nicely.
     :rtype string_types:
     """
-    availableAliases = dict()
-    convTitle = purple.PurpleConversationGetTitle(argSet[3])
-    if convTitle in messageLinks:
-        if isListButNotString(messageLinks[convTitle]):
-            for conv in messageLinks[convTitle]:
-                if conv in aliases:
-                    availableAliases.update(aliases[conv])
-        elif messageLinks[convTitle] in aliases:
-            availableAliases.update(aliases[messageLinks[convTitle]])
-    availableAliases.update(aliases[getChatName(argSet[3])])
-    aliasList = list(sorted(availableAliases.keys()))
-    return _formatCommandAndAliases(aliasList, u"Valid aliases: {}")
+    convTitle = getChatName(argSet[3])
+    if convTitle not in aliasListings:
+        aliasListings[convTitle] = _formatCommandAndAliases(sorted(getAliasTable(convTitle)), u"Valid aliases: {}")
+    return aliasListings[convTitle]
 
 
 def getCommands(argSet):
@@ -193,8 +583,122 @@ def getCommands(argSet):
     :return A: list of all of the commands.
     :rtype string_types:
     """
-    commandList = list(sorted(commands.keys()))
-    return _formatCommandAndAliases(commandList, u"Valid Commands: {}") + "\n" + getAliases(argSet)
+    global commandListing
+    if commandListing is None:  # The commands never change, so they're only formatted once.
+        commandListing = _formatCommandAndAliases(sortedCommands, u"Valid Commands: {}")
+    return commandListing + u"\n" + getAliases(argSet)
+
+
+def editDistance(first, second, limit):
+    """
+    Counts how many letters have to be added, removed, changed or swapped with the next one to turn one word into
+    another.
+
+    :param first: The first word.
+    :type first: string_types
+    :param second: The second word.
+    :type second: string_types
+    :param limit: Stop counting past this, since it's too far anyway.
+    :type limit: int
+    :return The: distance, or limit + 1 if it's more than limit.
+    :rtype int:
+    """
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    previous, current = None, list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                previous[j - 1] + (first[i - 1] != second[j - 1]))
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+    return current[-1]
+
+
+def getDeletes(word, distance):
+    """
+    Gets every way of removing up to distance letters from a word, including the word itself.
+
+    :param word: The word.
+    :type word: string_types
+    :param distance: The most letters to remove.
+    :type distance: int
+    :return Every: word left after removing the letters.
+    :rtype set:
+    """
+    deletes, edge = {word}, {word}
+    for _ in range(distance):
+        edge = {shorter[:i] + shorter[i + 1:] for shorter in edge for i in range(len(shorter))} - deletes
+        deletes |= edge
+    return deletes
+
+
+def getSuggestionIndex(chat):
+    """
+    Gets the index used to suggest commands and aliases in a chat. Every name is filed under each way of removing up
+    to suggestionDistance letters from it, so any name close to a typo shares one of those with it. Only made again
+    once an alias or link changes.
+
+    :param chat: The title of the chat.
+    :type chat: string_types
+    :return What: is left after removing letters -> the names it came from.
+    :rtype dict:
+    """
+    if chat not in suggestionIndexes:
+        index = {}
+        names = [name for name in chain(sortedCommands, getAliasTable(chat)) if len(name) <= maxSuggestionLength]
+        for name in names:
+            for delete in getDeletes(name, suggestionDistance):
+                index.setdefault(delete, set()).add(name)
+        suggestionIndexes[chat] = index
+        longestNames[chat] = max(len(name) for name in names)
+    return suggestionIndexes[chat]
+
+
+def suggestCommands(argSet, name, maxSuggestions=3):
+    """
+    Finds the commands and aliases closest to one which doesn't exist, closest first.
+
+    :param argSet: The set of values passed in to messageListener.
+    :type argSet: tuple
+    :param name: The command or alias which doesn't exist, lowercased.
+    :type name: string_types
+    :param maxSuggestions: The most commands and aliases to suggest.
+    :type maxSuggestions: int
+    :return The: commands and aliases.
+    :rtype list:
+    """
+    if not name or len(name) < suggestionDistance:  # Every short command would be close enough to suggest.
+        return []
+    chat = getChatName(argSet[3])
+    index = getSuggestionIndex(chat)
+    if len(name) > longestNames[chat] + suggestionDistance:  # Too long to be close to anything, and slow to check.
+        return []
+    candidates = set()
+    for delete in getDeletes(name, suggestionDistance):
+        candidates.update(index.get(delete, ()))
+    distances = ((editDistance(name, candidate, suggestionDistance), candidate) for candidate in candidates)
+    return [candidate for distance, candidate in sorted(distances)
+            if distance <= suggestionDistance][:maxSuggestions]
+
+
+def commandNotFound(argSet):
+    """
+    Tells the chat a command or alias doesn't exist, suggesting the closest ones.
+
+    :param argSet: The command which wasn't found.
+    :type argSet: ParsedCommand
+    """
+    suggestions = suggestCommands(argSet, argSet.command)
+    if suggestions:
+        simpleReply(argSet, u"Command/alias \"{}\" not found. Did you mean {}?".format(argSet.command,
+            u" or ".join(u"\"{}{}\"".format(argSet.delimiter, suggestion) for suggestion in suggestions)))
+    else:
+        simpleReply(argSet, u"Command/alias \"{}\" not found. {}commands lists them all.".format(argSet.command,
+            argSet.delimiter))
 
 
 def getFullConvName(partialName):
@@ -206,7 +710,7 @@ def getFullConvName(partialName):
     :return The: conversation ID.
     :rtype int:
     """
-    conversations = [purple.PurpleConversationGetTitle(conv) for conv in getChats()]
+    conversations = list(convIdsByTitle.keys())
     # Check the beginning first, if none start with the partial name, find it in there somewhere.
     return next((i for i in conversations if i == partialName), None) or \
            next((i for i in conversations if i[:len(partialName)] == partialName), None) or \
@@ -226,83 +730,262 @@ def simpleReply(argSet, message):
     :param message: The message to send out.
     :type message: string_types
     """
-    sendMessage(argSet[-2], argSet[-2], u"", message)  # Replies to a chat
+    # Replies to a chat. This goes through the same queue as forwarded messages so it stays in order with them.
+    sendMessages(argSet[-2], [argSet[-2]], u"", message)
 
     # Forwards the message to linked chats.
     conversation = argSet[3]
-    nick = purple.PurpleAccountGetAlias(argSet[0])
-
-    title = purple.PurpleConversationGetTitle(conversation)
-    if title in messageLinks:  # Gets conversations by their title, so they work across libpurple reboots.
-        if isListButNotString(messageLinks[title]):
-            for receiving in messageLinks[title]:  # It can send to multiple chats.
-                receiving = getConvByName(receiving)
-                sendMessage(conversation, receiving, nick, message)
-        else:
-            receiving = getConvByName(messageLinks[title])
-            sendMessage(conversation, receiving, nick, message)
+    nick = getAccountAlias(argSet[0])
+
+    # Gets conversations by their title, so they work across libpurple reboots. It can send to multiple chats at once.
+    linked = getLinkedChats(getChatName(conversation))
+    if linked:
+        sendMessages(conversation, [getConvByName(receiving) for receiving in linked], nick, message)
 
 
 # Gets the ID of a conversation, given its name. Does not work if a message has not been received from that chat yet.
-getConvByName = lambda name: next((i for i in getChats() if purple.PurpleConversationGetTitle(i) == name), None)
+getConvByName = lambda name: convIdsByTitle.get(name)
+
+# Runs commands which use a lot of CPU, like diceroll, with functions from cpuWork. Its workers are forked here, before
+# the bot starts any threads or opens anything, so they don't copy locks other threads are holding. Spawning them instead
+# would make them run this whole file again.
+backgroundProcesses = 2
+processPool = ProcessPoolExecutor(backgroundProcesses, mp_context=get_context(u"fork"))
+processPool.submit(int)  # Workers only start with the first job.
 
-logFile = open(u"Pidgin_Crossover_Messages.log", mode=u"a")
+# Written on another thread, gzipping the log once it passes 16MB and keeping the last 8.
+messageLog = MessageLog(u"Pidgin_Crossover_Messages.log", echo=True)
+messageIndex = MessageIndex(u"messageIndex.db")  # Every message, for the search command.
+maxSearchPage = 1000  # The furthest page of results the search command looks at.
 
 
 def log(msg):
     """
-    Writes msg into the console and appends it to the log file.
+    Queues msg to be written into the console and appended to the log file.
 
     :param msg: The string to write.
     :type msg: string_types
     """
-    print(msg)
-    print(msg, file=logFile)
+    messageLog.write(msg)
+
+
+def invalidateAliases():
+    """
+    Forgets everything worked out from the aliases and links, such as which aliases each chat can use. Run whenever
+    either changes.
+    """
+    aliasTables.clear()
+    aliasListings.clear()
+    suggestionIndexes.clear()
+    longestNames.clear()
+
+
+def compileRoutes():
+    """
+    Compiles messageLinks into routes. Each chat gets every chat its messages should go to exactly once, in order,
+    never including itself, even if the links have duplicates or cycles. Run whenever messageLinks changes.
+    """
+    global routes
+    direct = {source: tuple(linked) if isListButNotString(linked) else (linked,)
+              for source, linked in messageLinks.items()}
+    compiled = {}
+    for source, linked in direct.items():
+        visited = {source}
+        destinations = []
+        pending = deque(linked)
+        while pending:  # Breadth-first, so nearer chats come first.
+            chat = pending.popleft()
+            if chat in visited:  # Duplicates and cycles end here.
+                continue
+            visited.add(chat)
+            destinations.append(chat)
+            if transitiveLinks:
+                pending.extend(direct.get(chat, ()))
+        if destinations:
+            compiled[source] = tuple(destinations)
+    routes = compiled  # Replaced all at once, so nothing ever sees half of it.
+    invalidateAliases()  # Chats get aliases and puns from the chats they're linked to.
+    punIndexes.clear()
 
 
+getLinkedChats = lambda title: routes.get(title, ())  # The titles of every chat a chat's messages go to.
+
 # Returns what it says on the tin.
 isListButNotString = lambda obj: isinstance(obj, (list, tuple, set)) and not isinstance(obj, string_types)
 
+# The conversation registry, so conversations don't have to be looked up over DBus for every message.
+convInfo = {}  # Conversation ID -> (account, title, type)
+convIdsByInfo = {}  # (account, title) -> conversation ID, with duplicate conversations filtered out.
+convIdsByTitle = {}  # Conversation title -> conversation ID
+PURPLE_CONV_UPDATE_ACCOUNT = 2
+PURPLE_CONV_UPDATE_TITLE = 11
+
+# Caches for names, which otherwise take several DBus calls per message to resolve.
+nameCache = {}  # Chat title -> {(account, name) -> resolved name}
+rosters = {}  # Chat ID -> the Roster of the users in it.
+accountAliases = {}  # Account ID -> alias
+accountUsernames = {}  # Account ID -> username
+botStats = {  # Counters which are shown by the stats command.
+    u"nameCacheHits": 0,
+    u"nameCacheMisses": 0,
+    u"messagesCoalesced": 0,
+    u"messagesDelayed": 0,
+    u"messagesDropped": 0,
+    u"outboundMessages": 0,
+    u"outboundSends": 0,
+    u"loopsSuppressed": 0
+}
+
 # Read files for persistent values.
-messageLinks, puns, aliases, atLoc, scheduledEvents, nicks, commandDelimiters = readFiles(u"messageLinks.json",
-    u"Puns.json", u"Aliases.json", u"atLoc.json", u"scheduledEvents.json", u"nicks.json", u"commandDelimiters.json")
+messageLinks, commandDelimiters, rateLimitPolicies = readFiles(u"messageLinks.json", u"commandDelimiters.json",
+    u"rateLimitPolicies.json")
+dtFormatStr = u"%a, %d %b %Y %H:%M:%S UTC"
+# Puns, aliases, nicks, locations and events are kept in a SQLite database once it's been made with
+# "python3 stateStore.py migrate", in a snapshot and a journal if useStateJournal is set, and in json files otherwise.
+stateDatabase = u"pidginBot.db"
+useStateJournal = False  # Whether to append changes to a journal instead of rewriting a json file for each one.
+stateSnapshot, stateJournal = u"state.json", u"state.journal"
+journalCompactSize = 256 * 1024  # How big the journal can get, in bytes, before it's folded into the snapshot.
+if exists(stateDatabase):
+    stateStore = SqliteStateStore(stateDatabase, dtFormatStr)
+elif useStateJournal:
+    stateStore = JournalStateStore(stateSnapshot, stateJournal, readFile, journalCompactSize, dateFormat=dtFormatStr)
+else:
+    stateStore = JsonStateStore(readFile, updateFile)
+puns, aliases, atLoc, scheduledEvents, nicks = (stateStore.load(table) for table in
+                                                (u"puns", u"aliases", u"atLoc", u"scheduledEvents", u"nicks"))
 
 commandDelimiter = u"!"  # What character(s) the commands should start with.
 commandDelimiters = commandDelimiters or {}
-lastMessage = {}  # The last message, to prevent infinite looping.
 defaultLocMinutes = 45
 defaultLocTime = u"{} minutes".format(defaultLocMinutes)  # What to use when someone goes somewhere by default.
 now = datetime.now
 lastMessageTime = now()
 startTime = now()
-parser = datetimeParser()
+parser = None  # parsedatetime's Calendar, which is created the first time getTime needs it.
+parsedTimes = {}  # Natural time string -> the time it means, for the message being handled.
+timeShapes = {}  # Natural time string -> what getTimeShape made of it.
+timeShapesSize = 1000  # How many phrases timeShapes remembers before it starts over.
+timeUnits = {u"s": 1, u"m": 60, u"h": 60 * 60, u"d": 24 * 60 * 60, u"w": 7 * 24 * 60 * 60}  # By their first letter.
+timeAmountPattern = re.compile(u"(\\d+|an?) ?(seconds?|secs?|minutes?|mins?|hours?|hrs?|days?|weeks?)\\b")
+relativeTimePattern = re.compile(u"^(?:in )?((?:(?:\\d+|an?) ?(?:seconds?|secs?|minutes?|mins?|hours?|hrs?|days?|"
+    u"weeks?)(?:,? (?:and )?|$| (?=from now$)))+)(?:from now)?$")
+clockTimePattern = re.compile(
+    u"^(?:at )?(?:(noon|midnight)|(\\d{1,2})(?::(\\d\\d))? ?([ap])\\.?m\\.?|(\\d{1,2}):(\\d\\d))$")
 messageLinks = messageLinks or {}
-puns = puns or {}
-aliases = aliases or {}
-atLoc = atLoc or {}
-scheduledEvents = scheduledEvents or []
+transitiveLinks = False  # Whether messages also go to the chats linked to the chats a chat is linked to, and so on.
+routes = {}  # Chat title -> tuple of the titles of every chat its messages go to, compiled from messageLinks.
+aliasTables = {}  # Chat title -> {alias -> AliasTemplate} for every alias usable in it, including linked chats'.
+aliasListings = {}  # Chat title -> its aliases, formatted for the aliases command.
+suggestionIndexes = {}  # Chat title -> the index used to suggest commands and aliases in it.
+suggestionDistance = 2  # How many typos a command or alias can have and still be suggested.
+maxSuggestionLength = 32  # Longer aliases aren't suggested, so they can't make the index huge.
+longestNames = {}  # Chat title -> how long the longest name in its suggestion index is.
+punIndexes = {}  # Chat title -> the PunIndex of the puns usable in it, including linked chats'.
+compileRoutes()
 aliasVars = [  # Replace the string with the result from the lambda below.
-    (u"%sendername", lambda argSet: purple.PurpleBuddyGetName(purple.PurpleFindBuddy(argSet[0], argSet[1]))),
-    (u"%senderalias", lambda argSet: purple.PurpleBuddyGetAlias(purple.PurpleFindBuddy(argSet[0], argSet[1]))),
-    (u"%botname", lambda argSet: purple.PurpleAccountGetAlias(argSet[0])),
-    (u"%chattitle", lambda argSet: purple.PurpleConversationGetTitle(argSet[3])),
+    (u"%sendername", lambda argSet: purple.PurpleBuddyGetName(getMessageBuddy(argSet))),
+    (u"%senderalias", lambda argSet: purple.PurpleBuddyGetAlias(getMessageBuddy(argSet))),
+    (u"%botname", lambda argSet: getAccountAlias(argSet[0])),
+    (u"%chattitle", lambda argSet: getChatName(argSet[3])),
     (u"%chatname", lambda argSet: purple.PurpleConversationGetName(argSet[3]))
 ]
-nicks = nicks or {}
-dtFormatStr = u"%a, %d %b %Y %H:%M:%S UTC"
+aliasVarFunctions = dict(aliasVars)
+# Matches any alias var, longest first. The group makes re.split keep the vars.
+aliasVarPattern = re.compile(u"({})".format(u"|".join(re.escape(name) for name in
+    sorted(aliasVarFunctions, key=len, reverse=True))))
+aliasVarValues = {}  # (alias var or "buddy", account, sender, conversation) -> its value, for the current message.
+aliasTemplates = {}  # What an alias stands for -> its AliasTemplate.
 dateFormatStr = u"%a, %b %m %Y at %I:%M%p"
-running = True
 exitCode = 0
 restartingBot = False
-messageQueue = []
-overflowThreshold = 3
+conversationQueues = {}  # Conversation ID -> deque of [argSet, whether it's been delayed] waiting to be handled.
+rateLimitBuckets = {}  # Conversation ID or (account, sender) -> [tokens, when the tokens were last refilled]
+pausedUntil = {}  # Conversation ID -> when messages from it will stop being dropped.
+lastRateLimitNotice = {}  # Conversation ID -> when it was last told it was sending too many messages.
+dispatchSource = None  # The GLib source which will run dispatchMessages, if there is one.
+dispatchDeadline = None  # When dispatchSource will run.
+conversationRate, conversationBurst = 3.0, 6  # How many messages per second each chat can send, and in a burst.
+senderRate, senderBurst = 1.0, 4  # How many messages per second each user can send, and in a burst.
+conversationQueueSize = 20  # How many messages from one chat can wait before rateLimitPolicy kicks in.
+rateLimitPolicy = u"dropoldest"  # What to do with a full queue: "dropoldest", "coalesce" or "pause".
+rateLimitPolicies = rateLimitPolicies or {}  # Chat title -> rateLimitPolicy for that chat.
+pauseSeconds = 30  # How long the "pause" policy stops handling a chat's messages for.
+outboundQueues = {}  # Conversation ID -> (sending, nick, message, callback) waiting to be sent to it.
+outboundSources = {}  # Conversation ID -> the GLib source which will send its queued messages.
+outboundBusy = set()  # Conversation IDs with messages being sent to them right now.
+relayedMessages = {}  # Conversation ID -> deque of (fingerprint, sending chat, time) for what was relayed to it.
+relayedCounts = {}  # Conversation ID -> {fingerprint -> [how many are in relayedMessages, when it was last relayed]}
+relayedBufferSize = 64  # How many relayed messages to remember per chat.
+relayedWindow = 15  # How many seconds a relayed message coming back counts as a loop.
+sendBatchWindow = 0.25  # How many seconds to wait for more messages to send along with one. 0 sends immediately.
+threadPool = None  # Runs commands which block, like yt. Created when first needed.
+backgroundThreads = 4
+backgroundJobs = {}  # Chat title -> jobs running for that chat, as dicts.
+backgroundLimitPerChat = 2  # How many commands from one chat can run in the background at once.
+maxDice, maxDiceSides = 1000, 1000000  # The biggest dice roll diceroll will do.
+ytExtractor = None  # The YoutubeDL used for every search. Created when first needed, and can be swapped out.
+ytExtractorLock = Lock()
+ytCachePath = u"ytCache.json"  # Where the YouTube search cache is saved. None keeps it in memory only.
+ytCache = OrderedDict((query, entry) for query, entry in (readFile(ytCachePath) or []))  # Search -> [time, result]
+ytCacheLock = Lock()
+ytCacheTTL = 7 * 24 * 60 * 60  # How many seconds a search result is good for.
+ytCacheSize = 1000  # How many search results to keep.
 runInTerminal = False
+dirtyFiles = {}  # File path -> value to write to it, for files which have changed since they were last written.
+flushSource = None  # The GLib source which will write dirtyFiles, if there is one.
+flushDelay = 5  # How many seconds after a file changes it gets written.
+eventHeap = []  # (when, order it was added in, event) for every scheduled event, soonest first.
+eventOrder = count()  # Breaks ties in eventHeap, so events themselves never get compared.
+cancelledEvents = set()  # IDs of events which were removed, but are still in eventHeap.
+eventSource = None  # The GLib source which will run the soonest event, if there is one.
+maxEventWait = 3600  # The longest the event timer waits at once, in seconds, in case the clock changes.
+catchUpPolicy = u"once"  # What recurring events missed while the bot was off do: "skip", run "once", or run "all".
+maxCatchUp = 10  # The most times the "all" policy runs an event to catch up.
+purple = None  # The libpurple backend, set by setBackend.
+mainloop = None
 libpurpleClient = u"pidgin -c $PWD/.purple"
 
 
+def getMessageBuddy(argSet):
+    """
+    Gets the buddy who sent a message, only asking libpurple once per message.
+
+    :param argSet: The set of values passed in to messageListener.
+    :type argSet: tuple
+    :return The: buddy's ID.
+    :rtype int:
+    """
+    key = (u"buddy", argSet[0], argSet[1], argSet[3])
+    if key not in aliasVarValues:
+        aliasVarValues[key] = purple.PurpleFindBuddy(argSet[0], argSet[1])
+    return aliasVarValues[key]
+
+
+def getAliasVar(argSet, name):
+    """
+    Gets the value of an alias var, only working it out once per message.
+
+    :param argSet: The set of values passed in to messageListener.
+    :type argSet: tuple
+    :param name: The alias var, such as "%botname".
+    :type name: string_types
+    :return The: value of the alias var, or the alias var itself if it can't be worked out.
+    :rtype string_types:
+    """
+    key = (name, argSet[0], argSet[1], argSet[3])
+    if key not in aliasVarValues:
+        try:
+            aliasVarValues[key] = aliasVarFunctions[name](argSet)
+        except:
+            aliasVarValues[key] = name
+    return aliasVarValues[key]
+
+
 def replaceAliasVars(argSet, message):
     """
-    Given the original message, replaces any alias vars (see above) with their proper values.
+    Given the original message, replaces any alias vars (see above) with their proper values. Only the alias vars in
+    the message are worked out.
 
     :param argSet: The set of values passed in to messageListener.
     :type argSet: tuple
@@ -310,13 +993,87 @@ def replaceAliasVars(argSet, message):
     :type message: string_types
     :return Themessage:, with all of the alias variables replaced.
     :rtype string_types:    """
-    newMsg = message  # Don't touch the original
-    for i in aliasVars:
-        try:
-            newMsg = newMsg.replace(i[0], i[1](argSet))
-        except:
-            pass
-    return newMsg
+    return aliasVarPattern.sub(lambda match: getAliasVar(argSet, match.group(1)), message)
+
+
+class AliasTemplate(object):
+    """
+    What an alias stands for, split up once into plain text and the alias vars it uses.
+    """
+
+    def __init__(self, text):
+        """
+        :param text: What the alias stands for, such as "echo Hi, %sendername!", without the command delimiter.
+        :type text: string_types
+        """
+        self.text = text
+        self.parts = aliasVarPattern.split(text)  # Plain text, with the alias vars at the odd indexes.
+        self.command = text.split(u" ", 1)[0].lower()  # The command the alias runs.
+
+    def render(self, argSet):
+        """
+        Fills in the alias vars for a message.
+
+        :param argSet: The set of values passed in to messageListener.
+        :type argSet: tuple
+        :return What: the alias stands for, with its alias vars replaced.
+        :rtype string_types:
+        """
+        if len(self.parts) == 1:
+            return self.text
+        return u"".join(getAliasVar(argSet, part) if i % 2 else part for i, part in enumerate(self.parts))
+
+
+def getAliasTemplate(text):
+    """
+    Gets the AliasTemplate for what an alias stands for, only making it once.
+
+    :param text: What the alias stands for.
+    :type text: string_types
+    :return The: template.
+    :rtype AliasTemplate:
+    """
+    if text not in aliasTemplates:
+        aliasTemplates[text] = AliasTemplate(text)
+    return aliasTemplates[text]
+
+
+def dropAliasTemplate(text):
+    """
+    Forgets the AliasTemplate for what an alias stood for, once no alias stands for it any more.
+
+    :param text: What the alias stood for.
+    :type text: string_types
+    """
+    if not any(text in chatAliases.values() for chatAliases in aliases.values()):
+        aliasTemplates.pop(text, None)
+
+
+def getAliasTable(chat):
+    """
+    Gets every alias which can be used in a chat, including the ones from the chats it's linked to. If two chats have
+    the same alias, the chat's own wins, then the first linked chat's. Only made again once an alias or link changes.
+
+    :param chat: The title of the chat.
+    :type chat: string_types
+    :return Alias: -> AliasTemplate.
+    :rtype dict:
+    """
+    if chat not in aliasTables:
+        table = {}
+        for aliasChat in reversed((chat,) + getLinkedChats(chat)):  # Earlier chats overwrite later ones.
+            for alias, text in aliases.get(aliasChat, {}).items():
+                table[alias] = getAliasTemplate(text)
+        aliasTables[chat] = table
+    return aliasTables[chat]
+
+
+def clearMessageMemos():
+    """
+    Forgets what was worked out for the last message, such as the times and alias vars in it.
+    """
+    parsedTimes.clear()
+    aliasVarValues.clear()
 
 
 def restartFinch(*_):
@@ -342,45 +1099,55 @@ def restartFinch(*_):
 
 def tellPun(argSet, chosenPun):
     """
-    Tells a pun, sending the beginning of it up until the last sentence, waiting three seconds, then sending the last sentence (the punchline)
+    Tells a pun, sending the beginning of it up until the last sentence, waiting three seconds, then sending the last
+    sentence (the punchline)
 
     :param argSet: The set of values passed in to messageListener.
-    :type argSet: tuple
+    :type argSet: ParsedCommand
     :param chosenPun: The pun to tell.
     :type chosenPun: string_types
     """
     lastSentenceIndex = max(map(chosenPun.rstrip(';:!?.').rfind, ';:!?.'))
-    print(lastSentenceIndex)
     if lastSentenceIndex != -1:
         simpleReply(argSet, chosenPun[:lastSentenceIndex + 1].rstrip())
-        argSet = [_ for _ in argSet]
-        argSet[2] = u"!schedule 3 seconds !echo {pun}".format(pun=chosenPun[lastSentenceIndex + 1:].lstrip())
-        scheduleEvent(tuple(argSet), True)
+        scheduleEvent(argSet.withMessage(u"{0}schedule 3 seconds {0}echo {1}".format(argSet.delimiter,
+            chosenPun[lastSentenceIndex + 1:].lstrip())), True)
     else:
         simpleReply(argSet, chosenPun)
 
 
-def pun(argSet, *punFilter):
+def getPunIndex(chat):
+    """
+    Gets the index of every pun usable in a chat: its own and the ones from the chats it's linked to. Made once, then
+    kept current by addPun and removePun until a link changes.
+
+    :param chat: The title of the chat.
+    :type chat: string_types
+    :return The: index.
+    :rtype PunIndex:
+    """
+    if chat not in punIndexes:
+        punIndexes[chat] = PunIndex((chat,) + getLinkedChats(chat), puns)
+    return punIndexes[chat]
+
+
+def pun(argSet, punFilter=u""):
     """
-    Gets a random pun, or a random pun that satisfies the provided filter.
+    Tells a random pun, or a random pun with every word in the provided filter.
 
     :param argSet: The set of values passed in to messageListener.
-    :type argSet: tuple
-    :param punFilter: A string filtering the puns out.
+    :type argSet: ParsedCommand
+    :param punFilter: The words the pun has to have.
     :type punFilter: string_types
-    :return A: random pun from puns.json.
-    :rtype string_types:    """
-    chats = [getChatName(argSet[3])]
-    chats += messageLinks[chats[0]]
-    combinedPuns = [pun for pun in [puns[chat] for chat in chats]]
-    if len(combinedPuns) == 0:
-        return u"No puns found!"
-    if not punFilter:
-        return combinedPuns[randint(0, len(combinedPuns) - 1)]
-    validPuns = list(filter(lambda pun: str(u" " + punFilter) in str(pun), combinedPuns))
-    chosenPun = (validPuns[randint(0, len(validPuns) - 1)]) if len(validPuns) > 0 else (
-            u"Does not punpute! Random Pun: " + combinedPuns[randint(0, len(puns) - 1)])
-    tellPun(argSet, chosenPun)
+    """
+    index = getPunIndex(getChatName(argSet[3]))
+    randomPun = index.choice()
+    if randomPun is None:
+        simpleReply(argSet, u"No puns found!")
+        return
+    chosenPun = index.choice(punFilter) if punFilter else randomPun
+    tellPun(argSet, chosenPun if chosenPun is not None else u"Does not punpute! Random Pun: " + randomPun)
+
 
 def Help(argSet, page=u"", *_):
     """
@@ -391,20 +1158,18 @@ def Help(argSet, page=u"", *_):
     :param page: The page number it should be on, as a string_types string.
     :type page: string_types
     """
-    iterableCommands = tuple(sorted(commands.keys()))  # A tuple containing all of the keys in iterableCommands.
-    commandsPerPage = 10  # How many commands to show per page.
-    cmd = page[len(commandDelimiter):] if page.startswith(commandDelimiter) else page
+    cmd = page[len(argSet.delimiter):] if page.startswith(argSet.delimiter) else page
     if cmd and cmd.lower() in helpText:  # If the help text for a given command was asked for
         simpleReply(argSet, helpText[cmd.lower()])
     elif not page or (page and page.isdigit()):  # If a page number was asked for
-        page = int(page) if page and page.isdigit() else 1
-        helpEntries = [
-            u"Help page {}/{}".format(int(min(page, int(ceil(1.0 * len(iterableCommands) / commandsPerPage)))),
-                int(ceil(1.0 * len(iterableCommands) / commandsPerPage)))]
-        for i in range(max(0, (page - 1) * commandsPerPage), min(page * commandsPerPage, len(iterableCommands))):
-            helpEntries.append(u"\n" + iterableCommands[i] + u": " + (
-                helpText[iterableCommands[i]] if iterableCommands[i] in helpText else u""))
-        simpleReply(argSet, u"".join(helpEntries))
+        pageCount = int(ceil(1.0 * len(sortedCommands) / commandsPerPage))
+        page = min(int(page) if page and page.isdigit() else 1, pageCount + 1)  # Every page past the end is empty.
+        if page not in helpPages:  # The commands never change, so each page is only made once.
+            helpEntries = [u"Help page {}/{}".format(min(page, pageCount), pageCount)]
+            for i in range(max(0, (page - 1) * commandsPerPage), min(page * commandsPerPage, len(sortedCommands))):
+                helpEntries.append(u"\n" + sortedCommands[i] + u": " + helpText.get(sortedCommands[i], u""))
+            helpPages[page] = u"".join(helpEntries)
+        simpleReply(argSet, helpPages[page])
     else:
         simpleReply(argSet, u"No command \"{}\" found.".format(page))
 
@@ -430,6 +1195,7 @@ def Link(argSet, chat, *chats):
     else:
         messageLinks[fullChatName] = fullChatNames
     updateFile(u"messageLinks.json", messageLinks)
+    compileRoutes()
     simpleReply(argSet, u"{} linked to {}.".format(u", ".join(str(i) for i in fullChatNames), fullChatName))
 
 
@@ -453,6 +1219,8 @@ def Unlink(argSet, chat, *chats):
         fullName = getFullConvName(i)
         if fullName == messageLinks[fullChatName]:
             messageLinks.pop(fullChatName)  # Remove the last message link from this chat.
+            updateFile(u"messageLinks.json", messageLinks)
+            compileRoutes()
             simpleReply(argSet, u"{} unlinked from {}.".format(fullName, fullChatName))
             return
         elif isListButNotString(messageLinks[fullChatName]) and fullName in messageLinks[fullChatName]:
@@ -460,6 +1228,7 @@ def Unlink(argSet, chat, *chats):
             if len(messageLinks[fullChatName]) == 0:
                 del messageLinks[fullChatName]
     updateFile(u"messageLinks.json", messageLinks)  # Update the messageLinks file.
+    compileRoutes()
     simpleReply(argSet, u"{} unlinked from {}.".format(u", ".join(removedChats), fullChatName))
 
 
@@ -473,9 +1242,10 @@ def addPun(argSet, pun):
     :type pun: string_types
     """
     chat = getChatName(argSet[3])
-    puns[chat] = puns[chat] if chat in puns else []
-    puns[chat].append(str(pun))
-    updateFile(u"Puns.json", puns)
+    stateStore.appendItem(u"puns", chat, str(pun))
+    for index in punIndexes.values():
+        if chat in index.chats:
+            index.add(str(pun))
     simpleReply(argSet, u"\"{}\" added to the pun list.".format(pun))
 
 
@@ -489,14 +1259,17 @@ def removePun(argSet, pun):
     :type pun: string_types
     """
     chat = getChatName(argSet[3])
-    puns[chat] = puns[chat] if chat in puns else []
-    fullPun = next((fullPun for fullPun in puns if str(pun) in puns[chat]), None)
-    if fullPun is None:
+    chatPuns = puns.get(chat, [])
+    # The exact pun if it's there, otherwise the first one containing it.
+    fullPun = str(pun) if str(pun) in chatPuns else next((fullPun for fullPun in chatPuns if str(pun) in fullPun), None)
+    if not pun or fullPun is None:
         simpleReply(argSet, u"No pun found containing \"{}\".".format(pun))
         return
-    puns[chat].remove(fullPun)
+    stateStore.removeItem(u"puns", chat, fullPun)
+    for index in punIndexes.values():
+        if chat in index.chats:
+            index.remove(fullPun)
     simpleReply(argSet, u"\"{}\" removed from the pun list.".format(fullPun))
-    updateFile(u"Puns.json", puns)
 
 
 def addAlias(argSet, *_):
@@ -507,34 +1280,37 @@ def addAlias(argSet, *_):
     :type argSet: tuple
     """
     chat = getChatName(argSet[3])
-    aliases[chat] = aliases[chat] if chat in aliases else {}
-    message = argSet[2][7:]
-    if message == u"":
+    delimiter = argSet.delimiter
+    if argSet.text == u"":
         return
-    command = (message[:message.find(u" ")] if u" " in message else message).lower()
-    command = command[len(commandDelimiter):] if command[:len(commandDelimiter)] == commandDelimiter else command
-    argsMsg = message[message.find(u" ") + 1 + len(commandDelimiter):]
-    if u" " not in message:  # If the user is asking for the command run by a specific alias.
-        for currentChat in (messageLinks[chat] if chat in messageLinks else [chat]):
-            if str(command) in aliases[currentChat]:  # If the alias asked for does not exist.
+    command = argSet.args[0].lower()
+    command = command[len(delimiter):] if command.startswith(delimiter) else command
+    argsMsg = argSet.rest(1)
+    argsMsg = argsMsg[len(delimiter):] if argsMsg.startswith(delimiter) else argsMsg
+    if len(argSet.args) == 1:  # If the user is asking for the command run by a specific alias.
+        for currentChat in (chat,) + getLinkedChats(chat):
+            if str(command) in aliases.get(currentChat, {}):  # If the alias asked for does not exist.
                 chat = currentChat
                 break
         else:
             simpleReply(argSet, u"No alias \"{}\" found.".format(str(command)))
             return
-        simpleReply(argSet, u'"' + commandDelimiter + aliases[chat][str(command)] + u'"')
+        simpleReply(argSet, u'"' + delimiter + aliases[chat][str(command)] + u'"')
         return
     if str(command) in commands:
         simpleReply(argSet, u"That name is already used by a command!")
         return
-    cmd = argsMsg[(len(commandDelimiter) if argsMsg.startswith(commandDelimiter) else 0):(
-            u" " in argsMsg and argsMsg.find(u" ") or len(argsMsg))]
+    cmd = argsMsg.split(u" ", 1)[0]
     if cmd not in commands:
-        simpleReply(argSet, u"{}{} is not a command!".format(commandDelimiter, cmd))
+        simpleReply(argSet, u"{}{} is not a command!".format(delimiter, cmd))
         return
-    aliases[chat][str(command)] = argsMsg
-    simpleReply(argSet, u"\"{}\" bound to \"{}\".".format(commandDelimiter + command, commandDelimiter + argsMsg))
-    updateFile(u"Aliases.json", aliases)
+    oldText = aliases.get(chat, {}).get(str(command))
+    stateStore.setItem(u"aliases", chat, str(command), argsMsg)
+    if oldText is not None:  # It was redefined.
+        dropAliasTemplate(oldText)
+    getAliasTemplate(argsMsg)  # Only split up once, now, instead of every time it's used.
+    invalidateAliases()
+    simpleReply(argSet, u"\"{}\" bound to \"{}\".".format(delimiter + command, delimiter + argsMsg))
 
 
 def removeAlias(argSet, alias=u"", *_):
@@ -547,19 +1323,35 @@ def removeAlias(argSet, alias=u"", *_):
     :type alias: string_types
     """
     chat = getChatName(argSet[3])
-    aliases[chat] = aliases[chat] if chat in aliases else {}
     if not alias:
         simpleReply(argSet, u"Enter an alias to remove!")
         return
-    if alias.startswith(commandDelimiter):
-        alias = alias[len(commandDelimiter):]
-    if alias in aliases[chat]:
-        aliases[chat].pop(alias)
+    if alias.startswith(argSet.delimiter):
+        alias = alias[len(argSet.delimiter):]
+    if alias in aliases.get(chat, {}):
+        oldText = aliases[chat][alias]
+        stateStore.deleteItem(u"aliases", chat, alias)
+        dropAliasTemplate(oldText)
+        invalidateAliases()
     else:
         simpleReply(argSet, u"No alias \"{}\" found.".format(alias))
         return
     simpleReply(argSet, u"\"{}\" unaliased.".format(alias))
-    updateFile(u"Aliases.json", aliases)
+
+
+def getUserChats(argSet):
+    """
+    Gets the chats whose users can be referred to from this chat: this one, then the ones it's linked to.
+
+    :param argSet: The set of values passed in to messageListener.
+    :type argSet: tuple
+    :return The: IDs of the chats.
+    :rtype list:
+    """
+    chats = [argSet[3]]
+    chats += [getConvByName(_chat) for _chat in getLinkedChats(getChatName(argSet[3]))
+              if getConvByName(_chat) is not None]
+    return chats
 
 
 def getFullUsername(argSet, partialName, nick=True):
@@ -578,38 +1370,15 @@ def getFullUsername(argSet, partialName, nick=True):
     chat = getChatName(argSet[3])
 
     # Special case the bot's name
-    botName = purple.PurpleAccountGetAlias(argSet[0])
+    botName = getAccountAlias(argSet[0])
     if botName.lower().startswith(partialName.lower()) or partialName.lower() in botName.lower():
         return botName if chat not in nicks or (u"" + botName) not in nicks[chat] or not nick else nicks[chat][
             u"" + botName]
 
-    chats = [argSet[3]]
-    # Get all of the chats provided by libpurple.
-    if chat in messageLinks and messageLinks[chat]:
-        chats += [_chat for _chat in getChats() if getChatName(_chat) in messageLinks[chat]]
-
-    usersByChat = {}
-    # Get all of the users from the chats we have.
-    users = list(chain([purple.PurpleConvChatGetUsers(purple.PurpleConvChat(int(chat)))] for chat in chats))
-    for i in range(len(users)):
-        usersByChat[chats[i]] = users[i][0]
-    # Convert the users in all chats into buddies and collect them together.
-    buddies = {}
-    for userChat, users in usersByChat.items():
-        buddies[userChat] = []
-        for i in range(len(users)):
-            buddies[userChat].append(purple.PurpleConvChatCbGetName(users[i]))
-    # Convert the buddies into the names of those buddies.
-    names = []
-    for userChat, chatBuddies in buddies.items():
-        for buddy in chatBuddies:
-            names.append(getNameFromArgs(argSet[0], buddy, userChat))
-
-    rng = range(len(names))
     # Check if they match, then the beginning, then check if the partial name is somewhere in the name.
-    name = (next((names[i] for i in rng if names[i].lower() == partialName.lower()), None) or
-            next((names[i] for i in rng if names[i].lower().startswith(partialName.lower())), None) or
-            next((names[i] for i in rng if partialName.lower() in names[i].lower()), None))
+    matches = [match for match in (getRoster(userChat).find(partialName) for userChat in getUserChats(argSet))
+               if match is not None]
+    name = min(matches, key=lambda match: match[0])[1] if matches else None  # Earlier chats win ties.
     if nick and name is not None and chat in nicks and (u"" + name) in nicks[chat]:
         return nicks[chat][u"" + name]
     return name
@@ -634,15 +1403,12 @@ def Mimic(argSet, user=None, firstWordOfCmd=None, *_):
     if fullUser is None:
         simpleReply(argSet, u"No user by the name \"{}\" found.".format(user))
         return
-    elif fullUser == purple.PurpleAccountGetAlias(argSet[0]):  # If mimic is attempted on the bot
+    elif fullUser == getAccountAlias(argSet[0]):  # If mimic is attempted on the bot
         simpleReply(argSet, u"You can't use mimic on me! I'm invincible!")
         return
 
-    # The command, after the user argument.
-    cmd = argSet[2][6 + len(commandDelimiter):][argSet[2][6 + len(commandDelimiter):].find(u" ") + 1:].lower()
-
-    if not runCommand((argSet[0], fullUser, cmd, argSet[3], argSet[4]), cmd.split(u" ")[0][len(commandDelimiter):],
-            *cmd.split(u" ")[len(commandDelimiter):]):
+    cmd = argSet.rest(1)  # The command, after the user argument.
+    if not cmd.startswith(argSet.delimiter) or not runCommand(argSet.withMessage(cmd, fullUser)):
         simpleReply(argSet, u"That's not a command!")
 
 
@@ -653,15 +1419,10 @@ def loc(argSet, *_):
     :param argSet: The set of values passed in to messageListener.
     :type argSet: tuple
     """
-    findSpace = argSet[2].find(u" ")
-    time = False
-    location = None
-    if findSpace is not None:
-        findSpace2 = argSet[2].find(u" ", findSpace + 1)
-        location = argSet[2][findSpace + 1:findSpace2] if \
-            len(argSet[2]) > len(commandDelimiter) + 4 and argSet[2].count(u" ") > 1 else None
-        time = argSet[2][findSpace2 + 1:]
-    Loc(argSet, time=time or argSet[2], location=location)
+    if argSet.args:
+        Loc(argSet, location=argSet.args[0], time=argSet.rest(1))
+    else:
+        Loc(argSet)
 
 
 def Loc(argSet, location=u"GDS", time=defaultLocTime):
@@ -677,18 +1438,16 @@ def Loc(argSet, location=u"GDS", time=defaultLocTime):
     """
     chat = getChatName(argSet[3])
     time = time if len(time) != 0 else defaultLocTime
-    atLoc[chat] = atLoc[chat] if chat in atLoc else {}
     # Update the time
     name = getNameFromArgs(argSet[0], argSet[1], argSet[3])
-    atLoc[chat][name] = [now(), location, time]
+    stateStore.setItem(u"atLoc", chat, name, [now(), location, time])
     if u"in " in time or u"at " in time:
         newArgset = list(argSet)
-        newArgset[2] = u"{0}schedule {1} {0}loc {2} {3}".format(commandDelimiter, time, location, defaultLocTime)
+        newArgset[2] = u"{0}schedule {1} {0}loc {2} {3}".format(argSet.delimiter, time, location, defaultLocTime)
         messageListener(*newArgset)
         return
 
     simpleReply(argSet, u"{} is going to {} for {}.".format(getNameFromArgs(*argSet[:2]), location, time))
-    updateFile(u"atLoc.json", atLoc)
 
 
 def leftLoc(argSet, *_):
@@ -703,10 +1462,9 @@ def leftLoc(argSet, *_):
     name = getNameFromArgs(*argSet[:2])
     if name in atLoc[chat]:
         thisLoc = atLoc[chat][name]
-        thisLoc[0] = datetime(1901, 1, 1, 1, 1, 1, 1)
+        stateStore.setItem(u"atLoc", chat, name, [datetime(1901, 1, 1, 1, 1, 1, 1)] + thisLoc[1:])
         simpleReply(argSet,
             u"{} left {}.".format(name, thisLoc[1]))
-        updateFile(u"atLoc.json", atLoc)
     else:
         simpleReply(argSet, u"{} isn't anywhere!".format(name))
 
@@ -753,7 +1511,7 @@ def AtLoc(argSet, *_):
         except:
             return timedelta(minutes=defaultLocMinutes)
 
-    location = argSet[2][len(commandDelimiter) + 6:] if u" " in argSet[2] else u"anywhere"
+    location = argSet.text or u"anywhere"
     chat = getChatName(argSet[3])
     atLoc[chat] = atLoc[chat] if chat in atLoc else {}
 
@@ -773,28 +1531,42 @@ def AtLoc(argSet, *_):
 
 def scheduleEvent(argSet, quiet=False, *_):
     """
-    Schedules the given command to run at the given time.
+    Schedules the given command to run at the given time, or on a recurring schedule (see schedules.parseRecurrence).
 
     :param argSet: The set of values passed in to messageListener.
     :type argSet: tuple
     :param quiet: Whether or not a message should be sent.
     :type quiet: boolean
     """
-    msg = argSet[2][len(commandDelimiter) + 9:]
-    if commandDelimiter in msg:
-        timeStr = msg[:msg.find(commandDelimiter) - 1]
-        cmdStr = msg[msg.find(commandDelimiter):]
+    msg, delimiter = argSet.text, argSet.delimiter
+    if delimiter in msg:
+        timeStr = msg[:msg.find(delimiter) - 1]
+        cmdStr = msg[msg.find(delimiter):]
     else:
-        simpleReply(argSet, u"You need a command to run, with the command delimiter \"{}\"".format(commandDelimiter))
+        simpleReply(argSet, u"You need a command to run, with the command delimiter \"{}\"".format(delimiter))
         return
     newArgset = list(argSet)
     newArgset[2] = cmdStr
-    newArgset[0] = purple.PurpleAccountGetUsername(argSet[0])
-    scheduledEvents.append((getTime(timeStr), newArgset))
-    updateFile(u"scheduledEvents.json", scheduledEvents)
-    if not quiet:
-        simpleReply(argSet, u"\"{}\" scheduled to run {}.".format(cmdStr, naturalTime(getTime(timeStr))))
-
+    newArgset[0] = getAccountUsername(argSet[0])
+    timeStr, catchUp = splitCatchUp(timeStr)
+    try:
+        recurrence = parseRecurrence(timeStr)
+        # Recurring events also keep their schedule, and only ever have their next time stored.
+        eventTime = recurrence.next(now()) if recurrence is not None else None  # Some schedules never come up.
+    except ValueError as e:
+        simpleReply(argSet, u"" + str(e))
+        return
+    if recurrence is None:
+        eventTime = getTime(timeStr)
+        addEvent([eventTime, newArgset])
+        if not quiet:
+            simpleReply(argSet, u"\"{}\" scheduled to run {}.".format(cmdStr, naturalTime(eventTime)))
+        return
+    addEvent([eventTime, newArgset, {u"every": timeStr.strip(), u"catchUp": catchUp or catchUpPolicy}])
+    if not quiet:
+        simpleReply(argSet, u"\"{}\" scheduled to run {}, starting {}.".format(cmdStr, timeStr.strip(),
+            naturalTime(eventTime)))
+
 
 def getEvents(argSet, *_):
     """
@@ -803,18 +1575,33 @@ def getEvents(argSet, *_):
     :param argSet: The set of values passed in to messageListener.
     :type argSet: tuple
     """
-    eventStrs = [u"[{}] {}: {} ({})".format(
-        scheduledEvents.index(event),
-        naturalTime(datetime.strptime(event[0], dtFormatStr) if type(event[0]) != datetime else event[0]),
-        event[1][2],
-        (datetime.strptime(event[0], dtFormatStr) if type(event[0]) != datetime else event[0]).strftime(dateFormatStr))
-        for event in scheduledEvents if getNameFromArgs(argSet[0], *event[1][1:2]) == getNameFromArgs(*argSet[0:2])]
+    eventStrs = [describeEvent(index, event) for index, event in enumerate(scheduledEvents)
+        if getNameFromArgs(argSet[0], *event[1][1:2]) == getNameFromArgs(*argSet[0:2])]
     if len(list(eventStrs)) == 0:
         simpleReply(argSet, u"You don't have any events scheduled!")
     else:
         simpleReply(argSet, u"\n".join(eventStrs))
 
 
+def describeEvent(index, event):
+    """
+    Describes a scheduled event for the events and allevents commands.
+
+    :param index: The index of the event, for unschedule.
+    :type index: int
+    :param event: The event.
+    :type event: list
+    :return The: description of the event.
+    :rtype string_types:
+    """
+    eventTime = getEventTime(event)
+    description = u"[{}] {}: {} ({})".format(index, naturalTime(eventTime), event[1][2],
+        eventTime.strftime(dateFormatStr))
+    if len(event) > 2:
+        description += u", repeating {}".format(event[2][u"every"])
+    return description
+
+
 def getAllEvents(argSet, *_):
     """
     Replies with all of the scheduled events.
@@ -822,10 +1609,7 @@ def getAllEvents(argSet, *_):
     :param argSet: The set of values passed in to messageListener.
     :type argSet: tuple
     """
-    eventStrs = [u"[{}] {}: {} ({})".format(scheduledEvents.index(event),
-        naturalTime(datetime.strptime(event[0], dtFormatStr) if type(event[0]) != datetime else event[0]), event[1][2],
-        (datetime.strptime(event[0], dtFormatStr) if type(event[0]) != datetime else event[0]).strftime(dateFormatStr))
-        for event in scheduledEvents]
+    eventStrs = [describeEvent(index, event) for index, event in enumerate(scheduledEvents)]
     if len(list(eventStrs)) == 0:
         simpleReply(argSet, u"No events have been scheduled.")
     else:
@@ -843,7 +1627,7 @@ def removeEvent(argSet, index, *_):
     """
     index = int(index)
     if getNameFromArgs(argSet[0], *scheduledEvents[index][1][1:2]) == getNameFromArgs(*argSet[:2]):
-        scheduledEvents.pop(index)
+        cancelEvent(scheduledEvents[index])
         simpleReply(argSet, u"Event at index {} removed.".format(index))
     else:
         simpleReply(argSet, u"You don't have an event scheduled with that index!")
@@ -861,11 +1645,9 @@ def setNick(argSet, user, *nick):
     chat = getChatName(argSet[3])
     nick = u" ".join(nick)
     if fullName is not None:
-        if chat not in nicks:
-            nicks[chat] = {}
-        nicks[chat][fullName] = nick
+        stateStore.setItem(u"nicks", chat, fullName, nick)
+        invalidateNames(chat)
         simpleReply(argSet, u"{}'s nickname set to \"{}\".".format(fullName, nick))
-        updateFile(u"nicks.json", nicks)
     else:
         simpleReply(argSet, u"No user by the name {} found.".format(user))
 
@@ -879,11 +1661,9 @@ def removeNick(argSet, user):
     """
     fullName = getFullUsername(argSet, user)
     chat = getChatName(argSet[3])
-    if chat not in nicks:
-        nicks[chat] = {}
-    nicks[chat].pop(fullName)
+    stateStore.deleteItem(u"nicks", chat, fullName)
+    invalidateNames(chat)
     simpleReply(argSet, u"{}'s nickname removed.".format(fullName))
-    updateFile(u"nicks.json", nicks)
 
 
 def getNicks(argSet):
@@ -899,32 +1679,15 @@ def getNicks(argSet):
     simpleReply(argSet, u"\n".join(u"{}: {}".format(str(k), str(v)) for k, v in nicks[chat].items()))
 
 
-dice = [u"0⃣", u"1⃣", u"2⃣", u"3⃣", u"4⃣", u"5⃣", u"6⃣", u"7⃣", u"8⃣", u"9⃣️⃣️"]  # 1-9 in emoji form
-
-
-def numToEmoji(s):
-    """
-    Replaces numbers with emojis.
-
-    :param s: The string to replace the numbers of with emojis.
-    :type s: string_types
-    :return: The provided string with its numbers replaced with emojis.
-    :rtype string_types:
-    """
-    for i in range(len(dice)):
-        s = s.replace(u"" + str(i), dice[i])  # Force string_types strings for Python 2 and Python 3.
-    return s
-
-
 def exitProcess(code):
     """
     Exits like sys.exit, killing any other processes run by this one.
 
     :param code: the exit code.
     """
-    global running, exitCode
-    running = False  # Go away, GLib.timeout.
-    mainloop.quit()  # Go away, GObject.
+    global exitCode
+    if mainloop is not None:
+        mainloop.quit()  # Go away, GObject.
     exitCode = code
 
 
@@ -950,9 +1713,10 @@ def diceRoll(argSet, diceStr=u"", *_):
         numDice, numSides = int(diceStr[:diceStr.lower().find(u"d")]), int(diceStr[diceStr.lower().find(u"d") + 1:])
     elif diceStr.isdigit():
         numDice = int(diceStr)
-    rolls = [randint(1, numSides) for _ in range(numDice)]  # Roll the dice
-    simpleReply(argSet, numToEmoji(u"".join(str(s) + u" " for s in rolls) + u"\nSum={}\nMax={}\nMin={}".format(
-        sum(rolls), max(rolls), min(rolls))))
+    if not 1 <= numDice <= maxDice or not 1 <= numSides <= maxDiceSides:
+        simpleReply(argSet, u"You can roll 1 to {} dice with 1 to {} sides.".format(maxDice, maxDiceSides))
+        return
+    runInBackground(argSet, u"diceroll", rollDice, (numDice, numSides), 10, True)
 
 
 def to(argSet, *args):
@@ -969,9 +1733,7 @@ def to(argSet, *args):
     name = getFullUsername(argSet, user, False)
     nick = getFullUsername(argSet, user) or name
     if name is not None:
-        msg = argSet[2]
-        simpleReply(argSet,
-            replaceAliasVars(argSet, msg[len(commandDelimiter) + 3:msg.rfind(u" ")]).replace(u"%target", nick))
+        simpleReply(argSet, replaceAliasVars(argSet, u" ".join(args[:-1])).replace(u"%target", nick))
     else:
         simpleReply(argSet, u"No user containing {} found.".format(user))
 
@@ -998,19 +1760,234 @@ def findNthInstance(n, haystack, needle):
     return 0
 
 
+def normalizeYTQuery(query):
+    """
+    Normalizes a YouTube search so searches differing only in case or spacing share a cache entry.
+
+    :param query: The search term.
+    :type query: string_types
+    :return The: normalized search term.
+    :rtype string_types:
+    """
+    return u" ".join(query.lower().split())
+
+
+def getCachedYTURL(query):
+    """
+    Gets the result of a YouTube search from the cache, if it was searched for recently.
+
+    :param query: The search term.
+    :type query: string_types
+    :return The: cached result, or None if there is none.
+    :rtype string_types:
+    """
+    query = normalizeYTQuery(query)
+    with ytCacheLock:
+        if query not in ytCache:
+            return None
+        if currentTime() - ytCache[query][0] > ytCacheTTL:
+            del ytCache[query]
+            return None
+        ytCache[query] = ytCache.pop(query)  # Move it to the end, since it was just used.
+        return ytCache[query][1]
+
+
 def getYTURL(queryMsg):
     """
-    Gets the URL of the first YouTube video when searching for queryMsg.
+    Gets the URL of the first YouTube video when searching for queryMsg, using the cache if possible. Blocks while
+    searching, so it runs on the thread pool.
 
     :type queryMsg: string_types
     :param queryMsg: The search term to use to find the video.
     :rtype string_types:
     :return The: URL of the YouTube video, as a string.
     """
-    dl = ydl()
-    with dl:
-        info = dl.extract_info(u"ytsearch1:" + queryMsg, download=False)[u"entries"][0]
-        return u"{1} - https://youtube.com/watch?v={0}".format(info[u"id"], info[u"title"])
+    global ytExtractor
+    result = getCachedYTURL(queryMsg)
+    if result is not None:
+        return result
+    with ytExtractorLock:  # YoutubeDL isn't thread-safe, so searches take turns.
+        ytExtractor = ytExtractor or ydl({u"quiet": True, u"noplaylist": True})
+        info = ytExtractor.extract_info(u"ytsearch1:" + queryMsg, download=False)[u"entries"][0]
+    result = u"{1} - https://youtube.com/watch?v={0}".format(info[u"id"], info[u"title"])
+    with ytCacheLock:
+        ytCache[normalizeYTQuery(queryMsg)] = [currentTime(), result]
+        while len(ytCache) > ytCacheSize:
+            ytCache.popitem(last=False)  # Throw out whatever was used longest ago.
+    if ytCachePath is not None:
+        GLib.idle_add(saveYTCache)  # Files are written from the main loop.
+    return result
+
+
+def saveYTCache():
+    """
+    Writes the YouTube search cache to ytCachePath, so it lasts across restarts.
+
+    :return False:, so the GLib source only runs once.
+    :rtype bool:
+    """
+    with ytCacheLock:
+        entries = list(ytCache.items())
+    updateFile(ytCachePath, entries)
+    return False
+
+
+def youtubeSearch(argSet, *_):
+    """
+    Replies with the first YouTube video found when searching for the message. Answers from the cache right away if
+    possible, otherwise searches on the thread pool.
+
+    :param argSet: The set of values passed in to messageListener.
+    :type argSet: tuple
+    """
+    query = argSet.text
+    if not query.strip():
+        simpleReply(argSet, u"You need to say what to search for!")
+        return
+    result = getCachedYTURL(query)
+    if result is not None:
+        simpleReply(argSet, result)
+    else:
+        runInBackground(argSet, u"yt", getYTURL, (query,), 30)
+
+
+def searchMessages(argSet, *_):
+    """
+    Replies with the messages in this chat which best match the search. Ending the search with "#2" gets the second
+    page of results, and so on.
+
+    :param argSet: The set of values passed in to messageListener.
+    :type argSet: tuple
+    """
+    words = argSet.text.split()
+    page = 1
+    if len(words) > 1 and re.match(u"^#\\d+$", words[-1]):
+        page, words = max(int(words[-1][1:]), 1), words[:-1]
+    if not words:
+        simpleReply(argSet, u"You need to say what to search for!")
+        return
+    if page > maxSearchPage:  # Too far to be worth looking, and huge pages don't fit in an SQLite integer.
+        simpleReply(argSet, u"No more messages found.")
+        return
+    runInBackground(argSet, u"search", findMessages, (getChatName(argSet[3]), u" ".join(words), page,
+        argSet.delimiter), 10)
+
+
+def findMessages(chat, query, page, delimiter):
+    """
+    Searches the message index and formats the results. Runs on the thread pool.
+
+    :param chat: The title of the chat to search.
+    :type chat: string_types
+    :param query: What to search for.
+    :type query: string_types
+    :param page: Which page of results to get, starting at 1.
+    :type page: int
+    :param delimiter: The chat's command delimiter, for telling it how to get the next page.
+    :type delimiter: string_types
+    :return The: reply to the search.
+    :rtype string_types:
+    """
+    results, more = messageIndex.search(chat, query, page)
+    if not results:
+        return u"No messages found." if page == 1 else u"No more messages found."
+    reply = u"\n".join(u"[{}] {}: {}".format(time[:16].replace(u"T", u" "), sender, snippet)
+        for time, sender, snippet in results)
+    if more:
+        reply += u"\nSay {}search {} #{} for more.".format(delimiter, query, page + 1)
+    return reply
+
+
+def runInBackground(argSet, name, function, args, timeout, cpuBound=False):
+    """
+    Runs a command's work on the thread pool (or the process pool, for CPU-heavy work) so the main loop keeps going,
+    then replies with the result from the main loop. Jobs still running after timeout seconds are given up on, but
+    still count towards the chat's limit until they actually finish, since they're still using up a worker.
+
+    :param argSet: The set of values passed in to messageListener.
+    :type argSet: tuple
+    :param name: The name of the command, for messages to the chat.
+    :type name: string_types
+    :param function: The function doing the work. Its return value is the reply. It can't touch libpurple.
+    :type function: function
+    :param args: The arguments to function.
+    :type args: tuple
+    :param timeout: How many seconds the job gets to run.
+    :type timeout: int
+    :param cpuBound: Whether the job should run on the process pool instead of the thread pool.
+    :type cpuBound: bool
+    """
+    global threadPool
+    jobs = backgroundJobs.setdefault(getChatName(argSet[3]), [])
+    if len(jobs) >= backgroundLimitPerChat:
+        simpleReply(argSet, u"Too many commands are running in this chat already! Try again in a bit, or use {}cancel."
+            .format(argSet.delimiter))
+        return
+    if cpuBound:
+        future = processPool.submit(function, *args)
+    else:
+        threadPool = threadPool or ThreadPoolExecutor(backgroundThreads)
+        future = threadPool.submit(function, *args)
+    job = {u"argSet": argSet, u"name": name, u"future": future, u"jobs": jobs, u"abandoned": False}
+    jobs.append(job)
+    job[u"timeoutSource"] = GLib.timeout_add_seconds(timeout, _timeOutJob, job)
+    future.add_done_callback(lambda _: GLib.idle_add(_finishJob, job))  # Get back onto the main loop to reply.
+
+
+def _finishJob(job):
+    """
+    Frees a background job's slot once it's finished, and replies with its result, unless it was cancelled or timed
+    out. Runs on the main loop.
+
+    :param job: The job, from runInBackground.
+    :type job: dict
+    :return False:, so the GLib source only runs once.
+    :rtype bool:
+    """
+    job[u"jobs"].remove(job)
+    if job[u"abandoned"]:  # It was cancelled or timed out, and the chat's already been told.
+        return False
+    GLib.source_remove(job[u"timeoutSource"])
+    try:
+        simpleReply(job[u"argSet"], job[u"future"].result())
+    except:
+        simpleReply(job[u"argSet"], u"Command errored! Error message: \"{}\"".format(traceback.format_exc()))
+    return False
+
+
+def _timeOutJob(job):
+    """
+    Gives up on a background job which took too long.
+
+    :param job: The job, from runInBackground.
+    :type job: dict
+    :return False:, so the GLib source only runs once.
+    :rtype bool:
+    """
+    if not job[u"abandoned"]:
+        job[u"abandoned"] = True
+        job[u"future"].cancel()  # A job which already started can't be stopped, but its result will be ignored.
+        simpleReply(job[u"argSet"], u"{}{} took too long, so it was cancelled.".format(job[u"argSet"].delimiter,
+            job[u"name"]))
+    return False
+
+
+def cancelJobs(argSet):
+    """
+    Cancels the sender's background jobs in this chat.
+
+    :param argSet: The set of values passed in to messageListener.
+    :type argSet: tuple
+    :return How: many jobs were cancelled.
+    :rtype int:
+    """
+    jobs = backgroundJobs.get(getChatName(argSet[3]), [])
+    cancelled = [job for job in jobs if job[u"argSet"][1] == argSet[1] and not job[u"abandoned"]]
+    for job in cancelled:  # Each job keeps its slot until it's actually finished, then _finishJob frees it.
+        job[u"abandoned"] = True
+        GLib.source_remove(job[u"timeoutSource"])
+        job[u"future"].cancel()
+    return len(cancelled)
 
 
 def listUsers(argSet, *_):
@@ -1020,84 +1997,68 @@ def listUsers(argSet, *_):
     :param argSet: The set of values passed in to messageListener.
     :type argSet: tuple
     """
-    chat = getChatName(argSet[3])
-    chats = [argSet[3]]
-
-    # Get all of the chats provided by libpurple.
-    if chat in messageLinks and messageLinks[chat]:
-        chats += [_chat for _chat in getChats() if getChatName(_chat) in messageLinks[chat]]
-
-    usersByChat = {}
-    # Get all of the users from the chats we have.
-    users = list(chain([purple.PurpleConvChatGetUsers(purple.PurpleConvChat(int(chat)))] for chat in chats))
-    for i in range(len(users)):
-        usersByChat[chats[i]] = users[i][0]
-
-    # Convert the users in all chats into buddies and collect them together.
-    buddies = {}
-    for userChat, users in usersByChat.items():
-        buddies[userChat] = []
-        for i in range(len(users)):
-            buddies[userChat].append(purple.PurpleConvChatCbGetName(users[i]))
-
-    # Convert the buddies into the names of those buddies.
-    names = []
-    for userChat, chatBuddies in buddies.items():
-        for buddy in chatBuddies:
-            names.append(getNameFromArgs(argSet[0], buddy, userChat))
+    names = list(chain.from_iterable(getRoster(userChat).getNames() for userChat in getUserChats(argSet)))
     simpleReply(argSet, str(sorted(names)))
 
 
 commands = {  # A dict containing the functions to run when a given command is entered.
-    u"addpun":       lambda argSet, *_: addPun(argSet, argSet[2][7 + len(commandDelimiter):]),
+    u"addpun":       lambda argSet, *_: addPun(argSet, argSet.text),
     u"alias":        addAlias,
     u"aliases":      lambda argSet, *_: simpleReply(argSet, getAliases(argSet)),
     u"allevents":    getAllEvents,
     u"args":         lambda argSet, *_: simpleReply(argSet, u"" + str(argSet)),
     u"atloc":        AtLoc,
+    u"cancel":       lambda argSet, *_: simpleReply(argSet, u"{} command(s) cancelled.".format(cancelJobs(argSet))),
     u"botme":        lambda argSet, *_: simpleReply(argSet,
-        u"*{} {}.".format(purple.PurpleAccountGetAlias(argSet[0]), argSet[2][6 + len(commandDelimiter):])),
+        u"*{} {}.".format(getAccountAlias(argSet[0]), argSet.text)),
     u"chats":        lambda argSet, *_: simpleReply(argSet,
-        u", ".join([u"{} ({})".format(purple.PurpleConversationGetTitle(conv), conv) for conv in getChats()])),
+        u", ".join([u"{} ({})".format(getChatName(conv), conv) for conv in getChats()])),
     u"commands":     lambda argSet, *_: simpleReply(argSet, getCommands(argSet)),
     u"diceroll":     diceRoll,
-    u"echo":         lambda argSet, *_: simpleReply(argSet, argSet[2][5 + len(commandDelimiter):]),
+    u"echo":         lambda argSet, *_: simpleReply(argSet, argSet.text),
     u"events":       getEvents,
     u"exit":         lambda *_: exitProcess(37),
-    u"gds":          lambda argSet, *_: Loc(argSet, time=argSet[2][len(commandDelimiter) + 4:]),
+    u"gds":          lambda argSet, *_: Loc(argSet, time=argSet.text),
     u"help":         Help,
-    u"htmlescape":   lambda argSet, *_: simpleReply(argSet, purple.PurpleMarkupStripHtml(argSet[2][11:])),
-    u"htmlunescape": lambda argSet, *_: simpleReply(argSet, purple.PurpleUnescapeHtml(argSet[2][13:])),
+    u"htmlescape":   lambda argSet, *_: simpleReply(argSet, purple.PurpleMarkupStripHtml(argSet.text)),
+    u"htmlunescape": lambda argSet, *_: simpleReply(argSet, purple.PurpleUnescapeHtml(argSet.text)),
     u"lastreboot":   lambda argSet, *_: simpleReply(argSet,
         u"{}, ({})".format(naturalTime(startTime), startTime.strftime("%a, %b %m %Y at %I:%M%p"))),
     u"leftloc":      leftLoc,
     u"link":         lambda argSet, *args: Link(argSet, *args),
     u"links":        lambda argSet, *_: simpleReply(argSet, u"" + str(messageLinks)),
     u"loc":          loc,
-    u"loconly":      lambda argSet, *_: Loc(argSet, location=argSet[2][len(commandDelimiter) + 8:]),
+    u"loconly":      lambda argSet, *_: Loc(argSet, location=argSet.text),
     u"me":           lambda argSet, *_: simpleReply(argSet, replaceAliasVars(argSet,
-        u"*{} {}.".format(getNameFromArgs(argSet[0], argSet[1], argSet[3]), argSet[2][3 + len(commandDelimiter):]))),
+        u"*{} {}.".format(getNameFromArgs(argSet[0], argSet[1], argSet[3]), argSet.text))),
     u"mimic":        Mimic,
     u"msg":          lambda argSet, msg="", *_: sendMessage(argSet[-2], getConvFromPartialName(msg), u"",
-        getNameFromArgs(*argSet[:2]) + ": " + argSet[2][
-        argSet[2][4 + len(commandDelimiter):].find(u" ") + 5 + len(commandDelimiter):]),
+        getNameFromArgs(*argSet[:2]) + ": " + argSet.rest(1)),
     u"nicks":        getNicks,
     u"ping":         lambda argSet, *_: simpleReply(argSet, u"Pong!"),
-    u"pun":          lambda argSet, _pun=u"", *_: pun(argSet, _pun),
+    u"pun":          lambda argSet, *_: pun(argSet, argSet.text),
     u"removenick":   removeNick,
-    u"removepun":    lambda argSet, *_: removePun(argSet, argSet[2][10 + len(commandDelimiter):]),
-    u"replace":      lambda argSet, start, end, *_: simpleReply(argSet, re.compile(re.escape(start), re.IGNORECASE).sub(
-        end, argSet[2][findNthInstance(3, argSet[2], u" ") + 1:])),
+    u"removepun":    lambda argSet, *_: removePun(argSet, argSet.text),
+    u"replace":      lambda argSet, start, end, *_: runInBackground(argSet, u"replace", replaceText,
+        (start, end, argSet.rest(2)), 10, True),
     u"restart":      lambda argSet, *_: restartBot(argSet),
     u"schedule":     scheduleEvent,
+    u"search":       searchMessages,
     u"setnick":      setNick,
+    u"stats":        lambda argSet, *_: simpleReply(argSet,
+        u"\n".join(u"{}: {}".format(k, v) for k, v in sorted(dict(botStats, logLinesDropped=messageLog.dropped,
+            messagesNotIndexed=messageIndex.dropped).items()))),
     u"to":           to,
     u"unalias":      removeAlias,
     u"unlink":       lambda argSet, *args: Unlink(argSet, *args),
     u"unschedule":   removeEvent,
     u"users":        listUsers,
-    u"yt":           lambda argSet, *_: simpleReply(argSet, getYTURL(argSet[2])),
+    u"yt":           youtubeSearch,
 }
+sortedCommands = tuple(sorted(commands))
+commandListing = None  # The commands, formatted for the commands command.
+commandsPerPage = 10  # How many commands to show per help page.
+helpPages = {}  # Page number -> that help page.
 helpText = {  # The help text for each command.
     u"addpun":     u"Adds a pun to the list of random puns.",
     u"alias":      u"Links a name to a command, or prints out the command run by an alias.",
@@ -1108,6 +2069,7 @@ helpText = {  # The help text for each command.
     u"atloc":      u"Replies with who's said they're somewhere within the last hour and where they are.",
     u"botme":      u"Replies \"*(bot's name) (message)\", e.g. \"*NickBot DeLello died.\"",
     u"chats":      u"Lists all chats the bot knows of by name and ID.",
+    u"cancel":     u"Cancels any of your commands which are still running in this chat.",
     u"commands":   u"Lists all of the commands.",
     u"diceroll":   u"Rolls the specified number of dice, returning the min, max, and sum of the rolls. 1d6 by default.",
     u"echo":       u"Repeats the message said.",
@@ -1126,13 +2088,17 @@ helpText = {  # The help text for each command.
     u"msg":        u"Sends a message to the specified chat. Matches incomplete names.",
     u"nicks":      u"Lists the nicknames of all users in the chat. If they don't have one, their name will not show up!",
     u"ping":       u"Replies \"Pong!\". Useful for checking if the bot is working.",
-    u"pun":        u"Replies with a random pun.",
+    u"pun":        u"Replies with a random pun. Add words to only get puns with all of them.",
     u"removenick": u"Removes a user's nickname.",
     u"removepun":  u"Removes a pun from the list of puns.",
     u"replace":    u"Replaces the text in the last argument(s) using the first and second.",
     u"restart":    u"Restarts the bot.",
-    u"schedule":   u"Runs a command after the specified amount of time.",
+    u"schedule":   u"Runs a command after the specified amount of time, or repeatedly, e.g. \"every weekday at 9am\", "
+                   u"\"every 2 hours\" or \"cron 0 9 * * 1-5\". Add \"catch up skip/once/all\" to choose what happens "
+                   u"to repeats missed while the bot was off.",
+    u"search":     u"Searches this chat's history. End the search with #2 for the second page of results, and so on.",
     u"setnick":    u"Changes the nickname of the specified user.",
+    u"stats":      u"Lists the bot's internal counters, such as cache hits and misses.",
     u"to":         u"Sends a message with the provided person as a 'target'. Mainly used for aliases.",
     u"unalias":    u"Unlinks a name from a command.",
     u"unlink":     u"Unlinks the second and further chats from the first chat.",
@@ -1142,53 +2108,264 @@ helpText = {  # The help text for each command.
 }
 
 
-def runCommand(argSet, command, *args):
+class ParsedCommand(tuple):
+    """
+    A message which is a command, split up once so commands don't each have to. It's still the argSet tuple
+    (account, sender, message, conversation, flags), so it works anywhere an argSet does.
     """
-    Runs the command given the argSet and the command it's trying to run.
+
+    def __new__(cls, argSet, delimiter):
+        """
+        :param argSet: The set of values passed in to messageListener. The message has to start with delimiter.
+        :type argSet: tuple
+        :param delimiter: The command delimiter for the chat the message was sent in.
+        :type delimiter: string_types
+        """
+        self = tuple.__new__(cls, argSet)
+        words = argSet[2][len(delimiter):].split(u" ")
+        self.delimiter = delimiter
+        self.command = words[0].lower()  # The name of the command, without the delimiter.
+        self.args = tuple(words[1:])  # The words after the command.
+        self.text = u" ".join(self.args)  # Everything after the command.
+        return self
+
+    def rest(self, n):
+        """
+        Gets everything after the first n arguments.
+
+        :param n: How many arguments to skip.
+        :type n: int
+        :return Everything: after the first n arguments.
+        :rtype string_types:
+        """
+        return u" ".join(self.args[n:])
+
+    def withMessage(self, message, sender=None):
+        """
+        Parses another command in the same chat, such as the one an alias stands for.
+
+        :param message: The new command, starting with the delimiter.
+        :type message: string_types
+        :param sender: Who the new command is from, if it's not from the same person.
+        :type sender: string_types
+        :return The: new command.
+        :rtype ParsedCommand:
+        """
+        return ParsedCommand((self[0], sender or self[1], message, self[3], self[4]), self.delimiter)
+
+
+def getCommandDelimiter(conversation):
+    """
+    Gets what commands start with in a chat: its entry in commandDelimiters, or commandDelimiter if it has none.
+
+    :param conversation: The ID of the chat.
+    :type conversation: int
+    :return The: chat's command delimiter.
+    :rtype string_types:
+    """
+    return commandDelimiters.get(getChatName(conversation), commandDelimiter)
+
+
+def parseCommand(argSet):
+    """
+    Splits up a message if it's a command in the chat it was sent in.
 
     :param argSet: The set of values passed in to messageListener.
     :type argSet: tuple
+    :return The: command, or None if the message isn't one.
+    :rtype ParsedCommand:
+    """
+    delimiter = getCommandDelimiter(argSet[3])
+    return ParsedCommand(argSet, delimiter) if argSet[2].startswith(delimiter) else None
+
+
+def runCommand(command):
+    """
+    Runs a command, or the command an alias stands for.
+
     :param command: The command to run.
-    :type command: string_types
+    :type command: ParsedCommand
     :return If: the given command could be run, either as a command or an alias.
     :rtype bool:
     """
-    command = (command or argSet[2][:argSet[2].find(u" ")]).lower()
-    chat = getChatName(argSet[3])
-    global commandDelimiter
-    oldCommandDelimiter = commandDelimiter
-    commandDelimiter = commandDelimiters[chat] if chat in commandDelimiters else commandDelimiter
-    aliases[chat] = aliases[chat] if chat in aliases else {}
-    if command in commands:
-        commands[command](argSet, *args)
+    if command.command in commands:
+        commands[command.command](command, *command.args)
         return True
-    else:
-        cmd = aliases[chat][command] if command in aliases[chat] else None
-        convTitle = purple.PurpleConversationGetTitle(argSet[3])
-        if convTitle in messageLinks:
-            if isListButNotString(messageLinks[convTitle]):
-                for conv in messageLinks[convTitle]:
-                    if conv in aliases and command in aliases[conv]:
-                        cmd = aliases[conv][command]
-                        break
+    template = getAliasTable(getChatName(command[3])).get(command.command)
+    if template is None or template.command not in commands:
+        return False
+    # Swap the alias for the command it stands for, keeping any extra arguments at the end.
+    aliased = command.withMessage(command.delimiter + template.render(command) +
+        (u" " + replaceAliasVars(command, command.text) if command.args else u""))
+    commands[aliased.command](aliased, *aliased.args)  # Run the alias's command
+    return True
+
+
+class MessageFormatter(object):
+    """
+    Formats messages in one protocol's markup dialect, splitting them up if they're too long for that protocol.
+    """
+
+    def __init__(self, boldOpeningChar, boldClosingChar, lineBreak, maxLength=None):
+        """
+        :param boldOpeningChar: What to put before bold text.
+        :type boldOpeningChar: string_types
+        :param boldClosingChar: What to put after bold text.
+        :type boldClosingChar: string_types
+        :param lineBreak: What to replace newlines with.
+        :type lineBreak: string_types
+        :param maxLength: The longest message the protocol accepts, or None if there is no limit.
+        :type maxLength: int
+        """
+        self.nickFormat = boldOpeningChar + u"{}" + boldClosingChar + u": "
+        self.commandNickFormat = u"_" + self.nickFormat
+        self.lineBreak = lineBreak
+        self.maxLength = maxLength
+
+    def formatNick(self, nick):
+        """
+        Returns what goes before a message sent on behalf of nick.
+
+        :param nick: The nickname of the user who sent the message, or an empty string if there is none.
+        :type nick: string_types
+        :return The: formatted nick, or an empty string if there is no nick.
+        :rtype string_types:
+        """
+        if not nick:
+            return u""
+        return (self.commandNickFormat if nick[:len(commandDelimiter)] == commandDelimiter else
+                self.nickFormat).format(nick)
+
+    def format(self, nick, message):
+        """
+        Formats a message, splitting it into as many chunks as the protocol's length limit needs.
+
+        :param nick: The nickname of the user who sent the message, or an empty string if there is none.
+        :type nick: string_types
+        :param message: The message to format.
+        :type message: string_types
+        :return The: formatted chunks, in the order they should be sent.
+        :rtype list:
+        """
+        prefix = self.formatNick(nick)
+        if self.maxLength is None or len(prefix) + len(message) + message.count(u"\n") * len(
+                self.lineBreak) <= self.maxLength:
+            return [prefix + message.replace(u"\n", self.lineBreak)]
+        budget = max(self.maxLength - len(prefix), 1)
+        chunks = []
+        currentLines = []
+        currentLength = 0
+        for line in message.split(u"\n"):
+            while len(line) > budget:  # Lines which can't fit in one chunk on their own get split up by words.
+                if currentLines:
+                    chunks.append(self.lineBreak.join(currentLines))
+                    currentLines, currentLength = [], 0
+                cut = _findCut(line, budget)
+                chunks.append(line[:cut].rstrip())
+                line = line[cut:].lstrip()
+            addedLength = len(line) + (len(self.lineBreak) if currentLines else 0)
+            if currentLines and currentLength + addedLength > budget:
+                chunks.append(self.lineBreak.join(currentLines))
+                currentLines, currentLength = [], 0
+                addedLength = len(line)
+            currentLines.append(line)
+            currentLength += addedLength
+        if currentLines:
+            chunks.append(self.lineBreak.join(currentLines))
+        return [prefix + chunk for chunk in chunks]
+
+    def pack(self, chunks):
+        """
+        Joins formatted chunks into as few messages as the protocol's length limit allows, keeping their order.
+
+        :param chunks: The formatted chunks, from format.
+        :type chunks: list
+        :return The: messages to send, in order.
+        :rtype list:
+        """
+        packed = []
+        for chunk in chunks:
+            if packed and (self.maxLength is None or
+                           len(packed[-1]) + len(self.lineBreak) + len(chunk) <= self.maxLength):
+                packed[-1] += self.lineBreak + chunk
             else:
-                if messageLinks[convTitle] in aliases and command in aliases[messageLinks[convTitle]]:
-                    cmd = aliases[messageLinks[convTitle]][command]
-        if cmd is not None:
-            message = argSet[2]
-            msgLow = message.lower()
-            command = message[len(commandDelimiter):message.find(u" ") if u" " in message else len(message)].lower()
-            # Swap the command for the right one
-            message = message[:msgLow.find(command)] + command + message[msgLow.find(command) + len(command):]
-            newMsg = replaceAliasVars(argSet, message.replace(command, cmd, 1))
-            # Get the extra arguments to the function and append them at the end.
-            extraArgs = newMsg.split(u" ")[1:]
-            commands[cmd.split(u" ", 1)[0]]((argSet[0], argSet[1], newMsg, argSet[3], argSet[4]),
-                *extraArgs)  # Run the alias's command
-            commandDelimiter = oldCommandDelimiter
-            return True
-    commandDelimiter = oldCommandDelimiter
-    return False
+                packed.append(chunk)
+        return packed
+
+
+def _findCut(line, limit):
+    """
+    Finds where to split a line that's too long, preferring spaces and never splitting an HTML tag or entity.
+
+    :param line: The line to split.
+    :type line: string_types
+    :param limit: The most characters that can go before the split.
+    :type limit: int
+    :return The: index to split the line at.
+    :rtype int:
+    """
+    cut = line.rfind(u" ", 0, limit + 1)
+    cut = cut if cut > 0 else limit
+    for opening, closing in ((u"<", u">"), (u"&", u";")):
+        lastOpening = line.rfind(opening, 0, cut)
+        if lastOpening > 0 and line.rfind(closing, lastOpening, cut) == -1 and closing in line[cut:cut + 10]:
+            cut = lastOpening
+    return cut
+
+
+markupDialects = {  # The formatter to use for each markup dialect.
+    u"html":     lambda maxLength: MessageFormatter(u"<b>", u"</b>", u"<br>", maxLength),
+    u"facebook": lambda maxLength: MessageFormatter(u"*", u"*", u"<br>", maxLength),
+    u"markdown": lambda maxLength: MessageFormatter(u"**", u"**", u"<br>", maxLength),
+    u"plain":    lambda maxLength: MessageFormatter(u"", u"", u"\n", maxLength)  # For protocols showing markup as-is.
+}
+protocolFormats = {  # Lowercase protocol name -> (markup dialect, maximum message length). Anything else is HTML.
+    u"facebook": (u"facebook", 20000),
+    u"discord":  (u"markdown", 2000),
+    u"telegram": (u"html", 4096),
+    u"irc":      (u"html", 400),
+    u"slack":    (u"html", 4000),
+    u"hangouts": (u"html", 4000)
+}
+accountFormatters = {}  # Account ID -> MessageFormatter
+
+
+def getFormatter(account):
+    """
+    Gets the formatter for an account, looking the account's protocol up the first time it's used.
+
+    :param account: The account ID.
+    :type account: int
+    :return The: formatter for messages sent on the account.
+    :rtype MessageFormatter:
+    """
+    if account not in accountFormatters:
+        dialect, maxLength = protocolFormats.get(purple.PurpleAccountGetProtocolName(account).lower(), (u"html", None))
+        accountFormatters[account] = markupDialects[dialect](maxLength)
+    return accountFormatters[account]
+
+
+def logSent(sending, receiving, nick, message, conv):
+    """
+    Logs that a message was sent from one chat to another.
+
+    :param sending: The id of the sending chat.
+    :type sending: int
+    :param receiving: The id of the receiving chat.
+    :type receiving: int
+    :param nick: The nickname of the user, for logging purposes
+    :type nick: string_types
+    :param message: The message which was sent out.
+    :type message: string_types
+    :param conv: The PurpleConvChat or PurpleConvIm the message was sent on.
+    :type conv: int
+    """
+    # I could put this behind debug, but I choose not to. It's pretty enough.
+    try:  # Logging errors should not break things.
+        log(u"[{}] Sent \"{}\" from {} ({}) to {} ({}).".format(now().isoformat(),
+            (nick + u": " + message if nick else message), getChatName(sending), sending, getChatName(receiving), conv))
+    except UnicodeError:
+        pass
 
 
 def sendMessage(sending, receiving, nick, message):
@@ -1207,31 +2384,229 @@ def sendMessage(sending, receiving, nick, message):
     if receiving is None:  # If the conversation can't be found by libpurple, it'll just error anyway.
         return
 
-    protocol = purple.PurpleAccountGetProtocolName(purple.PurpleConversationGetAccount(receiving))
-    boldOpeningChar = u"*" if protocol.lower() == u"facebook" else u"<b>"
-    boldClosingChar = u"*" if protocol.lower() == u"facebook" else u"</b>"
+    account, _, convType = getConvInfo(receiving)
 
     # Actually send the messages out.
-    if purple.PurpleConversationGetType(receiving) == 2:  # 2 means a group chat.
+    if convType == PURPLE_CONV_TYPE_CHAT:
         conv = purple.PurpleConvChat(receiving)
-        purple.PurpleConvChatSend(conv, ((u"_" + boldOpeningChar if nick[:len(
-            commandDelimiter)] == commandDelimiter else boldOpeningChar) + nick + boldClosingChar + u": " if nick else u"") + message.replace(
-            u"\n", u"<br>"))
+        for chunk in getFormatter(account).format(nick, message):
+            purple.PurpleConvChatSend(conv, chunk)
     else:
         conv = purple.PurpleConvIm(receiving)
-        purple.PurpleConvImSend(conv, ((u"_" + boldOpeningChar if nick[:len(
-            commandDelimiter)] == commandDelimiter else boldOpeningChar) + nick + boldClosingChar + u": " if nick else u"") + message.replace(
-            u"\n", u"<br>"))
+        for chunk in getFormatter(account).format(nick, message):
+            purple.PurpleConvImSend(conv, chunk)
+    logSent(sending, receiving, nick, message, conv)
+
+
+def sendMessageAsync(sending, receiving, nick, message, callback):
+    """
+    Sends a message on the given chat without blocking on any of the DBus calls involved.
+
+    :param sending: The id of the sending chat.
+    :type sending: int
+    :param receiving: The id of the receiving chat.
+    :type receiving: int
+    :param nick: The nickname of the user, for logging purposes
+    :type nick: string_types
+    :param message: The message to send out.
+    :type message: string_types
+    :param callback: Called with the receiving chat and the error (or None) once the message is sent.
+    :type callback: function
+    """
+    if receiving is None:
+        callback(receiving, u"Conversation not found.")
+        return
+
+    def onSent(conv, error):
+        if error is None:
+            logSent(sending, receiving, nick, message, conv)
+        callback(receiving, error)
+
+    sendChunksAsync(receiving, getFormatter(getConvInfo(receiving)[0]).format(nick, message), onSent)
+
+
+def sendChunksAsync(receiving, chunks, callback):
+    """
+    Sends already formatted chunks on the given chat one at a time, so they can't arrive out of order.
+
+    :param receiving: The id of the receiving chat.
+    :type receiving: int
+    :param chunks: The formatted chunks to send.
+    :type chunks: list
+    :param callback: Called with the PurpleConvChat/PurpleConvIm and the error (or None) once every chunk is sent.
+    :type callback: function
+    """
+    isChat = getConvInfo(receiving)[2] == PURPLE_CONV_TYPE_CHAT
+    chunks = list(chunks)
+
+    def sendChunk(conv, error):
+        if error is not None:
+            callback(conv, error)
+        elif chunks:
+            botStats[u"outboundSends"] += 1
+            purple.callAsync(u"PurpleConvChatSend" if isChat else u"PurpleConvImSend", u"(is)", (conv, chunks.pop(0)),
+                lambda _, sendError: sendChunk(conv, sendError))
+        else:
+            callback(conv, None)
+
+    purple.callAsync(u"PurpleConvChat" if isChat else u"PurpleConvIm", u"(i)", (receiving,), sendChunk)
+
+
+def queueOutbound(sending, receiving, nick, message, callback):
+    """
+    Queues a message to be sent on the given chat along with anything else sent to it within sendBatchWindow.
+
+    :param sending: The id of the sending chat.
+    :type sending: int
+    :param receiving: The id of the receiving chat.
+    :type receiving: int
+    :param nick: The nickname of the user, for logging purposes
+    :type nick: string_types
+    :param message: The message to send out.
+    :type message: string_types
+    :param callback: Called with the receiving chat and the error (or None) once the message is sent.
+    :type callback: function
+    """
+    botStats[u"outboundMessages"] += 1
+    outboundQueues.setdefault(receiving, []).append((sending, nick, message, callback))
+    if receiving not in outboundSources and receiving not in outboundBusy:
+        outboundSources[receiving] = GLib.timeout_add(int(sendBatchWindow * 1000), flushOutbound, receiving)
+
+
+def flushOutbound(receiving):
+    """
+    Sends everything queued for the given chat as few messages as its protocol allows.
+
+    :param receiving: The id of the receiving chat.
+    :type receiving: int
+    :return False:, so the GLib source only runs once.
+    :rtype bool:
+    """
+    outboundSources.pop(receiving, None)
+    batch = outboundQueues.pop(receiving, [])
+    if not batch:
+        return False
+    formatter = getFormatter(getConvInfo(receiving)[0])
+    chunks = [chunk for sending, nick, message, _ in batch for chunk in formatter.format(nick, message)]
+    outboundBusy.add(receiving)  # Anything queued while this batch is sending waits for the next one, to keep order.
+
+    def onSent(conv, error):
+        outboundBusy.discard(receiving)
+        for sending, nick, message, callback in batch:
+            if error is None:
+                logSent(sending, receiving, nick, message, conv)
+            callback(receiving, error)
+        if receiving in outboundQueues and receiving not in outboundSources:
+            outboundSources[receiving] = GLib.timeout_add(int(sendBatchWindow * 1000), flushOutbound, receiving)
+
+    sendChunksAsync(receiving, formatter.pack(chunks), onSent)
+    return False
 
-    # I could put this behind debug, but I choose not to. It's pretty enough.
-    sendTitle = purple.PurpleConversationGetTitle(sending)
-    receiveTitle = purple.PurpleConversationGetTitle(receiving)
-    try:  # Logging errors should not break things.
-        log(u"[{}] Sent \"{}\" from {} ({}) to {} ({}).".format(now().isoformat(),
-            (nick + u": " + message if nick else message), sendTitle, sending, receiveTitle, conv))
-        logFile.flush()  # Update the log since it's been written to.
-    except UnicodeError:
-        pass
+
+htmlTagPattern = re.compile(u"<[^>]*>")
+
+
+def fingerprintMessage(message):
+    """
+    Fingerprints a message, ignoring the differences protocols make to messages, like markup, case and spacing.
+
+    :param message: The message.
+    :type message: string_types
+    :return The: message's fingerprint.
+    :rtype int:
+    """
+    # Spacing is dropped entirely, since removing markup like "<b>nick</b>: " leaves a space before the colon.
+    return hash(u"".join(htmlTagPattern.sub(u" ", message).lower().split()))
+
+
+def rememberRelayed(sending, receiving, nick, message):
+    """
+    Remembers that a message was relayed to a chat, so it isn't relayed again if it comes back. Only the exact form the
+    bot sends is remembered, so people in the chat can still say the same thing. Replies to the chat a message came
+    from aren't relayed, so they aren't remembered.
+
+    :param sending: The id of the sending chat.
+    :type sending: int
+    :param receiving: The id of the receiving chat.
+    :type receiving: int
+    :param nick: The nickname of the user who sent the message, or an empty string if there is none.
+    :type nick: string_types
+    :param message: The message.
+    :type message: string_types
+    """
+    if receiving == sending:
+        return
+    relayed = relayedMessages.setdefault(receiving, deque())
+    counts = relayedCounts.setdefault(receiving, {})
+    fingerprint = fingerprintMessage(nick + u": " + message if nick else message)
+    if len(relayed) >= relayedBufferSize:  # Forget the oldest fingerprint to make room.
+        oldest = relayed.popleft()[0]
+        counts[oldest][0] -= 1
+        if counts[oldest][0] == 0:
+            del counts[oldest]
+    relayed.append((fingerprint, sending, currentTime()))
+    counts.setdefault(fingerprint, [0, 0])
+    counts[fingerprint][0] += 1
+    counts[fingerprint][1] = currentTime()
+
+
+def wasRelayed(conversation, message):
+    """
+    Checks if a message received in a chat is something the bot relayed to it recently, exactly as the bot sent it
+    (with the nick in front), possibly with another bridge's name in front of that.
+
+    :param conversation: The ID of the conversation the message was received in.
+    :type conversation: int
+    :param message: The message.
+    :type message: string_types
+    :return If: the bot relayed the message to the chat within relayedWindow seconds.
+    :rtype bool:
+    """
+    counts = relayedCounts.get(conversation)
+    if not counts:
+        return False
+    fingerprints = [fingerprintMessage(message)]
+    if u": " in message:  # Another bridge might have put its own name in front of what the bot sent.
+        fingerprints.append(fingerprintMessage(message[message.find(u": ") + 2:]))
+    return any(fingerprint in counts and currentTime() - counts[fingerprint][1] <= relayedWindow
+               for fingerprint in fingerprints)
+
+
+def sendMessages(sending, receivingChats, nick, message, callback=None):
+    """
+    Sends a message to several chats at once. The sends overlap, so this takes as long as the slowest chat.
+
+    :param sending: The id of the sending chat.
+    :type sending: int
+    :param receivingChats: The ids of the receiving chats.
+    :type receivingChats: list
+    :param nick: The nickname of the user, for logging purposes
+    :type nick: string_types
+    :param message: The message to send out.
+    :type message: string_types
+    :param callback: Called with a list of (receiving chat, succeeded, error) once every send has finished.
+    :type callback: function
+    """
+    receivingChats = list(receivingChats)
+    results = []
+    for receiving in receivingChats:
+        rememberRelayed(sending, receiving, nick, message)
+
+    def onSent(receiving, error):
+        results.append((receiving, error is None, error))
+        if len(results) < len(receivingChats):
+            return
+        for failed in (result for result in results if not result[1]):
+            log(u"[{}] Failed to send \"{}\" from {} ({}) to {}: {}".format(now().isoformat(), message,
+                getChatName(sending), sending, failed[0], failed[2]))
+        if callback is not None:
+            callback(results)
+
+    for receiving in receivingChats:
+        if sendBatchWindow > 0 and receiving is not None:
+            queueOutbound(sending, receiving, nick, message, onSent)
+        else:
+            sendMessageAsync(sending, receiving, nick, message, onSent)
 
 
 def messageListener(account, sender, message, conversation, flags):
@@ -1249,19 +2624,13 @@ def messageListener(account, sender, message, conversation, flags):
     :param flags: Any flags for this message, such as the type of message.
     :type flags: tuple
     """
-    global lastMessageTime, lastMessage
+    global lastMessageTime
 
     # Deal with Python 2 and 3 compatibility
     try:
         message = u"" + message.decode(encoding=u"utf-8", errors=u"ignore")
     except:
         message = u"" + message
-    try:
-        lastMessage[conversation] = u"" + (
-                conversation in lastMessage and lastMessage[conversation].decode(encoding=u"utf-8",
-            errors=u"ignore") or u"")
-    except:
-        lastMessage[conversation] = u"" + (conversation in lastMessage and lastMessage[conversation] or u"")
     argSet = (account, sender, message, conversation, flags)
     lastMessageTime = now()
 
@@ -1270,16 +2639,17 @@ def messageListener(account, sender, message, conversation, flags):
     # Logs messages. Logging errors will not prevent commands from working.
     try:
         log(u"[{}] {}: {}\n".format(now().isoformat(), nick, (u"" + str(message))))
-        logFile.flush()
     except UnicodeError:
         pass
-    # Run commands if the message starts with the command character.
-    if message[:len(commandDelimiter)] == commandDelimiter:
-        command = message[len(commandDelimiter):message.find(u" ") if u" " in message else len(message)].lower()
-        args = message.split(u" ")[1:]
+    if wasRelayed(conversation, message):  # Makes sure the messages don't loop infinitely.
+        botStats[u"loopsSuppressed"] += 1
+        return
+    # Run commands if the message starts with the chat's command delimiter.
+    command = parseCommand(argSet)
+    if command is not None:
         try:
-            if not runCommand(argSet, command.lower(), *args):
-                simpleReply(argSet, u"Command/alias \"{}\" not found. {}".format(command, getCommands(argSet)))
+            if not runCommand(command):
+                commandNotFound(command)
         except SystemExit:  # This isn't an error, so it's okay.
             exitProcess(SIGQUIT)
             return
@@ -1290,56 +2660,162 @@ def messageListener(account, sender, message, conversation, flags):
             simpleReply(argSet, u"Command errored! Error message: \"{}\"".format(traceback.format_exc()))
 
     # Send messages to connected chats.
-    try:
-        if message == lastMessage:  # Makes sure the messages don't loop infinitely.
-            return
-    except:
-        pass
-    title = purple.PurpleConversationGetTitle(conversation)
-    if title in messageLinks:  # Gets conversations by their title, so they work across libpurple reboots.
-        if isListButNotString(messageLinks[title]):
-            for receiving in messageLinks[title]:  # It can send to multiple chats.
-                receiving = getConvByName(receiving)
-                sendMessage(conversation, receiving, nick, message)
-        else:
-            receiving = getConvByName(messageLinks[title])
-            sendMessage(conversation, receiving, nick, message)
-    lastMessage = nick + u": " + message  # Remember the last message to prevent infinite looping.
+    # Gets conversations by their title, so they work across libpurple reboots. It can send to multiple chats at once.
+    linked = getLinkedChats(getChatName(conversation))
+    if command is None:  # Index the message everywhere it's seen.
+        text = htmlTagPattern.sub(u"", message)
+        for chat in chain((getChatName(conversation),), linked):
+            messageIndex.add(chat, nick, text, lastMessageTime)
+    if linked:
+        sendMessages(conversation, [getConvByName(receiving) for receiving in linked], nick, message)
+
+
+def getEventTime(event):
+    """
+    Gets when an event is due. Events loaded from a file have it as a string, which is parsed the first time and kept
+    on the event, so it's never parsed again.
+
+    :param event: The event, as [when, argSet].
+    :type event: list
+    :return When: the event is due.
+    :rtype datetime:
+    """
+    if isinstance(event[0], string_types):  # If it's reading it from the serialized version...
+        event[0] = datetime.strptime(event[0], dtFormatStr)  # Convert it back to a datetime
+    return event[0]
+
+
+def addEvent(event):
+    """
+    Schedules an event, saving it and waking up when it's due.
+
+    :param event: The event, as [when, argSet].
+    :type event: list
+    """
+    try:  # The conversation ID changes every session, so the event's kept under its chat's title too.
+        chat = getChatName(event[1][3])
+    except:  # The conversation's gone, so the chat can't be known.
+        chat = None
+    stateStore.addEvent(event, chat)
+    heappush(eventHeap, (getEventTime(event), next(eventOrder), event))
+    if eventHeap[0][2] is event:  # It's the soonest event now, so wake up for it instead.
+        armEventTimer()
+
+
+def cancelEvent(event):
+    """
+    Unschedules an event. It's left in eventHeap, and skipped when it comes up.
+
+    :param event: The event, which has to be the one in scheduledEvents.
+    :type event: list
+    """
+    stateStore.removeEvent(event)
+    cancelledEvents.add(id(event))
+    if eventHeap and eventHeap[0][2] is event:
+        armEventTimer()
+
+
+def buildEventHeap():
+    """
+    Puts every event in scheduledEvents into eventHeap, then waits for the soonest one.
+    """
+    global eventHeap
+    cancelledEvents.clear()
+    eventHeap = [(getEventTime(event), next(eventOrder), event) for event in scheduledEvents]
+    heapify(eventHeap)
+    armEventTimer()
+
+
+def armEventTimer():
+    """
+    Sets up a GLib timeout for when the soonest event is due, replacing the one there was.
+    """
+    global eventSource
+    if eventSource is not None:
+        GLib.source_remove(eventSource)
+        eventSource = None
+    while eventHeap and id(eventHeap[0][2]) in cancelledEvents:  # Don't wake up for an event that's gone.
+        cancelledEvents.discard(id(heappop(eventHeap)[2]))
+    if eventHeap:
+        wait = min(max((eventHeap[0][0] - now()).total_seconds(), 0), maxEventWait)
+        eventSource = GLib.timeout_add(int(ceil(wait * 1000)), processEvents)
 
 
 def processEvents(threshold=timedelta(seconds=2)):
     """
-    Processes any events that are in the eventQueue.
+    Runs every event which is due, then waits for the next one. Run by the GLib timeout from armEventTimer.
 
     :param threshold: How long after the event is supposed to run until it's discarded.
     :type threshold: timedelta
-    :return: True
+    :return: False, since armEventTimer sets up a new timeout.
     :rtype bool:
     """
-    eventRemoved = False
-    for event in scheduledEvents:
-        if isinstance(event[0], string_types):  # If it's reading it from the serialized version...
-            eventTime = datetime.strptime(event[0], dtFormatStr)  # Convert it back to a datetime
-        else:
-            eventTime = event[0]
-        if timedelta() < now() - eventTime:  # If the event is due to be scheduled...
-            if now() - eventTime < min(threshold, timedelta(seconds=5)):  # Make sure the event was supposed to be run
-                # less than 5 seconds before now, otherwise, don't run the function, but still discard of it.
-                try:
-                    accounts = purple.PurpleAccountsGetAll()
-                    newArgset = event[1]
-                    newArgset[0] = next((i for i in accounts if purple.PurpleAccountGetUsername(i) == newArgset[0]),
-                        None)
-                    if newArgset[0] is None:
-                        raise Exception(u"Account not found.")
-                    messageListener(*newArgset)
-                except:
-                    pass
-            scheduledEvents.remove(event)  # Discard the event
-            eventRemoved = True
-    if eventRemoved:  # If any events were removed, update the file.
-        updateFile(u"scheduledEvents.json", scheduledEvents)
-    return True
+    global eventSource
+    eventSource = None  # This timeout is finishing, so armEventTimer shouldn't remove it.
+    threshold = min(threshold, timedelta(seconds=5))
+    while eventHeap and eventHeap[0][0] <= now():
+        eventTime, _, event = heappop(eventHeap)
+        if id(event) in cancelledEvents:
+            cancelledEvents.discard(id(event))
+            continue
+        stateStore.removeEvent(event)  # Discard the event
+        if len(event) > 2:  # Recurring events get scheduled again, and catch up on any times they were missed.
+            recurrence = parseRecurrence(event[2][u"every"])
+            runs = countEventRuns(event, eventTime, recurrence, threshold)
+            addEvent([recurrence.next(now(), eventTime), event[1], event[2]])
+        else:  # Make sure the event was supposed to be run less than 5 seconds before now, otherwise, don't run the
+            # function, but still discard of it.
+            runs = 1 if now() - eventTime < threshold else 0
+        for _ in range(runs):
+            runEvent(event)
+    armEventTimer()
+    return False
+
+
+def countEventRuns(event, eventTime, recurrence, threshold):
+    """
+    Works out how many times a recurring event should run, going by its catch-up rule if it was missed.
+
+    :param event: The event.
+    :type event: list
+    :param eventTime: When the event was due.
+    :type eventTime: datetime
+    :param recurrence: The event's schedule.
+    :type recurrence: CronSchedule or IntervalSchedule
+    :param threshold: How late an event can be and still count as on time.
+    :type threshold: timedelta
+    :return How: many times to run the event.
+    :rtype int:
+    """
+    rightNow = now()
+    catchUp = event[2].get(u"catchUp", catchUpPolicy)
+    if catchUp == u"skip":  # Only run if it's due right now.
+        return int(rightNow - eventTime < threshold or recurrence.next(rightNow - threshold, eventTime) <= rightNow)
+    if catchUp == u"all":
+        runs, missedTime = 1, recurrence.next(eventTime, eventTime)
+        while runs < maxCatchUp and missedTime <= rightNow:
+            runs, missedTime = runs + 1, recurrence.next(missedTime, missedTime)
+        return runs
+    return 1
+
+
+def runEvent(event):
+    """
+    Runs a scheduled event's command as whoever scheduled it.
+
+    :param event: The event.
+    :type event: list
+    """
+    clearMessageMemos()  # Times and alias vars are worked out once per message.
+    try:
+        accounts = purple.PurpleAccountsGetAll()
+        newArgset = list(event[1])
+        newArgset[0] = next((i for i in accounts if purple.PurpleAccountGetUsername(i) == newArgset[0]), None)
+        if newArgset[0] is None:
+            raise Exception(u"Account not found.")
+        messageListener(*newArgset)
+    except:
+        pass
 
 
 def queueMessage(account, sender, message, conversation, flags):
@@ -1358,45 +2834,175 @@ def queueMessage(account, sender, message, conversation, flags):
     :type flags: tuple
     """
     argSet = (account, sender, message, conversation, flags)
-    possibleNames = (purple.PurpleAccountGetAlias(account),
-    purple.PurpleAccountGetAlias(account),
-    getNameFromArgs(account, sender, conversation),
-    purple.PurpleAccountGetUsername(account))
+    possibleNames = (getAccountAlias(account), getNameFromArgs(account, sender, conversation),
+    getAccountUsername(account))
     if sender in possibleNames:
         return
-    messageQueue.append(argSet)
+    if pausedUntil.get(conversation, 0) > currentTime():
+        botStats[u"messagesDropped"] += 1
+        return
+    queue = conversationQueues.setdefault(conversation, deque())
+    if len(queue) >= conversationQueueSize:
+        policy = rateLimitPolicies.get(getChatName(conversation), rateLimitPolicy)
+        if policy == u"coalesce":
+            # Fold the message into the last one from the same person, so nothing they said is lost.
+            queued = next((queued for queued in reversed(queue) if queued[0][1] == sender), None)
+            if queued is not None:
+                queued[0] = queued[0][:2] + (queued[0][2] + u"\n" + message,) + queued[0][3:]
+                botStats[u"messagesCoalesced"] += 1
+                return
+        elif policy == u"pause":
+            botStats[u"messagesDropped"] += len(queue) + 1
+            queue.clear()
+            pausedUntil[conversation] = currentTime() + pauseSeconds
+            rateLimitNotice(conversation, u"Too many messages! Ignoring this chat for {} seconds.".format(pauseSeconds))
+            return
+        queue.popleft()
+        botStats[u"messagesDropped"] += 1
+        rateLimitNotice(conversation, u"Too many messages! Some were dropped.")
+    queue.append([argSet, False])
+    scheduleDispatch()
 
 
-def periodicLoop():
+def rateLimitNotice(conversation, notice):
     """
-    Used for any tasks that may need to run in the background.
+    Tells a chat it's sending too many messages, at most once every pauseSeconds.
 
-    :return True: if the program is not closing, False if it is closing.
-    :rtype bool:
+    :param conversation: The ID of the conversation.
+    :type conversation: int
+    :param notice: What to tell the chat.
+    :type notice: string_types
     """
-    processEvents()
-    msgQueueLen = len(messageQueue)
-    if msgQueueLen > 0:
-        if msgQueueLen <= overflowThreshold:
-            for argSet in messageQueue:
-                try:
-                    messageListener(*argSet)
-                except:
-                    print(u"Error in messageListener!\n", traceback.format_exc())
-        del messageQueue[:]  # Empties the queue
+    if currentTime() - lastRateLimitNotice.get(conversation, 0) > pauseSeconds:
+        lastRateLimitNotice[conversation] = currentTime()
+        sendMessage(conversation, conversation, u"", notice)
 
-    return running
 
+def takeToken(key, rate, burst):
+    """
+    Takes a token from a token bucket, refilling it first.
 
-bus = SessionBus()  # Initialize the DBus interface
-purple = bus.get(u"im.pidgin.purple.PurpleService", u"/im/pidgin/purple/PurpleObject")  # Connect to libpurple clients.
+    :param key: What the bucket is for, such as a conversation ID.
+    :param rate: How many tokens the bucket refills per second.
+    :type rate: float
+    :param burst: How many tokens the bucket can hold.
+    :type burst: int
+    :return How: many seconds until a token is available, or 0 if one was taken.
+    :rtype float:
+    """
+    bucket = rateLimitBuckets.setdefault(key, [burst, currentTime()])
+    bucket[0] = min(burst, bucket[0] + (currentTime() - bucket[1]) * rate)
+    bucket[1] = currentTime()
+    if bucket[0] < 1:
+        return (1 - bucket[0]) / rate
+    bucket[0] -= 1
+    return 0
 
-# Surprisingly, im.pidgin.* and im/pidgin/* work for Finch too. Not sure why.
-purple.ReceivedImMsg.connect(queueMessage)
-purple.ReceivedChatMsg.connect(queueMessage)
 
-GLib.timeout_add_seconds(1, periodicLoop)  # Run periodicLoop once per second.
-mainloop = GObject.MainLoop()
-mainloop.run()  # Actually run the program.
+def scheduleDispatch(delay=0):
+    """
+    Makes sure dispatchMessages will run after the given delay, or as soon as the main loop is idle.
+
+    :param delay: How many seconds to wait.
+    :type delay: float
+    """
+    global dispatchSource, dispatchDeadline
+    if dispatchSource is not None:
+        if dispatchDeadline <= currentTime() + delay:
+            return
+        GLib.source_remove(dispatchSource)
+    dispatchDeadline = currentTime() + delay
+    dispatchSource = GLib.idle_add(dispatchMessages) if delay <= 0 else GLib.timeout_add(int(delay * 1000) + 1,
+        dispatchMessages)
+
+
+def dispatchMessages():
+    """
+    Runs messageListener on queued messages, taking turns between chats. Messages from chats or users over their rate
+    limit wait, and dispatchMessages schedules itself again for when they can go.
+
+    :return False:, so the GLib source only runs once.
+    :rtype bool:
+    """
+    global dispatchSource
+    dispatchSource = None
+    wait = None
+    progress = True
+    while progress:
+        progress = False
+        for conversation, queue in list(conversationQueues.items()):  # One message per chat per turn keeps it fair.
+            if not queue:
+                del conversationQueues[conversation]
+                continue
+            queued = queue[0]
+            argSet = queued[0]
+            # Sender tokens are only taken once the chat has one, so waiting doesn't cost the sender anything.
+            convWait = takeToken(conversation, conversationRate, conversationBurst)
+            senderWait = convWait or takeToken((argSet[0], argSet[1]), senderRate, senderBurst)
+            if convWait or senderWait:
+                if senderWait and not convWait:  # The chat's token was taken, but the sender couldn't use it.
+                    rateLimitBuckets[conversation][0] += 1  # Give back the chat's token.
+                for waiting in queue:  # Everything behind the message has to wait too.
+                    if not waiting[1]:
+                        waiting[1] = True
+                        botStats[u"messagesDelayed"] += 1
+                wait = min(wait or convWait or senderWait, convWait or senderWait)
+                continue
+            queue.popleft()
+            progress = True
+            clearMessageMemos()  # Times and alias vars are worked out once per message.
+            try:
+                messageListener(*argSet)
+            except:
+                print(u"Error in messageListener!\n", traceback.format_exc())
+    if wait is not None:
+        scheduleDispatch(wait)
+    return False
+
 
-exit(exitCode)  # Make sure the process exists with the correct error code.
+def setBackend(backend):
+    """
+    Sets the libpurple backend the bot talks to, then starts listening to it.
+
+    :param backend: The backend to use, such as a DBusPurpleBackend or a FakePurpleBackend.
+    :type backend: PurpleBackend
+    """
+    global purple
+    purple = backend
+    buildConvRegistry()
+    purple.connect(u"ConversationCreated", registerConv)
+    purple.connect(u"DeletingConversation", unregisterConv)
+    purple.connect(u"ConversationUpdated", onConversationUpdated)
+    purple.connect(u"BuddyAdded", onBuddyChanged)
+    purple.connect(u"BuddyRemoved", onBuddyChanged)
+    purple.connect(u"BlistNodeAliased", onBuddyChanged)
+    purple.connect(u"AccountAliasChanged", lambda account, *_: accountAliases.pop(account, None))
+    purple.connect(u"ChatBuddyJoined", onChatBuddyJoined)
+    purple.connect(u"ChatBuddyLeft", onChatBuddyLeft)
+    purple.connect(u"ChatBuddyFlags", onChatBuddyFlags)
+    purple.connect(u"ChatBuddyRenamed", onChatBuddyRenamed)
+    purple.connect(u"ReceivedImMsg", queueMessage)
+    purple.connect(u"ReceivedChatMsg", queueMessage)
+    buildEventHeap()  # Scheduled events run when they're due. Messages run as they arrive.
+
+
+def main():
+    """
+    Connects to libpurple over DBus and runs the bot until it exits.
+    """
+    global mainloop
+    setBackend(DBusPurpleBackend())
+    mainloop = GObject.MainLoop()
+    mainloop.run()  # Actually run the program.
+    flushFiles()
+    stateStore.close()
+    messageLog.close()
+    messageIndex.close()
+    processPool.shutdown(wait=False)
+    if threadPool is not None:
+        threadPool.shutdown(wait=False)
+    exit(exitCode)  # Make sure the process exists with the correct error code.
+
+
+if __name__ == u"__main__":
+    main()
@@ -0,0 +1,147 @@
+# coding: UTF-8
+"""
+An index of puns by the words in them, so a random pun with a given word can be picked without looking through every
+pun.
+"""
+
+from __future__ import print_function  # This does not break Python 3 compatibility.
+
+import re
+from random import randrange
+
+wordPattern = re.compile(u"\\w+", re.UNICODE)
+
+
+def getWords(text):
+    """
+    Gets the lower-cased words in some text, without any punctuation.
+
+    :param text: The text.
+    :type text: string_types
+    :return The: words.
+    :rtype set:
+    """
+    return set(word.lower() for word in wordPattern.findall(text))
+
+
+class RandomSet(object):
+    """
+    A set which can also pick a random item. Items are kept in a list, with each one's position in a dict, so adding,
+    removing and picking are all constant time.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}  # Item -> where it is in items.
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def add(self, item):
+        """
+        Adds an item, if it isn't already there.
+
+        :param item: The item.
+        """
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def remove(self, item):
+        """
+        Removes an item by moving the last item into its place.
+
+        :param item: The item, which has to be there.
+        """
+        position = self.positions.pop(item)
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
+
+    def choice(self):
+        """
+        Picks a random item.
+
+        :return The: item, or None if there aren't any.
+        """
+        return self.items[randrange(len(self.items))] if self.items else None
+
+
+class PunIndex(object):
+    """
+    Every pun from a group of chats, once each even if more than one of the chats has it, indexed by the words in it.
+    """
+
+    def __init__(self, chats, puns):
+        """
+        :param chats: The titles of the chats in the group.
+        :type chats: tuple
+        :param puns: Chat title -> the chat's puns, for any chats.
+        :type puns: dict
+        """
+        self.chats = frozenset(chats)
+        self.puns = RandomSet()
+        self.counts = {}  # Pun -> how many times the chats have it, so it's only removed once none of them do.
+        self.words = {}  # Word -> RandomSet of the puns with it.
+        for chat in self.chats:
+            for pun in puns.get(chat, ()):
+                self.add(pun)
+
+    def add(self, pun):
+        """
+        Adds a pun which one of the chats now has.
+
+        :param pun: The pun.
+        :type pun: string_types
+        """
+        self.counts[pun] = self.counts.get(pun, 0) + 1
+        if pun in self.puns:
+            return
+        self.puns.add(pun)
+        for word in getWords(pun):
+            self.words.setdefault(word, RandomSet()).add(pun)
+
+    def remove(self, pun):
+        """
+        Removes a pun which one of the chats no longer has.
+
+        :param pun: The pun.
+        :type pun: string_types
+        """
+        if pun not in self.counts:
+            return
+        self.counts[pun] -= 1
+        if self.counts[pun]:
+            return
+        del self.counts[pun]
+        self.puns.remove(pun)
+        for word in getWords(pun):
+            self.words[word].remove(pun)
+            if not self.words[word]:
+                del self.words[word]
+
+    def choice(self, text=u""):
+        """
+        Picks a random pun with every word in some text.
+
+        :param text: The words the pun has to have, or nothing for any pun.
+        :type text: string_types
+        :return The: pun, or None if no pun has all of the words.
+        :rtype string_types:
+        """
+        words = getWords(text)
+        if not words:
+            return self.puns.choice()
+        matches = sorted((self.words.get(word, RandomSet()) for word in words), key=len)
+        if len(matches) == 1:
+            return matches[0].choice()
+        # Only the puns with the rarest word have to be checked for the others.
+        candidates = [pun for pun in matches[0] if all(pun in match for match in matches[1:])]
+        return candidates[randrange(len(candidates))] if candidates else None
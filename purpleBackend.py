@@ -0,0 +1,406 @@
+# coding: UTF-8
+"""
+The ways the bot can talk to libpurple: over DBus, to an in-memory fake, or through a wrapper recording every call.
+"""
+
+from __future__ import print_function  # This does not break Python 3 compatibility.
+
+from collections import Counter
+from itertools import count
+from time import time
+
+PURPLE_CONV_TYPE_IM = 1
+PURPLE_CONV_TYPE_CHAT = 2
+
+
+class PurpleBackend(object):
+    """
+    Everything the bot needs from libpurple. Methods are named after libpurple's DBus methods, so
+    backend.PurpleConvChatSend(conv, message) works the same way on every backend.
+    """
+
+    # The libpurple methods the bot calls.
+    methods = (u"PurpleAccountGetAlias", u"PurpleAccountGetProtocolName", u"PurpleAccountGetUsername",
+    u"PurpleAccountsGetAll", u"PurpleBuddyGetAlias", u"PurpleBuddyGetName", u"PurpleConvChat",
+    u"PurpleConvChatCbGetName", u"PurpleConvChatGetUsers", u"PurpleConvChatSend", u"PurpleConvIm",
+    u"PurpleConvImSend", u"PurpleConversationGetAccount", u"PurpleConversationGetName",
+    u"PurpleConversationGetTitle", u"PurpleConversationGetType", u"PurpleFindBuddy", u"PurpleGetConversations",
+    u"PurpleMarkupStripHtml", u"PurpleUnescapeHtml")
+    # The libpurple signals the bot listens to.
+    signals = (u"AccountAliasChanged", u"BlistNodeAliased", u"BuddyAdded", u"BuddyRemoved", u"ChatBuddyFlags",
+    u"ChatBuddyJoined", u"ChatBuddyLeft", u"ChatBuddyRenamed", u"ConversationCreated", u"ConversationUpdated",
+    u"DeletingConversation", u"ReceivedChatMsg", u"ReceivedImMsg")
+
+    def connect(self, signal, handler):
+        """
+        Runs handler whenever libpurple emits the given signal.
+
+        :param signal: The name of the signal, such as "ReceivedChatMsg".
+        :type signal: string_types
+        :param handler: The function to run, which gets the signal's arguments.
+        :type handler: function
+        """
+        raise NotImplementedError
+
+    def callAsync(self, method, signature, args, callback):
+        """
+        Calls a libpurple method without waiting for it to finish.
+
+        :param method: The name of the libpurple method, such as "PurpleConvChatSend".
+        :type method: string_types
+        :param signature: The DBus signature of the method's arguments, such as "(is)".
+        :type signature: string_types
+        :param args: The arguments to the method.
+        :type args: tuple
+        :param callback: Called with the method's return value (or None) and the error (or None).
+        :type callback: function
+        """
+        raise NotImplementedError
+
+
+class DBusPurpleBackend(PurpleBackend):
+    """
+    Talks to a running pidgin or finch over DBus.
+    """
+    busName = u"im.pidgin.purple.PurpleService"
+    objectPath = u"/im/pidgin/purple/PurpleObject"
+    interface = u"im.pidgin.purple.PurpleInterface"
+
+    def __init__(self):
+        # Only imported here so the other backends work without DBus.
+        from gi.repository import Gio, GLib
+        from pydbus import SessionBus
+        self._Gio, self._GLib = Gio, GLib
+        self.bus = SessionBus()  # Initialize the DBus interface
+        # Surprisingly, im.pidgin.* and im/pidgin/* work for Finch too. Not sure why.
+        self.proxy = self.bus.get(self.busName, self.objectPath)  # Connect to libpurple clients.
+
+    def __getattr__(self, name):
+        return getattr(self.proxy, name)
+
+    def connect(self, signal, handler):
+        getattr(self.proxy, signal).connect(handler)
+
+    def callAsync(self, method, signature, args, callback):
+        GLib = self._GLib
+
+        def onReply(connection, result, *_):
+            try:
+                value = connection.call_finish(result).unpack()
+            except GLib.Error as e:
+                callback(None, e)
+                return
+            callback(value[0] if len(value) == 1 else None, None)
+
+        self.bus.con.call(self.busName, self.objectPath, self.interface, method, GLib.Variant(signature, tuple(args)),
+            None, self._Gio.DBusCallFlags.NONE, -1, None, onReply, None)
+
+
+class FakePurpleBackend(PurpleBackend):
+    """
+    An in-memory libpurple, for running the bot without pidgin or finch. Accounts, conversations and buddies are
+    scripted with the add* methods, and incoming messages with receiveMessage. Everything the bot sends ends up in sent.
+    """
+
+    def __init__(self):
+        self._ids = count(1)
+        self.accounts = {}  # Account ID -> {"username", "alias", "protocol"}
+        self.conversations = {}  # Conversation ID -> {"account", "title", "name", "type", "users", "flags"}
+        self.buddies = {}  # Buddy ID -> (account, name, alias)
+        self.chatUsers = {}  # Chat user ID -> name
+        self.convChats = {}  # PurpleConvChat/PurpleConvIm ID -> conversation ID
+        self.handlers = {}  # Signal name -> handlers
+        self.sent = []  # (conversation ID, message) for every message sent.
+
+    def connect(self, signal, handler):
+        self.handlers.setdefault(signal, []).append(handler)
+
+    def emit(self, signal, *args):
+        """
+        Emits a signal, running every handler connected to it.
+
+        :param signal: The name of the signal, such as "ReceivedChatMsg".
+        :type signal: string_types
+        :param args: The signal's arguments.
+        """
+        for handler in list(self.handlers.get(signal, ())):
+            handler(*args)
+
+    def callAsync(self, method, signature, args, callback):
+        try:
+            value = getattr(self, method)(*args)
+        except Exception as e:
+            callback(None, e)
+            return
+        callback(value, None)
+
+    # Scripting
+    def addAccount(self, username, alias=None, protocol=u"IRC"):
+        """
+        Adds an account for the bot.
+
+        :param username: The account's username.
+        :type username: string_types
+        :param alias: The account's alias, which is the username if not given.
+        :type alias: string_types
+        :param protocol: The name of the account's protocol, such as "IRC" or "Facebook".
+        :type protocol: string_types
+        :return The: account ID.
+        :rtype int:
+        """
+        account = next(self._ids)
+        self.accounts[account] = {u"username": username, u"alias": alias or username, u"protocol": protocol}
+        return account
+
+    def addConversation(self, account, title, convType=PURPLE_CONV_TYPE_CHAT, users=()):
+        """
+        Opens a conversation, emitting ConversationCreated.
+
+        :param account: The account ID the conversation is on.
+        :type account: int
+        :param title: The conversation's title.
+        :type title: string_types
+        :param convType: PURPLE_CONV_TYPE_CHAT or PURPLE_CONV_TYPE_IM.
+        :type convType: int
+        :param users: The names of the users in the conversation.
+        :type users: tuple
+        :return The: conversation ID.
+        :rtype int:
+        """
+        conv = next(self._ids)
+        self.conversations[conv] = {u"account": account, u"title": title, u"name": title, u"type": convType,
+            u"users": list(users), u"flags": dict.fromkeys(users, 0)}
+        self.emit(u"ConversationCreated", conv)
+        return conv
+
+    def removeConversation(self, conv):
+        """
+        Closes a conversation, emitting DeletingConversation.
+
+        :param conv: The conversation ID.
+        :type conv: int
+        """
+        self.emit(u"DeletingConversation", conv)
+        del self.conversations[conv]
+
+    def addBuddy(self, account, name, alias=u""):
+        """
+        Adds a buddy to the buddy list, emitting BuddyAdded.
+
+        :param account: The account ID the buddy is on.
+        :type account: int
+        :param name: The buddy's name.
+        :type name: string_types
+        :param alias: The buddy's alias.
+        :type alias: string_types
+        :return The: buddy ID.
+        :rtype int:
+        """
+        buddy = next(self._ids)
+        self.buddies[buddy] = (account, name, alias)
+        self.emit(u"BuddyAdded", buddy)
+        return buddy
+
+    def joinChat(self, conv, user, flags=0):
+        """
+        Adds a user to a chat, emitting ChatBuddyJoined.
+
+        :param conv: The conversation ID.
+        :type conv: int
+        :param user: The user's name.
+        :type user: string_types
+        :param flags: The user's flags, such as whether they're an op.
+        :type flags: int
+        """
+        info = self.conversations[conv]
+        info[u"users"].append(user)
+        info[u"flags"][user] = flags
+        self.emit(u"ChatBuddyJoined", conv, user, flags, True)
+
+    def leaveChat(self, conv, user, reason=u""):
+        """
+        Removes a user from a chat, emitting ChatBuddyLeft.
+
+        :param conv: The conversation ID.
+        :type conv: int
+        :param user: The user's name.
+        :type user: string_types
+        :param reason: Why they left.
+        :type reason: string_types
+        """
+        info = self.conversations[conv]
+        info[u"users"].remove(user)
+        del info[u"flags"][user]
+        self.emit(u"ChatBuddyLeft", conv, user, reason)
+
+    def renameChatUser(self, conv, user, newName):
+        """
+        Changes a user's name in a chat, emitting ChatBuddyRenamed.
+
+        :param conv: The conversation ID.
+        :type conv: int
+        :param user: The user's old name.
+        :type user: string_types
+        :param newName: The user's new name.
+        :type newName: string_types
+        """
+        info = self.conversations[conv]
+        info[u"users"][info[u"users"].index(user)] = newName
+        info[u"flags"][newName] = info[u"flags"].pop(user)
+        self.emit(u"ChatBuddyRenamed", conv, user, newName, newName)
+
+    def setChatUserFlags(self, conv, user, flags):
+        """
+        Changes a user's flags in a chat, emitting ChatBuddyFlags.
+
+        :param conv: The conversation ID.
+        :type conv: int
+        :param user: The user's name.
+        :type user: string_types
+        :param flags: The user's new flags.
+        :type flags: int
+        """
+        oldFlags = self.conversations[conv][u"flags"][user]
+        self.conversations[conv][u"flags"][user] = flags
+        self.emit(u"ChatBuddyFlags", conv, user, oldFlags, flags)
+
+    def receiveMessage(self, conv, sender, message, flags=0):
+        """
+        Receives a message in a conversation, emitting ReceivedChatMsg or ReceivedImMsg.
+
+        :param conv: The conversation ID.
+        :type conv: int
+        :param sender: The name of whoever sent the message.
+        :type sender: string_types
+        :param message: The message.
+        :type message: string_types
+        :param flags: The message's flags.
+        :type flags: int
+        """
+        info = self.conversations[conv]
+        self.emit(u"ReceivedChatMsg" if info[u"type"] == PURPLE_CONV_TYPE_CHAT else u"ReceivedImMsg",
+            info[u"account"], sender, message, conv, flags)
+
+    # libpurple
+    def PurpleAccountGetAlias(self, account):
+        return self.accounts[account][u"alias"]
+
+    def PurpleAccountGetProtocolName(self, account):
+        return self.accounts[account][u"protocol"]
+
+    def PurpleAccountGetUsername(self, account):
+        return self.accounts[account][u"username"]
+
+    def PurpleAccountsGetAll(self):
+        return list(self.accounts)
+
+    def PurpleBuddyGetAlias(self, buddy):
+        return self.buddies[buddy][2] if buddy in self.buddies else u""
+
+    def PurpleBuddyGetName(self, buddy):
+        return self.buddies[buddy][1] if buddy in self.buddies else u""
+
+    def PurpleConvChat(self, conv):
+        return self._convHandle(conv)
+
+    def PurpleConvChatCbGetName(self, user):
+        return self.chatUsers[user]
+
+    def PurpleConvChatGetUsers(self, convChat):
+        users = []
+        for name in self.conversations[self.convChats[convChat]][u"users"]:
+            user = next(self._ids)
+            self.chatUsers[user] = name
+            users.append(user)
+        return users
+
+    def PurpleConvChatSend(self, convChat, message):
+        self.sent.append((self.convChats[convChat], message))
+
+    def PurpleConvIm(self, conv):
+        return self._convHandle(conv)
+
+    def PurpleConvImSend(self, convIm, message):
+        self.sent.append((self.convChats[convIm], message))
+
+    def PurpleConversationGetAccount(self, conv):
+        return self.conversations[conv][u"account"]
+
+    def PurpleConversationGetName(self, conv):
+        return self.conversations[conv][u"name"]
+
+    def PurpleConversationGetTitle(self, conv):
+        return self.conversations[conv][u"title"]
+
+    def PurpleConversationGetType(self, conv):
+        return self.conversations[conv][u"type"]
+
+    def PurpleFindBuddy(self, account, name):
+        return next((buddy for buddy, info in self.buddies.items() if info[:2] == (account, name)), 0)
+
+    def PurpleGetConversations(self):
+        return list(self.conversations)
+
+    def PurpleMarkupStripHtml(self, message):
+        return message
+
+    def PurpleUnescapeHtml(self, message):
+        return message
+
+    def _convHandle(self, conv):
+        """
+        Gets the PurpleConvChat/PurpleConvIm ID for a conversation, which libpurple keeps separate from its own ID.
+        """
+        handle = next((handle for handle, handleConv in self.convChats.items() if handleConv == conv), None)
+        if handle is None:
+            handle = next(self._ids)
+            self.convChats[handle] = conv
+        return handle
+
+
+class RecordingPurpleBackend(PurpleBackend):
+    """
+    Wraps another backend, recording every call made to it and how long it took.
+    """
+
+    def __init__(self, backend):
+        """
+        :param backend: The backend to wrap.
+        :type backend: PurpleBackend
+        """
+        self.backend = backend
+        self.calls = []  # (method, args, return value, seconds taken)
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+        if not name.startswith(u"Purple"):
+            return method
+
+        def record(*args):
+            startTime = time()
+            value = method(*args)
+            self.calls.append((name, args, value, time() - startTime))
+            return value
+
+        return record
+
+    def connect(self, signal, handler):
+        self.backend.connect(signal, handler)
+
+    def callAsync(self, method, signature, args, callback):
+        startTime = time()
+
+        def record(value, error):
+            self.calls.append((method, tuple(args), value if error is None else error, time() - startTime))
+            callback(value, error)
+
+        self.backend.callAsync(method, signature, args, record)
+
+    def callCounts(self):
+        """
+        Counts how many times each method was called.
+
+        :return How: many times each method was called.
+        :rtype Counter:
+        """
+        return Counter(call[0] for call in self.calls)
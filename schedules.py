@@ -0,0 +1,207 @@
+# coding: UTF-8
+"""
+Recurring schedules for scheduled commands, such as "every weekday at 9am", "every 2 hours" or "cron */15 9-17 * * 1-5".
+Only the next time a schedule is due is ever worked out, so a schedule costs the same however often it repeats.
+"""
+
+from __future__ import print_function  # This does not break Python 3 compatibility.
+
+import re
+from datetime import timedelta
+
+weekdayNames = (u"sunday", u"monday", u"tuesday", u"wednesday", u"thursday", u"friday", u"saturday")  # Cron order.
+dayGroups = {u"day": tuple(range(7)), u"weekday": (1, 2, 3, 4, 5), u"weekend": (0, 6)}
+intervalUnits = {u"minute": 60, u"hour": 60 * 60, u"day": 24 * 60 * 60, u"week": 7 * 24 * 60 * 60}
+intervalPattern = re.compile(u"^every\\s+(\\d+\\s+)?(minute|hour|day|week)s?$")
+dayPattern = u"(?:{})s?".format(u"|".join(sorted(dayGroups) + [name[:3] + u"(?:" + name[3:] + u")?"
+    for name in weekdayNames]))
+weeklyPattern = re.compile(u"^every\\s+({0}(?:\\s*(?:,|and)\\s*{0})*)\\s+at\\s+(.+)$".format(dayPattern))
+catchUpPattern = re.compile(u"\\s+catch\\s*up\\s+(skip|once|all)$", re.IGNORECASE)
+timeOfDayPattern = re.compile(u"^(\\d{1,2})(?::(\\d\\d))?\\s*([ap]\\.?m\\.?)?$")
+recurrences = {}  # Schedule text -> the schedule, so each is only parsed once.
+
+
+class CronSchedule(object):
+    """
+    A cron expression: minute, hour, day of the month, month and day of the week, each "*", a number, a range like
+    "1-5", a list like "1,3,5", or any of those with a step like "*/15". Days of the week start at 0 for Sunday.
+    """
+    fieldRanges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        """
+        :param expression: The cron expression, such as "0 9 * * 1-5".
+        :type expression: string_types
+        :raises ValueError: If the expression isn't valid.
+        """
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(u"A cron expression needs 5 fields: minute, hour, day, month and day of the week.")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (self._parseField(field, low, high)
+            for field, (low, high) in zip(fields, self.fieldRanges))
+        if 7 in self.weekdays:  # 7 is Sunday too.
+            self.weekdays = self.weekdays | {0}
+        # Like cron, if both days are restricted, either one matching is enough.
+        self.anyDay, self.anyWeekday = fields[2] == u"*", fields[4] == u"*"
+
+    @staticmethod
+    def _parseField(field, low, high):
+        values = set()
+        for part in field.split(u","):
+            rangePart, _, step = part.partition(u"/")
+            if rangePart == u"*":
+                start, end = low, high
+            elif u"-" in rangePart:
+                start, end = (int(value) for value in rangePart.split(u"-", 1))
+            else:
+                start = end = int(rangePart)
+                if step:
+                    end = high
+            if not low <= start <= end <= high:
+                raise ValueError(u"\"{}\" is out of range, which is {}-{}.".format(part, low, high))
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return frozenset(values)
+
+    def _dayMatches(self, when):
+        dayMatches = when.day in self.days
+        weekdayMatches = (when.weekday() + 1) % 7 in self.weekdays
+        if self.anyDay or self.anyWeekday:
+            return dayMatches and weekdayMatches
+        return dayMatches or weekdayMatches
+
+    def next(self, after, last=None):
+        """
+        Gets the first time the schedule is due after the given time.
+
+        :param after: The time to start looking from.
+        :type after: datetime
+        :param last: When the schedule was last due. Not used by cron schedules.
+        :type last: datetime
+        :return The: next time the schedule is due.
+        :rtype datetime:
+        """
+        when = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(5 * 366 * 24):  # Skips a month, day or hour at a time, so this is plenty for any schedule.
+            if when.month not in self.months:
+                when = (when.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._dayMatches(when):
+                when = when.replace(hour=0, minute=0) + timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0) + timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += timedelta(minutes=1)
+            else:
+                return when
+        raise ValueError(u"That schedule never comes up.")
+
+
+class IntervalSchedule(object):
+    """
+    Repeats every so many seconds, counting from when it was last due.
+    """
+
+    def __init__(self, seconds):
+        """
+        :param seconds: How many seconds apart each time is.
+        :type seconds: int
+        """
+        if seconds <= 0:
+            raise ValueError(u"A schedule has to repeat at least every minute.")
+        self.interval = timedelta(seconds=seconds)
+
+    def next(self, after, last=None):
+        """
+        Gets the first time the schedule is due after the given time.
+
+        :param after: The time to start looking from.
+        :type after: datetime
+        :param last: When the schedule was last due, which the times are counted from. Starts at after if not given.
+        :type last: datetime
+        :return The: next time the schedule is due.
+        :rtype datetime:
+        """
+        last = last or after
+        if last > after:
+            return last
+        return last + self.interval * (int((after - last).total_seconds() // self.interval.total_seconds()) + 1)
+
+
+def parseTimeOfDay(text):
+    """
+    Parses a time of day, such as "9am", "5:30 pm", "17:00", "noon" or "midnight".
+
+    :param text: The time of day.
+    :type text: string_types
+    :return The: hour and minute.
+    :rtype tuple:
+    """
+    text = text.strip()
+    if text in (u"noon", u"midnight"):
+        return (12 if text == u"noon" else 0), 0
+    match = timeOfDayPattern.match(text)
+    if match is None:
+        raise ValueError(u"\"{}\" isn't a time of day.".format(text))
+    hour, minute = int(match.group(1)), int(match.group(2) or 0)
+    if match.group(3):
+        if not 1 <= hour <= 12:
+            raise ValueError(u"\"{}\" isn't a time of day.".format(text))
+        hour = hour % 12 + (12 if match.group(3)[0] == u"p" else 0)
+    if hour > 23 or minute > 59:
+        raise ValueError(u"\"{}\" isn't a time of day.".format(text))
+    return hour, minute
+
+
+def splitCatchUp(text):
+    """
+    Splits the catch-up rule off the end of a schedule, such as "every day at 9am catch up all". The rule says what to
+    do about times the schedule was due while the bot wasn't running: "skip" them, run the command "once" for all of
+    them, or run it for "all" of them.
+
+    :param text: The schedule.
+    :type text: string_types
+    :return The: schedule without the rule, and the rule, or None if there wasn't one.
+    :rtype tuple:
+    """
+    match = catchUpPattern.search(text)
+    if match is None:
+        return text, None
+    return text[:match.start()], match.group(1).lower()
+
+
+def parseRecurrence(text):
+    """
+    Parses a recurring schedule, which is one of:
+        "every 2 hours", "every minute", "every 3 days"...
+        "every weekday at 9am", "every monday and friday at 5:30pm", "every day at noon", "every weekend at 10"...
+        "cron 0 9 * * 1-5", or any other cron expression.
+    Schedules are cached, so asking again for the same text is free.
+
+    :param text: The schedule.
+    :type text: string_types
+    :return The: schedule, which has a next(after, last) method, or None if the text isn't a recurring schedule.
+    :rtype CronSchedule or IntervalSchedule:
+    :raises ValueError: If it's a recurring schedule, but not a valid one.
+    """
+    text = u" ".join(text.lower().split())
+    if text in recurrences:
+        return recurrences[text]
+    schedule = None
+    if text.startswith(u"cron "):
+        schedule = CronSchedule(text[5:])
+    elif text.startswith(u"every "):
+        intervalMatch, weeklyMatch = intervalPattern.match(text), weeklyPattern.match(text)
+        if intervalMatch:
+            schedule = IntervalSchedule(int(intervalMatch.group(1) or 1) * intervalUnits[intervalMatch.group(2)])
+        elif weeklyMatch:
+            weekdays = set()
+            for day in re.split(u"\\s*(?:,|and)\\s*", weeklyMatch.group(1)):
+                day = day[:-1] if day.endswith(u"s") and day[:-1] in dayGroups else day
+                weekdays.update(dayGroups.get(day) or
+                    (next(i for i, name in enumerate(weekdayNames) if name.startswith(day[:3])),))
+            hour, minute = parseTimeOfDay(weeklyMatch.group(2))
+            schedule = CronSchedule(u"{} {} * * {}".format(minute, hour, u",".join(str(day) for day in weekdays)))
+        else:
+            raise ValueError(u"\"{}\" isn't a schedule I understand. Try \"every 2 hours\", \"every weekday at 9am\" "
+                u"or \"cron 0 9 * * 1-5\".".format(text))
+    recurrences[text] = schedule
+    return schedule
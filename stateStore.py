@@ -0,0 +1,580 @@
+# coding: UTF-8
+"""
+Where the bot keeps puns, aliases, nicks, locations and scheduled events between restarts.
+
+Every table is kept in memory the way the bot has always used it:
+    puns: chat title -> list of puns
+    aliases: chat title -> {alias -> command}
+    nicks: chat title -> {name -> nick}
+    atLoc: chat title -> {name -> [when, location, how long]}
+    scheduledEvents: list of [when, argSet]
+Changes go through the store, which updates the in-memory table and saves the change.
+"""
+
+from __future__ import print_function  # This does not break Python 3 compatibility.
+
+import sqlite3
+from datetime import datetime
+from io import open
+from json import dumps, loads
+from os import fsync, remove, rename
+from os.path import exists
+from sys import argv
+from threading import Thread
+
+defaultDateFormat = u"%a, %d %b %Y %H:%M:%S UTC"
+jsonPaths = {  # Table -> the json file it's kept in.
+    u"puns":            u"Puns.json",
+    u"aliases":         u"Aliases.json",
+    u"nicks":           u"nicks.json",
+    u"atLoc":           u"atLoc.json",
+    u"scheduledEvents": u"scheduledEvents.json"
+}
+chatTables = (u"puns", u"aliases", u"nicks", u"atLoc")  # The tables split up by chat.
+
+
+class StateStore(object):
+    """
+    The interface every store has.
+    """
+
+    def __init__(self):
+        self.tables = {}  # Table -> the in-memory table.
+
+    def load(self, table):
+        """
+        Gets the in-memory version of a table, loading it if needed.
+
+        :param table: The name of the table, such as "puns".
+        :type table: string_types
+        :return The: table, as a dict (or a list, for scheduledEvents).
+        """
+        raise NotImplementedError
+
+    def setItem(self, table, chat, key, value):
+        """
+        Sets a value in a chat's dict, such as a nick or an alias.
+
+        :param table: "aliases", "nicks" or "atLoc".
+        :type table: string_types
+        :param chat: The title of the chat.
+        :type chat: string_types
+        :param key: The key in the chat's dict.
+        :param value: The value to set it to.
+        """
+        raise NotImplementedError
+
+    def deleteItem(self, table, chat, key):
+        """
+        Removes a value from a chat's dict.
+
+        :param table: "aliases", "nicks" or "atLoc".
+        :type table: string_types
+        :param chat: The title of the chat.
+        :type chat: string_types
+        :param key: The key to remove.
+        """
+        raise NotImplementedError
+
+    def appendItem(self, table, chat, value):
+        """
+        Adds a value to a chat's list, such as a pun.
+
+        :param table: "puns".
+        :type table: string_types
+        :param chat: The title of the chat.
+        :type chat: string_types
+        :param value: The value to add.
+        """
+        raise NotImplementedError
+
+    def removeItem(self, table, chat, value):
+        """
+        Removes a value from a chat's list.
+
+        :param table: "puns".
+        :type table: string_types
+        :param chat: The title of the chat.
+        :type chat: string_types
+        :param value: The value to remove.
+        """
+        raise NotImplementedError
+
+    def addEvent(self, event, chat=None):
+        """
+        Adds a scheduled event.
+
+        :param event: The event, as [when, argSet].
+        :type event: list
+        :param chat: The title of the chat the event runs in, if it's known. The conversation ID in argSet changes
+        every session, so stores which look events up by chat use this instead.
+        :type chat: string_types
+        """
+        raise NotImplementedError
+
+    def removeEvent(self, event):
+        """
+        Removes a scheduled event.
+
+        :param event: The event, which has to be the same object that was added or loaded.
+        :type event: list
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Saves anything not saved yet and lets go of any files.
+        """
+        pass
+
+
+class JsonStateStore(StateStore):
+    """
+    Keeps every table in its own json file, rewriting the file whenever the table changes.
+    """
+
+    def __init__(self, readFile, updateFile, paths=None):
+        """
+        :param readFile: Reads and parses a json file, returning None if there's nothing there.
+        :type readFile: function
+        :param updateFile: Saves a value to a json file, taking the path and the value.
+        :type updateFile: function
+        :param paths: Table -> the json file it's kept in. Uses jsonPaths if not given.
+        :type paths: dict
+        """
+        StateStore.__init__(self)
+        self.readFile, self.updateFile = readFile, updateFile
+        self.paths = paths or jsonPaths
+
+    def load(self, table):
+        if table not in self.tables:
+            self.tables[table] = self.readFile(self.paths[table]) or ([] if table == u"scheduledEvents" else {})
+        return self.tables[table]
+
+    def save(self, table):
+        """
+        Saves a whole table to its json file.
+
+        :param table: The name of the table.
+        :type table: string_types
+        """
+        self.updateFile(self.paths[table], self.tables[table])
+
+    def setItem(self, table, chat, key, value):
+        self.load(table).setdefault(chat, {})[key] = value
+        self.save(table)
+
+    def deleteItem(self, table, chat, key):
+        self.load(table).get(chat, {}).pop(key, None)
+        self.save(table)
+
+    def appendItem(self, table, chat, value):
+        self.load(table).setdefault(chat, []).append(value)
+        self.save(table)
+
+    def removeItem(self, table, chat, value):
+        self.load(table)[chat].remove(value)
+        self.save(table)
+
+    def addEvent(self, event, chat=None):
+        self.load(u"scheduledEvents").append(event)
+        self.save(u"scheduledEvents")
+
+    def removeEvent(self, event):
+        self.load(u"scheduledEvents").remove(event)
+        self.save(u"scheduledEvents")
+
+
+class LazyChatTable(dict):
+    """
+    A chat title -> value dict which only loads a chat's rows from the database the first time it's used, so startup
+    doesn't have to read every chat's state.
+    """
+
+    def __init__(self, loadChat):
+        """
+        :param loadChat: Loads a chat's value given its title, returning None if the chat has nothing stored.
+        :type loadChat: function
+        """
+        dict.__init__(self)
+        self.loadChat = loadChat
+        self.loaded = set()  # Chats which have been looked up, even if they had nothing stored.
+
+    def _ensureLoaded(self, chat):
+        if chat not in self.loaded:
+            self.loaded.add(chat)
+            value = self.loadChat(chat)
+            if value is not None and not dict.__contains__(self, chat):
+                dict.__setitem__(self, chat, value)
+
+    def __contains__(self, chat):
+        self._ensureLoaded(chat)
+        return dict.__contains__(self, chat)
+
+    def __missing__(self, chat):
+        if chat in self.loaded:
+            raise KeyError(chat)
+        self._ensureLoaded(chat)
+        return dict.__getitem__(self, chat)
+
+    def get(self, chat, default=None):
+        return self[chat] if chat in self else default
+
+    def setdefault(self, chat, default=None):
+        if chat not in self:
+            dict.__setitem__(self, chat, default)
+        return dict.__getitem__(self, chat)
+
+
+class SqliteStateStore(StateStore):
+    """
+    Keeps every table in a SQLite database, writing one row per change. Chats are loaded when they're first used.
+    """
+
+    def __init__(self, path, dateFormat=defaultDateFormat):
+        """
+        :param path: The path of the database, which is created if it doesn't exist.
+        :type path: string_types
+        :param dateFormat: How datetimes are written, so they can be read back the same way as from json.
+        :type dateFormat: string_types
+        """
+        StateStore.__init__(self)
+        self.dateFormat = dateFormat
+        self.eventIds = {}  # id() of an event -> its row ID
+        self.db = sqlite3.connect(path)
+        old = self.db.execute(u"SELECT sql FROM sqlite_master WHERE name = 'scheduledEvents'").fetchone()
+        oldEvents = old is not None and u"chat INTEGER" in old[0]  # Made when events were kept by conversation ID.
+        if oldEvents:
+            self.db.executescript(u"""
+                DROP INDEX IF EXISTS eventsByDue;
+                DROP INDEX IF EXISTS eventsByUser;
+                ALTER TABLE scheduledEvents RENAME TO oldScheduledEvents;
+            """)
+        self.db.executescript(u"""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS puns (chat TEXT NOT NULL, pun TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS punsByChat ON puns (chat);
+            CREATE INDEX IF NOT EXISTS punsByText ON puns (pun);
+            CREATE TABLE IF NOT EXISTS aliases (chat TEXT NOT NULL, alias TEXT NOT NULL, command TEXT NOT NULL,
+                PRIMARY KEY (chat, alias));
+            CREATE TABLE IF NOT EXISTS nicks (chat TEXT NOT NULL, name TEXT NOT NULL, nick TEXT NOT NULL,
+                PRIMARY KEY (chat, name));
+            CREATE TABLE IF NOT EXISTS atLoc (chat TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL,
+                PRIMARY KEY (chat, name));
+            CREATE TABLE IF NOT EXISTS scheduledEvents (id INTEGER PRIMARY KEY, due REAL NOT NULL, chat TEXT,
+                user TEXT, event TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS eventsByDue ON scheduledEvents (due);
+            CREATE INDEX IF NOT EXISTS eventsByUser ON scheduledEvents (chat, user);
+        """)
+        if oldEvents:  # Their conversation IDs are from old sessions, so which chat they're in isn't known.
+            self.db.executescript(u"""
+                INSERT INTO scheduledEvents (id, due, chat, user, event)
+                    SELECT id, due, NULL, user, event FROM oldScheduledEvents;
+                DROP TABLE oldScheduledEvents;
+            """)
+        self.db.commit()
+
+    # Conversion
+    def _dumps(self, value):
+        return dumps(value, default=lambda dt: dt.strftime(self.dateFormat) if isinstance(dt, datetime) else None,
+            ensure_ascii=False)
+
+    def _due(self, event):
+        """
+        Gets when an event is due as a number, so the database can sort events by it.
+        """
+        due = event[0] if isinstance(event[0], datetime) else datetime.strptime(event[0], self.dateFormat)
+        return (due - datetime(1970, 1, 1)).total_seconds()
+
+    # Loading
+    def load(self, table):
+        if table in self.tables:
+            return self.tables[table]
+        if table == u"scheduledEvents":
+            self.tables[table] = []
+            for rowId, event in self.db.execute(u"SELECT id, event FROM scheduledEvents ORDER BY due"):
+                event = loads(event)
+                self.eventIds[id(event)] = rowId
+                self.tables[table].append(event)
+        else:
+            self.tables[table] = LazyChatTable(lambda chat: self._loadChat(table, chat))
+        return self.tables[table]
+
+    def _loadChat(self, table, chat):
+        if table == u"puns":
+            value = [row[0] for row in self.db.execute(u"SELECT pun FROM puns WHERE chat = ? ORDER BY rowid", (chat,))]
+        elif table == u"aliases":
+            value = dict(self.db.execute(u"SELECT alias, command FROM aliases WHERE chat = ?", (chat,)))
+        elif table == u"nicks":
+            value = dict(self.db.execute(u"SELECT name, nick FROM nicks WHERE chat = ?", (chat,)))
+        else:
+            value = {name: loads(row) for name, row in
+                     self.db.execute(u"SELECT name, value FROM atLoc WHERE chat = ?", (chat,))}
+        return value or None
+
+    # Changes
+    def _write(self, query, args):
+        with self.db:  # Commits, or rolls back if it fails.
+            return self.db.execute(query, args)
+
+    def setItem(self, table, chat, key, value):
+        self.load(table).setdefault(chat, {})[key] = value
+        if table == u"aliases":
+            self._write(u"INSERT OR REPLACE INTO aliases (chat, alias, command) VALUES (?, ?, ?)", (chat, key, value))
+        elif table == u"nicks":
+            self._write(u"INSERT OR REPLACE INTO nicks (chat, name, nick) VALUES (?, ?, ?)", (chat, key, value))
+        else:
+            self._write(u"INSERT OR REPLACE INTO atLoc (chat, name, value) VALUES (?, ?, ?)",
+                (chat, key, self._dumps(value)))
+
+    def deleteItem(self, table, chat, key):
+        self.load(table).get(chat, {}).pop(key, None)
+        self._write(u"DELETE FROM {} WHERE chat = ? AND {} = ?".format(
+            table, {u"aliases": u"alias", u"nicks": u"name", u"atLoc": u"name"}[table]), (chat, key))
+
+    def appendItem(self, table, chat, value):
+        self.load(table).setdefault(chat, []).append(value)
+        self._write(u"INSERT INTO puns (chat, pun) VALUES (?, ?)", (chat, value))
+
+    def removeItem(self, table, chat, value):
+        self.load(table)[chat].remove(value)
+        self._write(u"DELETE FROM puns WHERE rowid = (SELECT rowid FROM puns WHERE chat = ? AND pun = ? LIMIT 1)",
+            (chat, value))
+
+    def addEvent(self, event, chat=None):
+        self.load(u"scheduledEvents").append(event)
+        self.eventIds[id(event)] = self._write(
+            u"INSERT INTO scheduledEvents (due, chat, user, event) VALUES (?, ?, ?, ?)",
+            (self._due(event), chat, event[1][1], self._dumps(event))).lastrowid
+
+    def removeEvent(self, event):
+        self.load(u"scheduledEvents").remove(event)
+        rowId = self.eventIds.pop(id(event), None)
+        if rowId is not None:
+            self._write(u"DELETE FROM scheduledEvents WHERE id = ?", (rowId,))
+
+    def close(self):
+        self.db.close()
+
+
+class JournalStateStore(StateStore):
+    """
+    Keeps every table in one json snapshot, plus a journal with a line for every change since the snapshot was taken.
+    Changes are appended to the journal, and once it gets big, it's folded into a new snapshot on another thread.
+    """
+
+    def __init__(self, snapshotPath, journalPath, readFile=None, compactSize=256 * 1024, sync=True,
+            dateFormat=defaultDateFormat):
+        """
+        :param snapshotPath: The path of the snapshot.
+        :type snapshotPath: string_types
+        :param journalPath: The path of the journal.
+        :type journalPath: string_types
+        :param readFile: Reads and parses a json file. If given and there's no snapshot yet, the tables start off with
+        what's in the json files, so switching over doesn't lose anything.
+        :type readFile: function
+        :param compactSize: How big the journal can get, in bytes, before it's folded into the snapshot.
+        :type compactSize: int
+        :param sync: Whether every change should be fsynced, so even a power cut can't lose it.
+        :type sync: bool
+        :param dateFormat: How datetimes are written, so they can be read back the same way as from json.
+        :type dateFormat: string_types
+        """
+        StateStore.__init__(self)
+        self.snapshotPath, self.journalPath = snapshotPath, journalPath
+        self.compactSize, self.sync, self.dateFormat = compactSize, sync, dateFormat
+        self.compactingPath = journalPath + u".compacting"  # The journal being folded into the snapshot.
+        self.compactor = None  # The thread writing the snapshot, if there is one.
+        self.seq = 0  # The number of the last change.
+        try:
+            with open(snapshotPath, encoding=u"utf-8") as snapshotFile:
+                snapshot = loads(snapshotFile.read())
+            self.tables, self.seq = snapshot[u"tables"], snapshot[u"seq"]
+        except (IOError, ValueError):
+            if readFile is not None:
+                self.tables = {table: readFile(path) for table, path in jsonPaths.items()}
+        for table in jsonPaths:
+            self.tables[table] = self.tables.get(table) or ([] if table == u"scheduledEvents" else {})
+        # Replay whatever happened since the snapshot, including a journal that was being compacted during a crash.
+        for path in (self.compactingPath, journalPath):
+            self._replay(path)
+        self.journal = open(journalPath, u"a", encoding=u"utf-8")
+
+    def _dumps(self, value):
+        return dumps(value, default=lambda dt: dt.strftime(self.dateFormat) if isinstance(dt, datetime) else None,
+            ensure_ascii=False)
+
+    def _replay(self, path):
+        try:
+            with open(path, u"rb+") as journal:
+                end = 0  # Where the last complete line ends.
+                for line in journal:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError
+                        record = loads(line.decode(u"utf-8"))
+                    except ValueError:
+                        # Only the last line can be cut off by a crash, so drop it before anything's appended after it.
+                        journal.truncate(end)
+                        break
+                    end += len(line)
+                    if record[0] > self.seq:  # Changes already in the snapshot are skipped.
+                        self._apply(*record[1:])
+                        self.seq = record[0]
+        except IOError:
+            pass
+
+    def _apply(self, op, table, *args):
+        """
+        Makes a change to the in-memory tables.
+        """
+        if op == u"set":
+            self.tables[table].setdefault(args[0], {})[args[1]] = args[2]
+        elif op == u"delete":
+            self.tables[table].get(args[0], {}).pop(args[1], None)
+        elif op == u"append":
+            self.tables[table].setdefault(args[0], []).append(args[1])
+        elif op == u"remove":
+            self.tables[table][args[0]].remove(args[1])
+        elif op == u"addEvent":
+            self.tables[table].append(args[0])
+        elif op == u"removeEvent":
+            self.tables[table].pop(args[0])
+
+    def _record(self, op, table, *args):
+        """
+        Makes a change, then appends it to the journal.
+        """
+        self._apply(op, table, *args)
+        self.seq += 1
+        self.journal.write(self._dumps([self.seq, op, table] + list(args)) + u"\n")
+        self.journal.flush()
+        if self.sync:
+            fsync(self.journal.fileno())
+        if self.compactor is None and self.journal.tell() > self.compactSize:
+            self.compact()
+        elif self.compactor is not None and not self.compactor.is_alive():
+            self.compactor = None
+
+    def load(self, table):
+        return self.tables[table]
+
+    def setItem(self, table, chat, key, value):
+        self._record(u"set", table, chat, key, value)
+
+    def deleteItem(self, table, chat, key):
+        self._record(u"delete", table, chat, key)
+
+    def appendItem(self, table, chat, value):
+        self._record(u"append", table, chat, value)
+
+    def removeItem(self, table, chat, value):
+        self._record(u"remove", table, chat, value)
+
+    def addEvent(self, event, chat=None):
+        self._record(u"addEvent", u"scheduledEvents", event)
+
+    def removeEvent(self, event):
+        # Events are removed by position, which comes out the same when replaying.
+        index = next(i for i, other in enumerate(self.tables[u"scheduledEvents"]) if other is event)
+        self._record(u"removeEvent", u"scheduledEvents", index)
+
+    def compact(self, background=True):
+        """
+        Folds the journal into a new snapshot. The tables are serialized right away so the snapshot is consistent, then
+        the snapshot is written on another thread unless background is False.
+
+        :param background: Whether to write the snapshot on another thread.
+        :type background: bool
+        """
+        if self.compactor is not None:
+            self.compactor.join()
+        snapshot = self._dumps({u"seq": self.seq, u"tables": self.tables})
+        self.journal.close()
+        if exists(self.compactingPath):  # A compaction failed, so keep its changes around until one works.
+            with open(self.compactingPath, u"a", encoding=u"utf-8") as compacting, \
+                    open(self.journalPath, encoding=u"utf-8") as journal:
+                compacting.write(journal.read())
+            remove(self.journalPath)
+        else:
+            rename(self.journalPath, self.compactingPath)
+        self.journal = open(self.journalPath, u"a", encoding=u"utf-8")
+        self.compactor = Thread(target=self._writeSnapshot, args=(snapshot,))
+        self.compactor.daemon = True
+        self.compactor.start()
+        if not background:
+            self.compactor.join()
+            self.compactor = None
+
+    def _writeSnapshot(self, snapshot):
+        tempPath = self.snapshotPath + u".tmp"
+        with open(tempPath, u"w", encoding=u"utf-8") as snapshotFile:
+            snapshotFile.write(snapshot)
+            snapshotFile.flush()
+            fsync(snapshotFile.fileno())
+        rename(tempPath, self.snapshotPath)
+        remove(self.compactingPath)  # Everything in it is in the snapshot now.
+
+    def close(self):
+        self.compact(background=False)
+        self.journal.close()
+
+
+def migrateJson(databasePath, paths=None, dateFormat=defaultDateFormat):
+    """
+    Copies everything from the json files into a SQLite database, all in one transaction. The json files only have the
+    conversation IDs of scheduled events, not their chats' titles, so the events are copied without a chat.
+
+    :param databasePath: The path of the database to create. It can already exist, as long as nothing's been saved in
+    it, so migrating twice doesn't copy everything twice.
+    :type databasePath: string_types
+    :param paths: Table -> the json file it's kept in. Uses jsonPaths if not given.
+    :type paths: dict
+    :param dateFormat: How datetimes are written in the json files.
+    :type dateFormat: string_types
+    :return How: many rows were copied into each table.
+    :rtype dict:
+    :raises ValueError: If the database already has something saved in it.
+    """
+    store = SqliteStateStore(databasePath, dateFormat)
+    if any(store.db.execute(u"SELECT 1 FROM {} LIMIT 1".format(table)).fetchone() is not None
+           for table in (u"puns", u"aliases", u"nicks", u"atLoc", u"scheduledEvents")):
+        store.close()
+        raise ValueError(u"{} already has the bot's state in it.".format(databasePath))
+    counts = {}
+    with store.db:
+        for table, path in (paths or jsonPaths).items():
+            try:
+                with open(path, encoding=u"utf-8") as jsonFile:
+                    value = loads(jsonFile.read() or u"null")
+            except (IOError, ValueError):
+                value = None
+            rows = []
+            if table == u"scheduledEvents":
+                rows = [(store._due(event), None, event[1][1], store._dumps(event)) for event in value or []]
+                store.db.executemany(u"INSERT INTO scheduledEvents (due, chat, user, event) VALUES (?, ?, ?, ?)", rows)
+            elif table == u"puns":
+                rows = [(chat, pun) for chat, chatPuns in (value or {}).items() for pun in chatPuns]
+                store.db.executemany(u"INSERT INTO puns (chat, pun) VALUES (?, ?)", rows)
+            else:
+                rows = [(chat, key, store._dumps(item) if table == u"atLoc" else item)
+                        for chat, chatItems in (value or {}).items() for key, item in chatItems.items()]
+                store.db.executemany(u"INSERT OR REPLACE INTO {} VALUES (?, ?, ?)".format(table), rows)
+            counts[table] = len(rows)
+    store.close()
+    return counts
+
+
+if __name__ == u"__main__":
+    if len(argv) < 2 or argv[1] != u"migrate":
+        print(u"Usage: {} migrate [database path]".format(argv[0]))
+        print(u"Copies the bot's json files in the current directory into a SQLite database (pidginBot.db by default).")
+        exit(1)
+    try:
+        counts = migrateJson(argv[2] if len(argv) > 2 else u"pidginBot.db")
+    except ValueError as e:
+        print(e)
+        exit(1)
+    for migratedTable, count in sorted(counts.items()):
+        print(u"{}: {} rows".format(migratedTable, count))
@@ -0,0 +1,56 @@
+# coding: UTF-8
+"""
+Checks that MessageIndex only finds messages from the chat being searched, whatever the chat is called.
+"""
+
+from __future__ import print_function  # This does not break Python 3 compatibility.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from messageIndex import MessageIndex
+
+
+class MessageIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.index = MessageIndex(os.path.join(self.workDir, u"messageIndex.db"))
+        self.index.addMany([
+            (u"hello there", u"Alice", u"Cats", u"2020-01-01T00:00:00"),
+            (u"hello again", u"Bob", u"Cats and dogs", u"2020-01-01T00:00:01"),
+            (u"hello punctuation", u"Carol", u"!!!", u"2020-01-01T00:00:02"),
+            (u"hello emoji", u"Dave", u"\U0001F600\U0001F600", u"2020-01-01T00:00:03"),
+            (u"hello other punctuation", u"Erin", u"???", u"2020-01-01T00:00:04"),
+        ])
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def senders(self, chat, query):
+        return [row[1] for row in self.index.search(chat, query)[0]]
+
+    def testChatTitle(self):
+        """
+        A chat doesn't find messages from chats whose titles contain its title.
+        """
+        self.assertEqual(self.senders(u"Cats", u"hello"), [u"Alice"])
+        self.assertEqual(self.senders(u"Cats and dogs", u"hello"), [u"Bob"])
+
+    def testTitleWithoutWords(self):
+        """
+        A chat called only punctuation or emoji still finds its own messages, and only those.
+        """
+        self.assertEqual(self.senders(u"!!!", u"hello"), [u"Carol"])
+        self.assertEqual(self.senders(u"???", u"hello"), [u"Erin"])
+        self.assertEqual(self.senders(u"\U0001F600\U0001F600", u"hello"), [u"Dave"])
+        self.assertEqual(self.senders(u"!!!", u"emoji"), [])
+
+
+if __name__ == u"__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# coding: UTF-8
+"""
+Checks that dispatchMessages keeps each chat to its rate limit, using a FakePurpleBackend and a fake clock.
+"""
+
+from __future__ import print_function  # This does not break Python 3 compatibility.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from purpleBackend import FakePurpleBackend
+
+workDir = tempfile.mkdtemp()
+startDir = os.getcwd()
+os.chdir(workDir)  # The bot keeps its files in the working directory.
+try:
+    import pidginCrossover as bot
+finally:
+    os.chdir(startDir)
+
+
+def tearDownModule():
+    shutil.rmtree(workDir, ignore_errors=True)
+
+
+class RateLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.limits = (bot.conversationRate, bot.conversationBurst, bot.senderRate, bot.senderBurst,
+            bot.conversationQueueSize)
+        self.clock = [1000.0]
+        self.realTime = bot.currentTime
+        bot.currentTime = lambda: self.clock[0]
+        bot.rateLimitBuckets.clear()
+        bot.conversationQueues.clear()
+        self.handled = []
+        self.realListener = bot.messageListener
+        bot.messageListener = lambda *argSet: self.handled.append(argSet)
+        self.fake = FakePurpleBackend()
+        self.account = self.fake.addAccount(u"bot", u"Bot")
+        for i in range(5):  # Messages from people who aren't buddies look like the bot's own, and are ignored.
+            self.fake.addBuddy(self.account, u"user{}".format(i), u"User {}".format(i))
+        bot.setBackend(self.fake)
+        self.conv = self.fake.addConversation(self.account, u"Rate limited chat", users=[u"user0"])
+
+    def tearDown(self):
+        (bot.conversationRate, bot.conversationBurst, bot.senderRate, bot.senderBurst,
+            bot.conversationQueueSize) = self.limits
+        bot.currentTime = self.realTime
+        bot.messageListener = self.realListener
+
+    def testChatLimit(self):
+        """
+        A chat sending ten messages a second for ten seconds only gets its burst, then one a second, through.
+        """
+        bot.conversationRate, bot.conversationBurst = 1.0, 2
+        bot.senderRate, bot.senderBurst = 1000.0, 1000  # Only the chat's limit matters here.
+        bot.conversationQueueSize = 1000
+        for i in range(100):
+            bot.queueMessage(self.account, u"user{}".format(i % 5), u"message {}".format(i), self.conv, 0)
+            bot.dispatchMessages()
+            self.clock[0] += 0.1
+        self.assertLessEqual(len(self.handled), 2 + 10)
+        self.assertGreaterEqual(len(self.handled), 2 + 9)
+
+    def testSenderLimit(self):
+        """
+        A sender over their own limit doesn't use up the chat's tokens.
+        """
+        bot.conversationRate, bot.conversationBurst = 1.0, 2
+        bot.senderRate, bot.senderBurst = 0.001, 1
+        bot.conversationQueueSize = 1000
+        bot.queueMessage(self.account, u"user0", u"first", self.conv, 0)
+        bot.queueMessage(self.account, u"user0", u"second", self.conv, 0)
+        bot.dispatchMessages()
+        self.assertEqual(len(self.handled), 1)
+        self.assertEqual(bot.rateLimitBuckets[self.conv][0], 1)  # Only the first message took one.
+
+
+if __name__ == u"__main__":
+    unittest.main()